@@ -0,0 +1,555 @@
+"""
+Benchmarks. `generate` writes synthetic MARC files that look like our Koha
+exports (many items, subjects, some duplicates, broken 041s, Comics Plus
+ebooks, a share of MARC-8 records), `run` times each tool on them and saves
+the results as JSON, and `compare` shows the difference between two runs.
+
+Corpora are built byte by byte rather than with pymarc: pymarc can't write
+MARC-8 and would take longer than the tools we're timing. They only depend on
+their options and seed, so they're generated once and reused between runs.
+
+Each tool runs in its own process through its command line, like it does in
+production, so a run's time includes startup and its peak RSS is the tool's
+alone. summon.py's search is replaced with one that finds nothing, so only the
+MARC side of it is timed.
+"""
+
+from datetime import datetime
+import json
+import os
+from pathlib import Path
+import platform
+import random
+import subprocess
+import sys
+import time
+from typing import Callable, NamedTuple
+
+import click
+
+from marc_index import SD, as_marc
+
+HERE: Path = Path(__file__).resolve().parent
+DATA: Path = Path("data/bench")
+COUNTS: dict[str, int] = {"": 1, "K": 1000, "M": 1000**2}
+SIZES: tuple[str, ...] = ("1k", "100k", "1M")
+
+# (UTF-8, MARC-8) spellings, MARC-8 puts combining marks before the letter
+WORDS: tuple[tuple[str, bytes], ...] = (
+    *((w, w.encode()) for w in "art design history of the and a modern".split()),
+    *((w, w.encode()) for w in "city drawing studies new world graphic".split()),
+    *((w, w.encode()) for w in "painting theory practice in America".split()),
+    ("café", b"caf\xe2e"),
+    ("Müller", b"M\xe8uller"),
+    ("niño", b"ni\xb4no"),
+    ("Zürich", b"Z\xe8urich"),
+    ("Pérez", b"P\xe2erez"),
+    ("Łódź", b"\xa1\xe2od\xe2z"),
+    ("façade", b"fa\xf0cade"),
+)
+SUBJECTS: tuple[str, ...] = (
+    "Art, Modern",
+    "Architecture",
+    "Ceramics",
+    "Comic books, strips, etc.",
+    "Design",
+    "Graphic arts",
+    "Illustration",
+    "Painting, American",
+    "Photography",
+    "Textile design",
+)
+PLACES: tuple[str, ...] = ("New York", "London", "San Francisco", "Berlin")
+PUBLISHERS: tuple[str, ...] = ("Phaidon", "Thames & Hudson", "MIT Press", "Taschen")
+LANGUAGES: tuple[str, ...] = ("eng", "eng", "eng", "fre", "ger", "jpn", "spa")
+# 041$a values split_lang_codes.py has to fix
+BROKEN_041: tuple[str, ...] = ("engjpn", "engfre", "jap", "eng; spa", "ENG", "fr")
+JUNK_538: tuple[str, ...] = (
+    "Mode of access: World Wide Web.",
+    "Requires a valid library card and registration.",
+    "System requirements: Internet connection.",
+)
+
+
+class Options(NamedTuple):
+    records: int
+    seed: int
+    duplicates: float
+    broken_041: float
+    comics_plus: float
+    marc8: float
+    items: int
+    subjects: int
+
+    @property
+    def name(self) -> str:
+        return (
+            f"{self.records}-s{self.seed}-d{self.duplicates}-l{self.broken_041}"
+            f"-c{self.comics_plus}-m{self.marc8}-i{self.items}-t{self.subjects}.mrc"
+        )
+
+
+def parse_count(value: str) -> int:
+    """Parse a record count like 1000, 100k or 1M"""
+    number: str = value.strip().upper()
+    unit: str = number[-1] if number and number[-1] in COUNTS else ""
+    try:
+        return int(float(number.removesuffix(unit)) * COUNTS[unit])
+    except ValueError:
+        raise ValueError(f"{value} is not a count like 1000, 100k or 1M")
+
+
+class Generator:
+    """Writes records for one set of Options. A record's bibliographic fields
+    come from its work number, so duplicates (an earlier work again) repeat
+    the 001, ISBN, OCLC number and title, while items and the biblionumber
+    are always new."""
+
+    def __init__(self, options: Options):
+        self.options = options
+        self.random = random.Random(options.seed)
+        self.works: int = 0
+
+    def text(self, rng: random.Random, marc8: bool, words: int) -> bytes:
+        return b" ".join(
+            w[1] if marc8 else w[0].encode() for w in rng.choices(WORDS, k=words)
+        )
+
+    def subfields(self, indicators: str, *pairs: tuple[str, bytes | str]) -> bytes:
+        return indicators.encode() + b"".join(
+            SD + code.encode() + (v.encode() if isinstance(v, str) else v)
+            for code, v in pairs
+        )
+
+    def bib(self, work: int, marc8: bool, comics: bool) -> list[tuple[str, bytes]]:
+        o: Options = self.options
+        rng = random.Random(o.seed * 1_000_003 + work)
+        sf = self.subfields
+        year: int = rng.randint(1950, 2025)
+        language: str = rng.choice(LANGUAGES)
+        title: bytes = self.text(rng, marc8, rng.randint(2, 6)).capitalize()
+        author: bytes = self.text(rng, marc8, 2).title()
+        fields: list[tuple[str, bytes]] = [
+            ("001", b"ocm%08d" % (10_000_000 + work)),
+            ("003", b"OCoLC"),
+            ("005", b"20240101120000.0"),
+            (
+                "008",
+                f"240101s{year}    nyua     b    001 0 {language} d".encode(),
+            ),
+        ]
+        for _ in range(rng.randint(0, 2)):
+            isbn: str = f"978{rng.randrange(10**9, 10**10)}"
+            fields.append(("020", sf("  ", ("a", f"{isbn} (pbk.)"))))
+        fields += [
+            ("035", sf("  ", ("a", f"(OCoLC){10_000_000 + work}"))),
+            ("040", sf("  ", ("a", "DLC"), ("b", "eng"), ("e", "rda"), ("c", "DLC"))),
+        ]
+        if rng.random() < o.broken_041:
+            fields.append(("041", sf("0 ", ("a", rng.choice(BROKEN_041)))))
+        elif rng.random() < 0.2:
+            fields.append(("041", sf("1 ", ("a", language), ("h", "jpn"))))
+        fields += [
+            ("050", sf(" 4", ("a", f"N{rng.randint(1, 9999)}"), ("b", ".A1 2020"))),
+            ("100", sf("1 ", ("a", author + b","), ("e", "author."))),
+        ]
+        if comics:
+            fields.append(
+                (
+                    "245",
+                    sf(
+                        "10",
+                        ("a", title),
+                        ("h", "[electronic resource] /"),
+                        ("c", "LibraryPass."),
+                    ),
+                )
+            )
+        else:
+            fields.append(
+                ("245", sf("10", ("a", title + b" :"), ("b", self.text(rng, marc8, 3))))
+            )
+        fields += [
+            (
+                "264",
+                sf(
+                    " 1",
+                    ("a", rng.choice(PLACES) + " :"),
+                    ("b", rng.choice(PUBLISHERS) + ","),
+                    ("c", str(year)),
+                ),
+            ),
+            ("300", sf("  ", ("a", f"{rng.randint(40, 600)} pages :"), ("c", "28 cm"))),
+        ]
+        if not comics:
+            fields += [
+                ("336", sf("  ", ("a", "text"), ("b", "txt"), ("2", "rdacontent"))),
+                ("337", sf("  ", ("a", "unmediated"), ("b", "n"), ("2", "rdamedia"))),
+                ("338", sf("  ", ("a", "volume"), ("b", "nc"), ("2", "rdacarrier"))),
+            ]
+        fields.append(("500", sf("  ", ("a", self.text(rng, marc8, 8)))))
+        fields.append(("520", sf("  ", ("a", self.text(rng, marc8, 25)))))
+        if comics:
+            fields.append(("538", sf("  ", ("a", rng.choice(JUNK_538)))))
+        for subject in rng.sample(SUBJECTS, rng.randint(0, min(o.subjects, 10))):
+            fields.append(("650", sf(" 0", ("a", subject), ("v", "Periodicals."))))
+        if comics:
+            fields += [
+                ("655", sf(" 7", ("a", "Comics (Graphic works)"), ("2", "lcgft"))),
+                ("710", sf("2 ", ("a", "LibraryPass (Firm)"))),
+                (
+                    "856",
+                    sf(
+                        "40",
+                        (
+                            "u",
+                            "https://californiacollegeoftheartsca.librarypass.com"
+                            f"/comics/{work}",
+                        ),
+                        ("z", "Instantly available on LibraryPass"),
+                    ),
+                ),
+            ]
+        else:
+            fields.append(("700", sf("1 ", ("a", self.text(rng, marc8, 2).title()))))
+        return fields
+
+    def record(self, n: int) -> bytes:
+        o: Options = self.options
+        rng: random.Random = self.random
+        if self.works and rng.random() < o.duplicates:
+            work: int = rng.randrange(self.works)
+        else:
+            work = self.works
+            self.works += 1
+        marc8: bool = rng.random() < o.marc8
+        comics: bool = rng.random() < o.comics_plus
+        fields: list[tuple[str, bytes]] = self.bib(work, marc8, comics)
+        sf = self.subfields
+        suppressed: str = "1" if rng.random() < 0.05 else "0"
+        fields.append(("942", sf("  ", ("c", "BOOK"), ("n", suppressed))))
+        for item in range(0 if comics else rng.randint(min(1, o.items), o.items)):
+            fields.append(
+                (
+                    "952",
+                    sf(
+                        "  ",
+                        ("0", "0"),
+                        ("1", "0"),
+                        ("4", "0"),
+                        ("7", "0"),
+                        ("a", "MAIN"),
+                        ("b", "MAIN"),
+                        ("c", "STACKS"),
+                        ("d", "2024-01-01"),
+                        ("o", f"N{rng.randint(1, 9999)} .A1 2020"),
+                        ("p", f"3{n:07d}{item:03d}"),
+                        ("y", "BOOK"),
+                    ),
+                )
+            )
+        fields.append(("999", sf("  ", ("c", str(n)), ("d", str(n)))))
+        leader: bytes = b"00000nam %s2200000 i 4500" % (b" " if marc8 else b"a")
+        return as_marc(leader, fields)
+
+
+def corpus(options: Options, directory: Path = DATA) -> Path:
+    """Path of the corpus for options, generating it if it doesn't exist"""
+    path: Path = directory / options.name
+    if path.exists():
+        return path
+    directory.mkdir(parents=True, exist_ok=True)
+    generator = Generator(options)
+    partial: Path = path.with_suffix(".part")
+    with open(partial, "wb") as fh:
+        for n in range(1, options.records + 1):
+            fh.write(generator.record(n))
+    partial.rename(path)
+    return path
+
+
+# tool -> its command line for a corpus, run in a scratch directory
+TOOLS: dict[str, Callable[[Path], list[str]]] = {
+    "break": lambda file: ["break.py", "10000", str(file), "-m", "manifest.json"],
+    "comics-plus": lambda file: ["comics_plus.py", str(file), "out.mrc"],
+    "dupes": lambda file: ["dupes.py", "-k", "001", "-k", "isbn", str(file)],
+    "split-lang-codes": lambda file: [
+        "split_lang_codes.py",
+        "fix",
+        str(file),
+        "out.mrc",
+    ],
+    "summon": lambda file: ["bench.py", "summon-marc", str(file)],
+}
+
+
+class Result(NamedTuple):
+    tool: str
+    records: int
+    seconds: float
+    cpu_seconds: float
+    records_per_second: float
+    peak_rss_mb: float
+    returncode: int
+
+
+def measure(tool: str, file: Path, records: int, scratch: Path) -> Result:
+    """Run a tool on file in its own process, in the scratch directory"""
+    scratch.mkdir(parents=True, exist_ok=True)
+    script, *args = TOOLS[tool](file.resolve())
+    start: float = time.perf_counter()
+    process = subprocess.Popen(
+        [sys.executable, str(HERE / script), *args],
+        cwd=scratch,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    # wait4 gives us the resource usage of this child alone
+    _, status, usage = os.wait4(process.pid, 0)
+    seconds: float = time.perf_counter() - start
+    process.returncode = os.waitstatus_to_exitcode(status)
+    # ru_maxrss is in KB on Linux, bytes on macOS
+    rss: int = usage.ru_maxrss * (1 if sys.platform == "darwin" else 1024)
+    return Result(
+        tool,
+        records,
+        round(seconds, 3),
+        round(usage.ru_utime + usage.ru_stime, 3),
+        round(records / seconds, 1),
+        round(rss / 1024**2, 1),
+        process.returncode,
+    )
+
+
+def git_commit() -> tuple[str | None, bool]:
+    """HEAD's commit and whether the working tree has changes"""
+    try:
+        commit: str = (
+            subprocess.run(
+                ["git", "rev-parse", "HEAD"], cwd=HERE, capture_output=True, check=True
+            )
+            .stdout.decode()
+            .strip()
+        )
+        status: bytes = subprocess.run(
+            ["git", "status", "--porcelain", "--untracked-files=no"],
+            cwd=HERE,
+            capture_output=True,
+        ).stdout
+    except (OSError, subprocess.CalledProcessError):
+        return None, False
+    return commit, bool(status.strip())
+
+
+def corpus_options(function):
+    """Options shared by generate and run"""
+    for option in reversed(
+        [
+            click.option("--seed", default=1, show_default=True, help="random seed"),
+            click.option(
+                "--duplicates",
+                default=0.02,
+                show_default=True,
+                help="share of records that repeat an earlier record",
+                type=click.FloatRange(0, 1),
+            ),
+            click.option(
+                "--broken-041",
+                default=0.05,
+                show_default=True,
+                help="share of records with a 041 split_lang_codes.py fixes",
+                type=click.FloatRange(0, 1),
+            ),
+            click.option(
+                "--comics-plus",
+                default=0.1,
+                show_default=True,
+                help="share of Comics Plus ebooks (LibraryPass 856, junk 538s)",
+                type=click.FloatRange(0, 1),
+            ),
+            click.option(
+                "--marc8",
+                default=0.1,
+                show_default=True,
+                help="share of MARC-8 records",
+                type=click.FloatRange(0, 1),
+            ),
+            click.option(
+                "--items",
+                default=8,
+                show_default=True,
+                help="most 952 items per record",
+                type=click.IntRange(min=0),
+            ),
+            click.option(
+                "--subjects",
+                default=6,
+                show_default=True,
+                help="most 650 subjects per record",
+                type=click.IntRange(0, 10),
+            ),
+        ]
+    ):
+        function = option(function)
+    return function
+
+
+def counts(values: tuple[str, ...]) -> list[int]:
+    try:
+        return [parse_count(v) for v in values]
+    except ValueError as e:
+        raise click.BadParameter(str(e), param_hint="--records")
+
+
+@click.group()
+@click.help_option("-h", "--help")
+def cli():
+    """Benchmark the tools on synthetic MARC files."""
+    pass
+
+
+@cli.command()
+@click.help_option("-h", "--help")
+@click.option(
+    "-n",
+    "--records",
+    "sizes",
+    default=SIZES,
+    multiple=True,
+    show_default=True,
+    help="records in the corpus (e.g. 1000, 100k, 1M), can be repeated",
+)
+@corpus_options
+@click.option(
+    "-d",
+    "--directory",
+    default=DATA,
+    show_default=True,
+    help="where to write corpora",
+    type=click.Path(file_okay=False, path_type=Path),
+)
+def generate(sizes: tuple[str, ...], directory: Path, **options):
+    """Write synthetic MARC files (skipping ones that already exist)."""
+    for records in counts(sizes):
+        start: float = time.perf_counter()
+        path: Path = corpus(Options(records, **options), directory)
+        click.echo(f"{path} ({time.perf_counter() - start:.1f}s)")
+
+
+@cli.command()
+@click.help_option("-h", "--help")
+@click.option(
+    "-n",
+    "--records",
+    "sizes",
+    default=SIZES,
+    multiple=True,
+    show_default=True,
+    help="corpus sizes to run on (e.g. 1000, 100k, 1M), can be repeated",
+)
+@click.option(
+    "-t",
+    "--tool",
+    "tools",
+    multiple=True,
+    help="only time this tool, can be repeated (default: all)",
+    type=click.Choice(list(TOOLS)),
+)
+@corpus_options
+@click.option(
+    "-d",
+    "--directory",
+    default=DATA,
+    show_default=True,
+    help="where corpora and results are kept",
+    type=click.Path(file_okay=False, path_type=Path),
+)
+@click.option(
+    "-o",
+    "--output",
+    help="results file [default: <directory>/<commit>.json]",
+    type=click.Path(dir_okay=False, writable=True, path_type=Path),
+)
+def run(
+    sizes: tuple[str, ...],
+    tools: tuple[str, ...],
+    directory: Path,
+    output: Path | None,
+    **options,
+):
+    """Time each tool on each corpus size and save the results as JSON."""
+    commit, dirty = git_commit()
+    results: list[dict] = []
+    for records in counts(sizes):
+        file: Path = corpus(Options(records, **options), directory)
+        for tool in tools or TOOLS:
+            result: Result = measure(tool, file, records, directory / "scratch")
+            results.append(result._asdict())
+            click.echo(
+                f"{tool:<17}{records:>9} records {result.seconds:>9.2f}s "
+                f"{result.records_per_second:>10.0f} rec/s "
+                f"{result.peak_rss_mb:>8.1f} MB"
+            )
+            if result.returncode:
+                click.echo(f"Warning: {tool} exited with {result.returncode}", err=True)
+    output = (
+        output
+        or directory / f"{(commit or 'results')[:10]}{'-dirty' if dirty else ''}.json"
+    )
+    with open(output, "w") as fh:
+        json.dump(
+            {
+                "commit": commit,
+                "dirty": dirty,
+                "created": datetime.now().isoformat(timespec="seconds"),
+                "python": platform.python_version(),
+                "platform": platform.platform(),
+                "cpus": os.cpu_count(),
+                "corpus": options,
+                "results": results,
+            },
+            fh,
+            indent=2,
+        )
+    click.echo(f"Wrote results to {output}")
+
+
+@cli.command()
+@click.help_option("-h", "--help")
+@click.argument("before", type=click.File())
+@click.argument("after", type=click.File())
+def compare(before, after):
+    """Compare two results files, e.g. from before and after a change."""
+    old, new = json.load(before), json.load(after)
+    if old["corpus"] != new["corpus"]:
+        click.echo("Warning: the results are for different corpora", err=True)
+    baseline: dict[tuple[str, int], dict] = {
+        (r["tool"], r["records"]): r for r in old["results"]
+    }
+    click.echo(f"{old['commit'] or '?':.10} -> {new['commit'] or '?':.10}")
+    for r in new["results"]:
+        b: dict | None = baseline.get((r["tool"], r["records"]))
+        if not b:
+            continue
+        speed: float = r["records_per_second"] / b["records_per_second"] - 1
+        click.echo(
+            f"{r['tool']:<17}{r['records']:>9} records "
+            f"{b['records_per_second']:>10.0f} -> {r['records_per_second']:<10.0f}"
+            f"rec/s {speed:>+7.1%} "
+            f"{b['peak_rss_mb']:>8.1f} -> {r['peak_rss_mb']:<8.1f}MB"
+        )
+
+
+@cli.command("summon-marc", hidden=True)
+@click.argument("file", type=click.Path(exists=True, dir_okay=False))
+def summon_marc(file: str):
+    """summon.py on a MARC file without searching Summon"""
+    sys.path.insert(0, str(HERE))
+    import summon
+
+    summon.search = lambda params: []
+    summon.cli([file])
+
+
+if __name__ == "__main__":
+    cli()
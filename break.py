@@ -1,42 +1,134 @@
-from io import TextIOWrapper
+from datetime import datetime
+import json
 from pathlib import Path
+from typing import BinaryIO
 
 import click
-from pymarc import MARCReader, MARCWriter
+from pymarc import Record
 
+from marc_io import DigestWriter, compress, open_marc, parse_size
+from marc_reader import read_records
+from profiling import profile_option, stage
 
-def get_writer(n: int):
-    fh = open(f"records-{n + 1}.mrc", "wb")
-    writer = MARCWriter(fh)
-    return writer
+
+class Shard:
+    """An output file that tracks its record count, size, checksum and first
+    & last 001 as records are written, so we never re-read it."""
+
+    def __init__(self, n: int, compression: str | None = None):
+        self.name: str = (
+            f"records-{n + 1}.mrc{f'.{compression}' if compression else ''}"
+        )
+        # size & checksum are of the file on disk, i.e. after compression
+        self.file = DigestWriter(open(self.name, "wb"))
+        self.fh: BinaryIO = compress(self.file, compression)  # type: ignore
+        self.count: int = 0
+        self.size: int = 0
+        self.first_001: str | None = None
+        self.last_001: str | None = None
+
+    def write(self, record: Record, data: bytes) -> None:
+        self.fh.write(data)
+        self.count += 1
+        self.size += len(data)
+        id_field = record.get("001")
+        record_id: str | None = id_field.value() if id_field else None
+        if self.count == 1:
+            self.first_001 = record_id
+        self.last_001 = record_id
+
+    def _close(self) -> None:
+        if self.fh is not self.file:
+            self.fh.close()
+        self.file.close()
+
+    def discard(self) -> None:
+        self._close()
+        Path(self.name).unlink()
+
+    def close(self) -> dict:
+        self._close()
+        click.echo(f"Wrote {self.count} records to {self.name}")
+        return {
+            "file": self.name,
+            "records": self.count,
+            "bytes": self.file.size,
+            "sha256": self.file.sha256.hexdigest(),
+            "first_001": self.first_001,
+            "last_001": self.last_001,
+        }
 
 
 @click.command()
 @click.help_option("-h", "--help")
 @click.argument("N", type=click.INT)
-@click.argument("file", type=click.File("rb"), metavar="file.mrc")
-def main(n: int, file: TextIOWrapper):
+@click.argument(
+    "file", type=click.Path(exists=True, dir_okay=False), metavar="file.mrc"
+)
+@click.option(
+    "-s",
+    "--size",
+    help="also start a new file before one exceeds this uncompressed size (e.g. 500K, 20M), the manifest's bytes are the (compressed) size on disk",
+    metavar="SIZE",
+)
+@click.option(
+    "-m",
+    "--manifest",
+    default="manifest.json",
+    show_default=True,
+    help="where to write the manifest of output files",
+    type=click.Path(dir_okay=False, writable=True),
+)
+@click.option(
+    "-c",
+    "--compress",
+    "compression",
+    help="compress output files",
+    type=click.Choice(["gz", "bz2", "zst"]),
+)
+@profile_option
+def main(n: int, file: str, size: str | None, manifest: str, compression: str | None):
     """break MARC file into smaller ones of N or less records"""
-    count = 0
-    files = 0
-    reader = MARCReader(file)  # type: ignore
-    writer = get_writer(files)
-    for record in reader:
-        if record:
-            if count < n:
-                writer.write(record)
-                count += 1
-            else:
-                # close writer (also closes fh) & write to next file
-                writer.close()
-                click.echo(f"Wrote {count} records to records-{files + 1}.mrc")
-                files += 1
-                writer = get_writer(files)
-                writer.write(record)
-                count = 1
-    # final file if it has < n records
-    if count != n:
-        click.echo(f"Wrote {count} records to records-{files + 1}.mrc")
+    try:
+        max_bytes: int | None = parse_size(size) if size else None
+    except ValueError as e:
+        raise click.BadParameter(str(e), param_hint="--size")
+    files: list[dict] = []
+    shard = Shard(len(files), compression)
+    with open_marc(file) as fh:
+        for i, (_, _, record, errors) in enumerate(read_records(fh), 1):
+            for error in errors:
+                click.echo(f"Warning: record {i}: {error}", err=True)
+            if record:
+                with stage("serialize", 1):
+                    data: bytes = record.as_marc()
+                full: bool = shard.count >= n or bool(
+                    max_bytes and shard.count and shard.size + len(data) > max_bytes
+                )
+                if full:
+                    # close file & write to next one
+                    files.append(shard.close())
+                    shard = Shard(len(files), compression)
+                with stage("write", 1):
+                    shard.write(record, data)
+    # final file with the remaining records
+    if shard.count or not files:
+        files.append(shard.close())
+    else:
+        shard.discard()
+
+    with open(manifest, "w") as fh:
+        json.dump(
+            {
+                "source": file,
+                "created": datetime.now().isoformat(timespec="seconds"),
+                "records": sum(f["records"] for f in files),
+                "files": files,
+            },
+            fh,
+            indent=2,
+        )
+    click.echo(f"Wrote manifest of {len(files)} files to {manifest}")
 
 
 if __name__ == "__main__":
@@ -0,0 +1,237 @@
+"""
+A persistent SQLite index of our Koha catalog's match keys (001, normalized
+ISBN, OCLC number and 999$c biblionumber) built from a full Koha export, so
+incoming vendor files can be checked for duplicates with index lookups
+instead of re-scanning the whole catalog. See `dupes.py --against`.
+"""
+
+from datetime import datetime
+from pathlib import Path
+import sqlite3
+import tempfile
+
+import click
+
+from marc_index import SD, iter_raw
+from marc_io import open_marc
+from match_keys import KEYS, biblionumbers, make_raw, text_values
+from testing import test_option
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS records (
+    biblionumber TEXT PRIMARY KEY,
+    title TEXT,
+    updated TEXT
+);
+CREATE TABLE IF NOT EXISTS keys (
+    key TEXT NOT NULL,
+    value TEXT NOT NULL,
+    biblionumber TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS keys_lookup ON keys (key, value);
+CREATE INDEX IF NOT EXISTS keys_biblionumber ON keys (biblionumber);
+"""
+# rows are written in batches of this size
+BATCH = 5000
+
+
+def record_title(raw: bytes) -> str:
+    return " ".join(text_values(raw, "245", "a", "b")) or "[no title]"
+
+
+class CatalogIndex:
+    """Match keys of every catalog record, keyed by biblionumber"""
+
+    def __init__(self, path: str | Path):
+        self.path = Path(path)
+        self.db = sqlite3.connect(self.path)
+        self.db.executescript(SCHEMA)
+
+    def __enter__(self) -> "CatalogIndex":
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+    def close(self) -> None:
+        self.db.close()
+
+    def __len__(self) -> int:
+        return self.db.execute("SELECT count(*) FROM records").fetchone()[0]
+
+    def update(self, file: str | Path, full: bool = False) -> tuple[int, int, int]:
+        """Add or replace the records in a Koha export. With full=True the
+        export is the whole catalog, so records missing from it are removed.
+        Returns the number of (records indexed, records removed, records
+        skipped because they have no 999$c)."""
+        indexed: int = 0
+        skipped: int = 0
+        now: str = datetime.now().isoformat(timespec="seconds")
+        # biblionumber -> (records row, keys rows), a biblionumber repeated in
+        # the export keeps its last copy like it does across batches
+        batch: dict[str, tuple[tuple[str, str, str], list[tuple[str, str, str]]]] = {}
+        with self.db:
+            if full:
+                # DDL isn't rolled back, so seen can be left from a failed run
+                self.db.execute(
+                    "CREATE TEMP TABLE IF NOT EXISTS seen (biblionumber TEXT PRIMARY KEY)"
+                )
+                self.db.execute("DELETE FROM seen")
+            with open_marc(file) as fh:
+                for _, raw in iter_raw(fh):
+                    bn: list[str] = biblionumbers(raw)
+                    if not bn:
+                        skipped += 1
+                        continue
+                    batch[bn[0]] = (
+                        (bn[0], record_title(raw), now),
+                        [
+                            (name, value, bn[0])
+                            for name, key in KEYS.items()
+                            for value in key(raw)
+                        ],
+                    )
+                    indexed += 1
+                    if len(batch) >= BATCH:
+                        self._write(batch, full)
+                        batch = {}
+            self._write(batch, full)
+            removed: int = self._remove_unseen() if full else 0
+        return indexed, removed, skipped
+
+    def _write(
+        self,
+        batch: dict[str, tuple[tuple[str, str, str], list[tuple[str, str, str]]]],
+        full: bool,
+    ) -> None:
+        ids: list[tuple[str]] = [(bn,) for bn in batch]
+        self.db.executemany("DELETE FROM keys WHERE biblionumber = ?", ids)
+        self.db.executemany(
+            "INSERT OR REPLACE INTO records VALUES (?, ?, ?)",
+            (record for record, _ in batch.values()),
+        )
+        self.db.executemany(
+            "INSERT INTO keys VALUES (?, ?, ?)",
+            (row for _, keys in batch.values() for row in keys),
+        )
+        if full:
+            self.db.executemany("INSERT OR IGNORE INTO seen VALUES (?)", ids)
+
+    def _remove_unseen(self) -> int:
+        unseen = "SELECT biblionumber FROM records WHERE biblionumber NOT IN (SELECT biblionumber FROM seen)"
+        self.db.execute(f"DELETE FROM keys WHERE biblionumber IN ({unseen})")
+        removed: int = self.db.execute(
+            f"DELETE FROM records WHERE biblionumber IN ({unseen})"
+        ).rowcount
+        self.db.execute("DROP TABLE seen")
+        return removed
+
+    def lookup(self, key: str, value: str) -> list[tuple[str, str]]:
+        """(biblionumber, title) of catalog records with this key value"""
+        return self.db.execute(
+            """SELECT DISTINCT records.biblionumber, records.title FROM keys
+            JOIN records ON records.biblionumber = keys.biblionumber
+            WHERE keys.key = ? AND keys.value = ?""",
+            (key, value),
+        ).fetchall()
+
+
+class CatalogIndexTests:
+    @staticmethod
+    def make_export(path: Path, records: list[tuple[str, bytes, str]]) -> None:
+        """Write (biblionumber, 245$a, ISBN) records, no 999 if biblionumber
+        is empty"""
+        with open_marc(path, "wb") as out:
+            for bn, title, isbn in records:
+                fields: list[tuple[str, bytes]] = [
+                    ("020", b"  " + SD + b"a" + isbn.encode()),
+                    ("245", b"10" + SD + b"a" + title),
+                ]
+                if bn:
+                    fields.append(("999", b"  " + SD + b"c" + bn.encode()))
+                out.write(make_raw(fields, utf8=b"\xe2" not in title))
+
+    def test_update(self) -> None:
+        with tempfile.TemporaryDirectory() as tmp:
+            export = Path(tmp) / "export.mrc.gz"
+            self.make_export(
+                export,
+                [
+                    ("1", b"Color theory", "0306406152"),
+                    ("2", b"Old title", "9780804429573"),
+                    ("3", b"Caf\xe2e society", "9781234567897"),
+                    ("", b"No biblionumber", "9780000000002"),
+                    # repeated biblionumber, the last copy wins
+                    ("2", b"New title", "9780804429573"),
+                ],
+            )
+            with CatalogIndex(Path(tmp) / "catalog.db") as index:
+                self.assertEqual(index.update(export), (4, 0, 1))
+                self.assertEqual(len(index), 3)
+                self.assertEqual(
+                    index.lookup("isbn", "9780306406157"), [("1", "Color theory")]
+                )
+                self.assertEqual(
+                    index.lookup("isbn", "9780804429573"), [("2", "New title")]
+                )
+                # MARC-8 titles are stored decoded
+                self.assertEqual(
+                    index.lookup("biblionumber", "3"), [("3", "Café society")]
+                )
+                self.assertEqual(index.lookup("isbn", "9780000000002"), [])
+                (count,) = index.db.execute(
+                    "SELECT count(*) FROM keys WHERE biblionumber = '2'"
+                ).fetchone()
+                self.assertEqual(count, 2)  # isbn & biblionumber, once each
+
+                # a full export removes records that aren't in it anymore
+                self.make_export(export, [("1", b"Color theory", "0306406152")])
+                self.assertEqual(index.update(export, full=True), (1, 2, 0))
+                self.assertEqual(len(index), 1)
+                self.assertEqual(index.lookup("isbn", "9780804429573"), [])
+                (count,) = index.db.execute("SELECT count(*) FROM keys").fetchone()
+                self.assertEqual(count, 2)
+
+                # a full update that fails part way leaves the index as it was
+                # and doesn't break the next one
+                self.assertRaises(
+                    OSError, index.update, Path(tmp) / "missing.mrc", full=True
+                )
+                self.assertEqual(len(index), 1)
+                self.assertEqual(index.update(export, full=True), (1, 0, 0))
+
+
+@click.command()
+@click.help_option("-h", "--help")
+@click.argument("db", metavar="<catalog.db>", type=click.Path(dir_okay=False))
+@click.argument(
+    "files",
+    metavar="<export.mrc>...",
+    nargs=-1,
+    required=True,
+    type=click.Path(exists=True, dir_okay=False),
+)
+@click.option(
+    "-f",
+    "--full",
+    is_flag=True,
+    help="exports are the full catalog, remove records that aren't in them",
+)
+@test_option(CatalogIndexTests)
+def main(db: str, files: tuple[str, ...], full: bool) -> None:
+    """Add Koha export(s) to a catalog index, creating it if needed."""
+    if full and len(files) > 1:
+        raise click.UsageError("--full only works with a single export file")
+    with CatalogIndex(db) as index:
+        for file in files:
+            indexed, removed, skipped = index.update(file, full)
+            click.echo(f"Indexed {indexed} records from {file}")
+            if removed:
+                click.echo(f"Removed {removed} records no longer in the catalog")
+            if skipped:
+                click.echo(f"Skipped {skipped} records without a 999$c biblionumber")
+        click.echo(f"{db} has {len(index)} records")
+
+
+if __name__ == "__main__":
+    main()
@@ -4,20 +4,52 @@ validate and improve the records otherwise. Prints a warning for "c" corrected
 or "d" deleted records.
 """
 
+from collections import Counter
+import contextlib
+from copy import deepcopy
 from datetime import date
+from functools import cache, partial
+from hashlib import blake2b
+from importlib.metadata import version
+import io
+from pathlib import Path
+import random
+import re
+import tempfile
+from typing import Callable, NamedTuple
 
 import click
-from pydantic import ValidationError
-from pydantic_marc.models import MarcRecord
+from click.testing import CliRunner
 from pymarc import (
     Field,
     Indicators,
-    MARCReader,
-    MARCWriter,
     Record,
     Subfield,
 )
 
+from marc_runner import RecordCache, run
+from profiling import profile_option, stage
+from testing import test_option
+
+# same leader pattern and rules pydantic-marc validates against
+LEADER = re.compile(
+    r"^[0-9]{5}[acdnp][acdefgijkmoprt][abcdims][\sa][\sa]22[0-9]{5}[\s12345678uzIKLM][\sacinu][\sabc]4500$"
+)
+CONTROL_TAG = re.compile(r"00[1-9]")
+DATA_TAG = re.compile(r"0[1-9]\d|[1-9]\d\d")
+# --incremental remembers processed records here, editing this script, the
+# modules that decode & write records or upgrading pymarc changes the hash
+# which invalidates the cache
+CACHE = Path("data/comicsplus_cache.db")
+VERSION: str = blake2b(
+    b"".join(
+        (Path(__file__).parent / name).read_bytes()
+        for name in ("comics_plus.py", "marc_reader.py", "marc_runner.py")
+    )
+    + version("pymarc").encode(),
+    digest_size=8,
+).hexdigest()
+
 
 def is_delete(record) -> bool:
     """Print message if we find a deleted record."""
@@ -51,99 +83,175 @@ def proxy_856(field) -> None:
             )
 
 
-def fix_538(record: Record) -> None:
-    # Remove junk 538s
-    for field in record.get_fields("538"):
-        a = field.get("a")
-        if type(a) is str and "Mode of access: World Wide Web" in a:
-            record.remove_field(field)
-        if type(a) is str and "Requires a valid library card and registration" in a:
-            record.remove_field(field)
-        if type(a) is str and "System requirements:" in a:
-            record.remove_field(field)
-
-    # add a better-worded 538 but don't duplicate it
-    has_our_538 = False
-    msg = 'Use the "Sign Up" link to create a LibraryPass account. You must have an account to read the ebook.'
-    for field in record.get_fields("538"):
-        a = field.get("a")
-        if type(a) is str and msg in a:
-            has_our_538 = True
-    if not has_our_538:
-        record.add_ordered_field(
-            Field(
-                tag="538",
-                subfields=[
-                    Subfield(
-                        code="a",
-                        value='Use the "Sign Up" link to create a LibraryPass account. You must have an account to read the ebook.',
-                    )
-                ],
-            )
-        )
+def merge_ordered(fields: list[Field], new: list[Field]) -> list[Field]:
+    """fields with new ones inserted where record.add_ordered_field(*new)
+    would put them (before the first field with a greater or non-numeric
+    tag) but in one pass instead of one per new field"""
+    if not fields or not all(f.tag.isdigit() for f in new):
+        record = Record()
+        record.fields = list(fields)
+        record.add_ordered_field(*new)
+        return record.fields
+    pending: list[tuple[int, Field]] = sorted(
+        ((int(f.tag), f) for f in new), key=lambda p: p[0]
+    )
+    merged: list[Field] = []
+    i: int = 0
+    for n, field in enumerate(fields):
+        tag: int | None = int(field.tag) if field.tag.isdigit() else None
+        while i < len(pending) and (tag is None or tag > pending[i][0]):
+            merged.append(pending[i][1])
+            i += 1
+        if i == len(pending):
+            return merged + fields[n:]
+        merged.append(field)
+    merged.extend(f for _, f in pending[i:])
+    return merged
 
 
-def rda_ebook(record: Record) -> None:
-    """Remove 245$h GMD and add RDA 336/337/338 fields"""
-    for field in record.get_fields("245"):
-        field.delete_subfield("h")
+class Rule(NamedTuple):
+    """A transform of the fields with one of `tags`. Fields are passed to
+    `edit`, which changes them in place and returns True if the field should
+    be removed. If none of the remaining fields satisfy `has` (by default,
+    any field with the tag counts) the fields from `add` are added."""
 
-    # 33x fields
-    if not record.get("336"):
-        record.add_ordered_field(
-            Field(
-                tag="336",
-                subfields=[
-                    Subfield(code="a", value="text"),
-                    Subfield(code="b", value="txt"),
-                    Subfield(code="2", value="rdacontent"),
-                ],
-            )
-        )
-        # graphic novels have text _and_ image content
-        record.add_ordered_field(
-            Field(
-                tag="336",
-                subfields=[
-                    Subfield(code="a", value="still image"),
-                    Subfield(code="b", value="sti"),
-                    Subfield(code="2", value="rdacontent"),
-                ],
-            )
-        )
-    if not record.get("337"):
-        record.add_ordered_field(
-            Field(
-                tag="337",
-                subfields=[
-                    Subfield(code="a", value="computer"),
-                    Subfield(code="b", value="c"),
-                    Subfield(code="2", value="rdamedia"),
-                ],
-            )
-        )
-    if not record.get("338"):
-        record.add_ordered_field(
-            Field(
-                tag="338",
-                subfields=[
-                    Subfield(code="a", value="online resource"),
-                    Subfield(code="b", value="cr"),
-                    Subfield(code="2", value="rdacarrier"),
-                ],
-            )
+    tags: tuple[str, ...]
+    edit: Callable[[Field], bool | None] | None = None
+    has: Callable[[Field], bool] | None = None
+    add: Callable[[], list[Field]] | None = None
+    # only the first field with the tag, like record.get(tag)
+    first: bool = False
+    # add fields to the end of the record instead of in tag order
+    append: bool = False
+
+
+class RuleSet:
+    """Rules applied in one pass over a record's fields: each field goes to
+    the rules registered for its tag (in rule order), then the fields rules
+    add are inserted all at once."""
+
+    def __init__(self, *rules: Rule):
+        self.rules: tuple[Rule, ...] = rules
+        # tag -> (position, first, edit, has) of the rules for it
+        self.by_tag: dict[str, list[tuple]] = {}
+        for n, rule in enumerate(rules):
+            for tag in rule.tags:
+                self.by_tag.setdefault(tag, []).append(
+                    (n, rule.first, rule.edit, rule.has)
+                )
+
+    def apply(self, record: Record) -> Record:
+        found: list[bool] = [False] * len(self.rules)
+        visited: set[int] = set()
+        kept: list[Field] = []
+        for field in record.fields:
+            rules: list[tuple] | None = self.by_tag.get(field.tag)
+            if rules is None:
+                kept.append(field)
+                continue
+            for n, first, edit, has in rules:
+                if first:
+                    if n in visited:
+                        continue
+                    visited.add(n)
+                if edit and edit(field):
+                    break
+                if not found[n] and (has is None or has(field)):
+                    found[n] = True
+            else:
+                kept.append(field)
+        record.fields[:] = kept
+
+        ordered: list[Field] = []
+        appended: list[Field] = []
+        for n, rule in enumerate(self.rules):
+            if rule.add and not found[n]:
+                (appended if rule.append else ordered).extend(rule.add())
+        if ordered:
+            record.fields[:] = merge_ordered(record.fields, ordered)
+        if appended:
+            record.add_field(*appended)
+        return record
+
+
+def subfield_has(field: Field, code: str, *texts: str) -> bool:
+    value = field.get(code)
+    return type(value) is str and any(text in value for text in texts)
+
+
+# junk 538s, replaced with a better-worded one
+JUNK_538: tuple[str, ...] = (
+    "Mode of access: World Wide Web",
+    "Requires a valid library card and registration",
+    "System requirements:",
+)
+OUR_538 = 'Use the "Sign Up" link to create a LibraryPass account. You must have an account to read the ebook.'
+LIBRARYPASS: tuple[str, ...] = ("Library Pass", "LibraryPass")
+
+
+def remove_gmd(field: Field) -> None:
+    """Remove 245$h GMD"""
+    field.delete_subfield("h")
+
+
+def remove_librarypass_245(field: Field) -> None:
+    if subfield_has(field, "c", *LIBRARYPASS):
+        field.delete_subfield("c")
+
+
+def add_cca(field: Field) -> None:
+    if "CC9" not in field.get_subfields("a", "b", "c", "d"):
+        field.add_subfield(code="d", value="CC9")
+
+
+def koha_ebook(field: Field) -> None:
+    """Koha stores local information in 942, $c is default item type"""
+    if "EBOOK" not in field.get_subfields("c"):
+        field.add_subfield(code="c", value="EBOOK")
+
+
+def rda_fields(tag: str, *terms: tuple[str, str, str]) -> Callable[[], list[Field]]:
+    """RDA 33x fields, one per (term, code, source)"""
+    return lambda: [
+        Field(
+            tag=tag,
+            subfields=[
+                Subfield(code="a", value=term),
+                Subfield(code="b", value=code),
+                Subfield(code="2", value=source),
+            ],
         )
+        for term, code, source in terms
+    ]
 
 
-def lcgft(record: Record) -> None:
-    """Add LC Genre/Form Term for Graphic novels"""
-    has_gn: bool = False
-    for field in record.get_fields("655"):
-        a = field.get("a")
-        if type(a) is str and "Graphic novels" in a:
-            has_gn = True
-    if not has_gn:
-        record.add_ordered_field(
+COMICS_PLUS = RuleSet(
+    Rule(("856",), edit=proxy_856),
+    # remove junk 538s, add ours but don't duplicate it
+    Rule(
+        ("538",),
+        edit=lambda f: subfield_has(f, "a", *JUNK_538),
+        has=lambda f: subfield_has(f, "a", OUR_538),
+        add=lambda: [Field(tag="538", subfields=[Subfield(code="a", value=OUR_538)])],
+    ),
+    # RDA ebook: no GMD, add 336/337/338
+    Rule(("245",), edit=remove_gmd),
+    # graphic novels have text _and_ image content
+    Rule(
+        ("336",),
+        add=rda_fields(
+            "336",
+            ("text", "txt", "rdacontent"),
+            ("still image", "sti", "rdacontent"),
+        ),
+    ),
+    Rule(("337",), add=rda_fields("337", ("computer", "c", "rdamedia"))),
+    Rule(("338",), add=rda_fields("338", ("online resource", "cr", "rdacarrier"))),
+    # LC Genre/Form Term for Graphic novels
+    Rule(
+        ("655",),
+        has=lambda f: subfield_has(f, "a", "Graphic novels"),
+        add=lambda: [
             Field(
                 tag="655",
                 indicators=Indicators(" ", "7"),
@@ -152,29 +260,17 @@ def lcgft(record: Record) -> None:
                     Subfield(code="2", value="lcgft"),
                 ],
             )
-        )
-
-
-def remove_librarypass(record: Record) -> None:
-    """Remove references to LibraryPass in 245, 710"""
-    for field in record.get_fields("245"):
-        c = field.get("c")
-        if type(c) is str and ("Library Pass" in c or "LibraryPass" in c):
-            field.delete_subfield("c")
-    for field in record.get_fields("710"):
-        a = field.get("a")
-        if type(a) is str and ("Library Pass" in a or "LibraryPass" in a):
-            record.remove_field(field)
-
-
-def add_cca(record: Record) -> None:
-    field = record.get("040")
-    if field:
-        if "CC9" not in field.get_subfields("a", "b", "c", "d"):
-            field.add_subfield(code="d", value="CC9")
-    else:
-        # this should probably never happen but...
-        record.add_ordered_field(
+        ],
+    ),
+    # remove references to LibraryPass in 245, 710
+    Rule(("245",), edit=remove_librarypass_245),
+    Rule(("710",), edit=lambda f: subfield_has(f, "a", *LIBRARYPASS)),
+    # an 040 should always exist but...
+    Rule(
+        ("040",),
+        edit=add_cca,
+        first=True,
+        add=lambda: [
             Field(
                 tag="040",
                 subfields=[
@@ -182,50 +278,511 @@ def add_cca(record: Record) -> None:
                     Subfield(code="e", value="rda"),
                 ],
             )
-        )
-
-
-def koha_ebook(record: Record) -> None:
-    """Koha stores local information in 942, $c is default item type"""
-    field: Field | None = record.get("942")
-    if field:
-        if "EBOOK" not in field.get_subfields("c"):
-            field.add_subfield(code="c", value="EBOOK")
-    else:
-        record.add_field(
-            Field(tag="942", subfields=[Subfield(code="c", value="EBOOK")])
-        )
+        ],
+    ),
+    Rule(
+        ("942",),
+        edit=koha_ebook,
+        first=True,
+        append=True,
+        add=lambda: [Field(tag="942", subfields=[Subfield(code="c", value="EBOOK")])],
+    ),
+)
 
 
-def process_record(record: Record) -> Record:
+def process_record(record: Record, rules: RuleSet = COMICS_PLUS) -> Record:
     """Process MARC record"""
     if is_delete(record):
         return record  # don't waste work on deleted records
-    for field in record.get_fields("856"):
-        proxy_856(field)
-    fix_538(record)
-    rda_ebook(record)
-    lcgft(record)
-    remove_librarypass(record)
-    add_cca(record)
-    koha_ebook(record)
-    return record
+    return rules.apply(record)
+
+
+class MarcRules(NamedTuple):
+    fields: dict[str, dict]
+    non_repeatable: frozenset[str]
+    required: frozenset[str]
+
+
+@cache
+def marc_rules() -> MarcRules:
+    """pydantic-marc's rules, imported the first time a record is checked
+    since pydantic takes a while to load"""
+    from pydantic_marc.rules import MARC_RULES
+
+    return MarcRules(
+        MARC_RULES,
+        frozenset(tag for tag, r in MARC_RULES.items() if r.get("repeatable") is False),
+        frozenset(tag for tag, r in MARC_RULES.items() if r.get("required") is True),
+    )
+
+
+def check_control_field(field: Field) -> bool:
+    length = (marc_rules().fields.get(field.tag) or {}).get("length")
+    if not length:
+        return True
+    data: str = field.data or ""
+    if field.tag == "007":
+        length = length.get(data[:1])
+    return len(data) in length if isinstance(length, list) else len(data) == length
+
+
+def check_data_field(field: Field) -> bool:
+    if not DATA_TAG.fullmatch(field.tag):
+        return False
+    rules: dict | None = marc_rules().fields.get(field.tag)
+    if not rules:
+        return True
+    for indicator, valid in zip(field.indicators or [], (rules["ind1"], rules["ind2"])):
+        if valid is not None and indicator not in valid:
+            return False
+    codes: Counter = Counter(subfield.code for subfield in field.subfields)
+    subfield_rules: dict = rules.get("subfields") or {}
+    valid_codes: list[str] = subfield_rules.get("valid", [])
+    if valid_codes and any(code not in valid_codes for code in codes):
+        return False
+    return not any(codes[code] > 1 for code in subfield_rules.get("non_repeatable", []))
+
+
+def check_record(record: Record) -> bool:
+    """Quick structural check of leader, tags, control field lengths,
+    non-repeatable & required fields, indicators, and subfield codes using
+    pydantic-marc's rules without building its models. A record that passes
+    also passes validate_record(strict=True)."""
+    if not LEADER.match(str(record.leader)):
+        return False
+    rules: MarcRules = marc_rules()
+    tags: Counter = Counter(field.tag for field in record.fields)
+    if any(tags[tag] > 1 for tag in rules.non_repeatable) or not (
+        rules.required <= tags.keys()
+    ):
+        return False
+    if sum(n for tag, n in tags.items() if tag.startswith("1")) > 1:
+        return False
+    for field in record.fields:
+        if field.tag.startswith("00"):
+            if (
+                not CONTROL_TAG.fullmatch(field.tag)
+                or field.data is None
+                or not check_control_field(field)
+            ):
+                return False
+        elif not check_data_field(field):
+            return False
+    return True
 
 
-def validate_record(record: Record) -> bool:
+def validate_record(record: Record, strict: bool = False) -> bool:
     """Use pydantic-marc to validate basic MARC structure
     like having three-digit tags and only one 001, etc.
     Returns a result boolean but _does not throw exceptions_.
+    Unless strict, only records that fail the quicker check_record()
+    get the full (slow) validation, to report what's wrong with them.
     """
+    if not strict and check_record(record):
+        return True
+    from pydantic import ValidationError
+    from pydantic_marc.models import MarcRecord
+
     try:
         MarcRecord.model_validate(record, from_attributes=True)
     except ValidationError as e:
         print(f"Warning invalid record: {record.title}")
         print(e.errors())
         return False
+    except KeyError as e:
+        # pydantic-marc fails to build its error for some invalid fields, e.g.
+        # tag "85a" or a control field without data
+        print(f"Warning invalid record: {record.title}")
+        print(f"invalid field, pydantic-marc could not validate it ({e!r})")
+        return False
     return True
 
 
+def transform(record: Record, n: int, strict: bool = False, sample: int = 0) -> Record:
+    """Validate, process, and validate again record number n"""
+    full: bool = strict or bool(sample and n % sample == 0)
+    with stage("validate", 1):
+        validate_record(record, full)
+    new_record: Record = process_record(record)
+    with stage("validate"):
+        validate_record(new_record, full)
+    return new_record
+
+
+def make_field(tag: str, indicators: str, *subfields: tuple[str, str]) -> Field:
+    """Data field from (code, value) pairs, helper functions for tests"""
+    return Field(
+        tag=tag,
+        indicators=Indicators(*indicators),
+        subfields=[Subfield(code=c, value=v) for c, v in subfields],
+    )
+
+
+def make_record(*fields: Field, status: str = "n") -> Record:
+    """Book record with a 001, 008, 245 and the fields in the order given"""
+    record = Record(leader=f"00000{status}am a2200000 a 4500")
+    record.add_field(
+        Field(tag="001", data="cp12345"),
+        Field(tag="008", data="240101s2024    xx a    o     000 0 eng d"),
+        make_field("245", "10", ("a", "Saga.")),
+        *fields,
+    )
+    return record
+
+
+def tag_values(record: Record, *tags: str) -> list[tuple[str, str]]:
+    """(tag, text) of the record's fields with one of tags"""
+    return [(f.tag, f.value()) for f in record.get_fields(*tags)]
+
+
+class ComicsPlusTests:
+    def test_merge_ordered(self) -> None:
+        def merged(tags: list[str], new: list[str]) -> None:
+            fields: list[Field] = [
+                make_field(tag, "  ", ("a", str(n))) for n, tag in enumerate(tags)
+            ]
+            added: list[Field] = [
+                make_field(tag, "  ", ("a", f"new {n}")) for n, tag in enumerate(new)
+            ]
+            record = Record()
+            record.fields = list(fields)
+            record.add_ordered_field(*added)
+            self.assertEqual(
+                [str(f) for f in merge_ordered(fields, added)],
+                [str(f) for f in record.fields],
+                (tags, new),
+            )
+
+        merged([], ["245", "040"])
+        merged(["001", "245", "500", "856"], ["538", "040", "336", "337", "338"])
+        # equal tags go after the existing ones, in the order they're added
+        merged(["040", "336", "500"], ["336", "040", "336"])
+        merged(["001", "245"], ["999", "010"])
+        # out of order records, new fields go before the first greater tag
+        merged(["001", "500", "245", "650"], ["336", "040"])
+        merged(["856", "100", "245"], ["538", "020"])
+        # non-numeric tags in the record or among the new fields
+        merged(["001", "245", "CAT", "500"], ["538", "040"])
+        merged(["001", "245", "LOC"], ["942", "CAT", "040"])
+        merged(["CAT", "245"], ["040"])
+
+        rng = random.Random(0)
+        tags: list[str] = ["001", "008", "040", "245", "336", "500", "856", "CAT"]
+        for _ in range(500):
+            merged(
+                rng.choices(tags, k=rng.randint(0, 6)),
+                rng.choices(tags, k=rng.randint(1, 4)),
+            )
+
+    def test_proxy_856(self) -> None:
+        url = "https://californiacollegeoftheartsca.librarypass.com/comics/saga-1"
+        record: Record = process_record(
+            make_record(
+                make_field(
+                    "856", "40", ("u", url), ("z", "Instantly available on LibraryPass")
+                ),
+                make_field(
+                    "856", "42", ("u", "https://example.com/cover"), ("z", "Cover")
+                ),
+            )
+        )
+        self.assertEqual(
+            tag_values(record, "856"),
+            [
+                (
+                    "856",
+                    f"{proxy(url)} Read ebook in Comics Plus (account creation required)",
+                ),
+                ("856", "https://example.com/cover Cover"),
+            ],
+        )
+        self.assertEqual(
+            record["856"]["u"], f"https://login.proxy.cca.edu/login?url={url}"
+        )
+
+    def test_538(self) -> None:
+        record: Record = process_record(
+            make_record(
+                make_field("538", "  ", ("a", "Mode of access: World Wide Web.")),
+                make_field("538", "  ", ("a", "System requirements: web browser.")),
+                make_field("538", "  ", ("a", "Color illustrations.")),
+                make_field("650", " 0", ("a", "Comic books, strips, etc.")),
+            )
+        )
+        self.assertEqual(
+            tag_values(record, "538"),
+            [("538", "Color illustrations."), ("538", OUR_538)],
+        )
+        # ours isn't added twice
+        self.assertEqual(
+            tag_values(process_record(record), "538"), tag_values(record, "538")
+        )
+        # and goes before the 650 (the first field with a greater tag)
+        tags: list[str] = [f.tag for f in record.fields]
+        self.assertLess(tags.index("538"), tags.index("650"))
+
+    def test_245(self) -> None:
+        record = Record(leader="00000nam a2200000 a 4500")
+        record.add_field(
+            make_field(
+                "245",
+                "10",
+                ("a", "Saga."),
+                ("n", "Volume one /"),
+                ("h", "[electronic resource] /"),
+                ("c", "LibraryPass Inc."),
+            )
+        )
+        process_record(record)
+        self.assertEqual(record["245"].subfields_as_dict(), {"a": ["Saga."], "n": ["Volume one /"]})  # type: ignore
+        record = Record(leader="00000nam a2200000 a 4500")
+        record.add_field(
+            make_field("245", "10", ("a", "Saga /"), ("c", "Brian K. Vaughan."))
+        )
+        process_record(record)
+        self.assertEqual(record["245"].value(), "Saga / Brian K. Vaughan.")  # type: ignore
+
+    def test_710(self) -> None:
+        record: Record = process_record(
+            make_record(
+                make_field("710", "2 ", ("a", "LibraryPass (Firm)")),
+                make_field("710", "2 ", ("a", "Library Pass, Inc.")),
+                make_field("710", "2 ", ("a", "Image Comics.")),
+            )
+        )
+        self.assertEqual(tag_values(record, "710"), [("710", "Image Comics.")])
+
+    def test_040(self) -> None:
+        record: Record = process_record(make_record())
+        self.assertEqual(tag_values(record, "040"), [("040", "CC9 rda")])
+        self.assertEqual(
+            [f.tag for f in record.fields][:4], ["001", "008", "040", "245"]
+        )
+        # an existing 040 gets $d CC9, only the first one and only once
+        record = process_record(
+            make_record(
+                make_field("040", "  ", ("a", "DLC"), ("b", "eng"), ("c", "DLC")),
+                make_field("040", "  ", ("a", "OCLC")),
+            )
+        )
+        self.assertEqual(
+            tag_values(process_record(record), "040"),
+            [("040", "DLC eng DLC CC9"), ("040", "OCLC")],
+        )
+        record = process_record(make_record(make_field("040", "  ", ("a", "CC9"))))
+        self.assertEqual(tag_values(record, "040"), [("040", "CC9")])
+
+    def test_rda_fields(self) -> None:
+        record: Record = process_record(
+            make_record(make_field("500", "  ", ("a", "Collects issues 1-6.")))
+        )
+        self.assertEqual(
+            [f.tag for f in record.fields],
+            "001 008 040 245 336 336 337 338 500 538 655 942".split(),
+        )
+        self.assertEqual(
+            [f.subfields_as_dict() for f in record.get_fields("336", "337", "338")],
+            [
+                {"a": ["text"], "b": ["txt"], "2": ["rdacontent"]},
+                {"a": ["still image"], "b": ["sti"], "2": ["rdacontent"]},
+                {"a": ["computer"], "b": ["c"], "2": ["rdamedia"]},
+                {"a": ["online resource"], "b": ["cr"], "2": ["rdacarrier"]},
+            ],
+        )
+        self.assertEqual(tag_values(record, "655"), [("655", "Graphic novels lcgft")])
+        self.assertEqual(record["655"].indicators, Indicators(" ", "7"))  # type: ignore
+        # processing is idempotent, nothing is added twice
+        self.assertEqual(str(process_record(record)), str(record))
+        # a record with any 336 keeps it but still gets 337/338
+        record = process_record(
+            make_record(
+                make_field(
+                    "336", "  ", ("a", "text"), ("b", "txt"), ("2", "rdacontent")
+                ),
+                make_field("655", " 7", ("a", "Graphic novels."), ("2", "lcgft")),
+            )
+        )
+        self.assertEqual(
+            [f.tag for f in record.fields],
+            "001 008 040 245 336 337 338 538 655 942".split(),
+        )
+
+    def test_942(self) -> None:
+        # added at the end of the record, even after local fields
+        record: Record = process_record(
+            make_record(make_field("999", "  ", ("c", "1234")))
+        )
+        self.assertEqual(record.fields[-1].tag, "942")
+        self.assertEqual(
+            tag_values(record, "942", "999"), [("999", "1234"), ("942", "EBOOK")]
+        )
+        # an existing 942 gets $c EBOOK once, only the first one
+        record = process_record(
+            make_record(
+                make_field("942", "  ", ("n", "0")),
+                make_field("942", "  ", ("c", "BOOK")),
+            )
+        )
+        process_record(record)
+        self.assertEqual(
+            tag_values(record, "942"), [("942", "0 EBOOK"), ("942", "BOOK")]
+        )
+
+    def test_check_record(self) -> None:
+        # check_record must fail exactly the records pydantic-marc fails
+        def first(record: Record, tag: str) -> Field:
+            return record.get_fields(tag)[0]
+
+        def leader(value: str) -> Callable[[Record], None]:
+            return lambda r: setattr(r, "leader", value)
+
+        def add(*fields: Field) -> Callable[[Record], None]:
+            return lambda r: r.add_ordered_field(*deepcopy(fields))
+
+        def remove(tag: str) -> Callable[[Record], None]:
+            return lambda r: r.remove_fields(tag)
+
+        def indicators(tag: str, value: str) -> Callable[[Record], None]:
+            return lambda r: setattr(first(r, tag), "indicators", Indicators(*value))
+
+        def subfield(tag: str, code: str) -> Callable[[Record], None]:
+            return lambda r: first(r, tag).add_subfield(code, "x")
+
+        def repeat(tag: str) -> Callable[[Record], None]:
+            return lambda r: r.add_ordered_field(deepcopy(first(r, tag)))
+
+        def data(tag: str, value: str) -> Callable[[Record], None]:
+            return lambda r: setattr(first(r, tag), "data", value)
+
+        mutations: list[tuple[str, Callable[[Record], None], bool]] = [
+            ("leader too short", leader("00000nam a2200000 a 450"), False),
+            ("leader/05 status", leader("00000zam a2200000 a 4500"), False),
+            ("leader/06 type", leader("00000nxm a2200000 a 4500"), False),
+            ("leader/09 coding", leader("00000nam b2200000 a 4500"), False),
+            ("leader/20-23", leader("00000nam a2200000 a 4501"), False),
+            ("leader/17-19", leader("00000cam  2200289 i 4500"), True),
+            ("two digit tag", add(make_field("85", "40", ("u", "x"))), False),
+            ("letter in tag", add(make_field("85a", "40", ("u", "x"))), False),
+            ("000 tag", add(make_field("000", "  ", ("a", "x"))), False),
+            ("local tags", add(make_field("999", "  ", ("c", "1"))), True),
+            ("245 ind1", indicators("245", "90"), False),
+            ("245 ind2", indicators("245", "1x"), False),
+            ("245 indicators", indicators("245", "04"), True),
+            ("245 $j", subfield("245", "j"), False),
+            ("245 $a twice", subfield("245", "a"), False),
+            ("245 $n", subfield("245", "n"), True),
+            ("245 twice", repeat("245"), False),
+            ("001 twice", repeat("001"), False),
+            ("008 twice", repeat("008"), False),
+            ("856 twice", repeat("856"), True),
+            (
+                "100 and 110",
+                add(make_field("110", "2 ", ("a", "Image Comics."))),
+                False,
+            ),
+            ("no 245", remove("245"), False),
+            ("no 008", remove("008"), False),
+            ("no 001", remove("001"), True),
+            ("short 008", data("008", "240101s2024"), False),
+            ("short 007", add(Field(tag="007", data="cr")), False),
+            ("007", add(Field(tag="007", data="cr |||||||||||")), True),
+            ("006", add(Field(tag="006", data="m     o  d        ")), True),
+            ("000 control field", add(Field(tag="000", data="x")), False),
+            ("009", add(Field(tag="009", data="x")), True),
+            ("009 without data", add(make_field("009", "  ", ("a", "x"))), False),
+            ("005 without data", add(make_field("005", "  ")), False),
+        ]
+        records: list[Record] = [
+            make_record(
+                make_field("100", "1 ", ("a", "Vaughan, Brian K.")),
+                make_field("856", "40", ("u", "https://example.com/saga")),
+            ),
+            process_record(
+                make_record(
+                    make_field("020", "  ", ("a", "9781607066019")),
+                    make_field("100", "1 ", ("a", "Vaughan, Brian K.")),
+                    make_field(
+                        "650",
+                        " 0",
+                        ("a", "Space warfare"),
+                        ("v", "Comic books, strips, etc."),
+                    ),
+                    make_field("856", "40", ("u", "https://example.com/saga")),
+                    make_field("856", "42", ("u", "https://example.com/cover")),
+                )
+            ),
+        ]
+        for record in records:
+            self.assertTrue(check_record(record))
+            for name, mutate, valid in mutations:
+                mutated: Record = deepcopy(record)
+                mutate(mutated)
+                out = io.StringIO()
+                with self.subTest(name), contextlib.redirect_stdout(out):
+                    self.assertEqual(validate_record(mutated, strict=True), valid)
+                    self.assertEqual(check_record(mutated), valid)
+                # the full validation reports what's wrong instead of raising
+                self.assertEqual(bool(out.getvalue()), not valid, name)
+
+    def test_incremental(self) -> None:
+        from unittest import mock
+
+        records: list[bytes] = [
+            make_record(make_field("500", "  ", ("a", f"Volume {n}."))).as_marc()
+            for n in range(3)
+        ]
+        runner = CliRunner()
+        with tempfile.TemporaryDirectory() as tmp:
+            input, output = Path(tmp) / "in.mrc", Path(tmp) / "out.mrc"
+            input.write_bytes(b"".join(records))
+            args: list[str] = [str(input), str(output), "-i"]
+            args += ["--cache", str(Path(tmp) / "cache.db")]
+
+            def processed(*extra: str) -> tuple[str, bytes]:
+                result = runner.invoke(process_marc, args + list(extra))
+                self.assertEqual(result.exit_code, 0, result.output)
+                return result.output, output.read_bytes()
+
+            text, first = processed()
+            self.assertEqual(
+                text,
+                "Skipped 0 records unchanged since the last run\n"
+                f"Wrote 3 records to {output}\n",
+            )
+            self.assertEqual(first.count(OUR_538.encode()), 3)
+            self.assertEqual(processed()[1], b"")
+            # --reuse writes the cached output without processing records
+            with mock.patch(f"{__name__}.transform", side_effect=AssertionError):
+                text, reused = processed("--reuse")
+            self.assertEqual(reused, first)
+            self.assertEqual(
+                text,
+                "Reused cached output for 3 unchanged records\n"
+                f"Wrote 3 records to {output}\n",
+            )
+            # a new version of the script processes every record again
+            with mock.patch(f"{__name__}.VERSION", "new"):
+                text, again = processed()
+            self.assertIn("Wrote 3 records", text)
+            self.assertEqual(again, first)
+            # and entries from the old version are gone
+            self.assertIn("Wrote 3 records", processed()[0])
+            result = runner.invoke(process_marc, [str(input), str(output), "--reuse"])
+            self.assertEqual(result.exit_code, 2)
+            self.assertIn("--reuse only works with --incremental", result.output)
+
+    def test_deleted(self) -> None:
+        record: Record = make_record(
+            make_field("245", "10", ("h", "[electronic resource]")), status="d"
+        )
+        before: str = str(record)
+        out = io.StringIO()
+        with contextlib.redirect_stdout(out):
+            self.assertIs(process_record(record), record)
+        self.assertEqual(str(record), before)
+        self.assertEqual(out.getvalue(), "Warning deleted record: Saga.\n")
+
+
 @click.command(help="Process Comics Plus MARC records.")
 @click.help_option("-h", "--help")
 @click.argument(
@@ -239,16 +796,71 @@ def validate_record(record: Record) -> bool:
     metavar="<output.mrc>",
     type=click.Path(writable=True),
 )
-def process_marc(file, output) -> None:
+@click.option(
+    "-s",
+    "--strict",
+    is_flag=True,
+    help="fully validate every record with pydantic-marc (slow)",
+)
+@click.option(
+    "--sample",
+    default=0,
+    metavar="N",
+    help="fully validate every Nth record as a spot check",
+    type=click.IntRange(min=0),
+)
+@click.option(
+    "-j",
+    "--jobs",
+    default=1,
+    show_default=True,
+    help="process records with this many processes (0 for one per CPU)",
+    type=click.IntRange(min=0),
+)
+@click.option(
+    "-i",
+    "--incremental",
+    is_flag=True,
+    help="only output records that are new or changed since the last --incremental run",
+)
+@click.option(
+    "--reuse",
+    is_flag=True,
+    help="with --incremental, output unchanged records too, from the cache",
+)
+@click.option(
+    "--cache",
+    default=CACHE,
+    show_default=True,
+    help="where --incremental stores processed records",
+    type=click.Path(dir_okay=False, path_type=Path),
+)
+@profile_option
+@test_option(ComicsPlusTests)
+def process_marc(
+    file,
+    output,
+    strict: bool = False,
+    sample: int = 0,
+    jobs: int = 1,
+    incremental: bool = False,
+    reuse: bool = False,
+    cache: Path = CACHE,
+) -> None:
     """Parse MARC file and search for items."""
-    reader = MARCReader(open(file, "rb"))
-    writer = MARCWriter(open(output, "wb"))
-    for record in reader:
-        if record:
-            validate_record(record)
-            new_record = process_record(record)
-            validate_record(new_record)
-            writer.write(new_record)
+    if reuse and not incremental:
+        raise click.UsageError("--reuse only works with --incremental")
+    fn = partial(transform, strict=strict, sample=sample)
+    if not incremental:
+        run(file, output, fn, jobs)
+        return
+    with RecordCache(cache, VERSION) as store:
+        written, cached = run(file, output, fn, jobs, cache=store, reuse=reuse)
+    if reuse:
+        click.echo(f"Reused cached output for {cached} unchanged records")
+    else:
+        click.echo(f"Skipped {cached} records unchanged since the last run")
+    click.echo(f"Wrote {written} records to {output}")
 
 
 if __name__ == "__main__":
@@ -1,7 +1,399 @@
+from concurrent.futures import ProcessPoolExecutor
+import heapq
+import os
 from pathlib import Path
+import tempfile
+from typing import IO, Iterable, Iterator
 
 import click
-from pymarc import Field, MARCReader, Record
+
+from catalog_index import CatalogIndex, record_title
+from lsh import similar_groups
+from marc_columns import ColumnStore, extract
+from marc_index import RT, SD, LazyField, ScannedRecord, iter_raw
+from marc_io import file_format, open_marc, parse_size, sniff
+from match_keys import KEYS, make_raw, title_tokens
+from profiling import profile_option, stage, timed
+from testing import test_option
+
+# (matching value, offsets of the records sharing it)
+Group = tuple[str, list[int]]
+# (key name, key value, offset, position among the record's values for the
+# key) entries for external sorting
+Entry = tuple[str, str, int, int]
+# approximate memory used by one Entry on top of its value
+ENTRY_OVERHEAD = 150
+# most sorted runs to merge at once, more are merged in several rounds
+MAX_RUNS = 256
+
+
+def scan(file: Path) -> Iterator[tuple[int, bytes]]:
+    """Yield (offset, raw record) for every record"""
+    with open_marc(file) as fh:
+        yield from iter_raw(fh)
+
+
+def staff_link(biblionumber: str) -> str:
+    return f"https://library-staff.cca.edu/cgi-bin/koha/catalogue/detail.pl?biblionumber={biblionumber}"
+
+
+def describe(raw: bytes) -> str:
+    """Title and Koha staff link for a raw record"""
+    rec = ScannedRecord(raw, ("245", "999"))
+    if not rec.valid:
+        return "[unreadable record]"
+    link: str = ""
+    sysctl_field: LazyField | None = rec.get("999")
+    if sysctl_field:
+        biblionumber: str | None = sysctl_field.get("c")
+        if biblionumber:
+            link: str = staff_link(biblionumber)
+    title: str = rec.title if rec.title else "[no title]"
+    return f"{title} {link}"
+
+
+def read_at(file: Path, offsets: list[int]) -> dict[int, str]:
+    """Re-read the records at offsets (in one forward pass) and describe them"""
+    lines: dict[int, str] = {}
+    wanted: set[int] = set(offsets)
+    with open_marc(file) as fh:
+        if file_format(file) != "marc":
+            # MARCXML & MARC-in-JSON "offsets" are record positions, read up to them
+            for offset, raw in iter_raw(fh):
+                if len(lines) == len(wanted):
+                    break
+                if offset in wanted:
+                    lines[offset] = describe(raw)
+            return lines
+        for offset in sorted(wanted):
+            fh.seek(offset)
+            for _, raw in iter_raw(fh):
+                lines[offset] = describe(raw)
+                break
+    return lines
+
+
+def offset_duplicates(
+    file: Path, keys: list[str], threshold: float
+) -> dict[str, tuple[list[Group], int]]:
+    """One pass keeping only the first offset per key value (plus offsets of
+    any repeats). Returns {key: (groups of duplicates, number of unique values)}
+    """
+    first: dict[str, dict[str, int]] = {k: {} for k in keys if k in KEYS}
+    repeats: dict[str, dict[str, list[int]]] = {k: {} for k in first}
+    offsets: list[int] = []
+    tokens: list[set[str]] = []
+    for offset, raw in timed("read", scan(file)):
+        with stage("keys", 1):
+            for key, index in first.items():
+                for value in KEYS[key](raw):
+                    if value in index:
+                        repeats[key].setdefault(value, [index[value]]).append(offset)
+                    else:
+                        index[value] = offset
+        if "title" in keys:
+            with stage("titles", 1):
+                offsets.append(offset)
+                tokens.append(title_tokens(raw))
+
+    # order groups by when their value was first seen, like the file
+    results: dict[str, tuple[list[Group], int]] = {
+        key: (
+            [(v, repeats[key][v]) for v in first[key] if v in repeats[key]],
+            len(first[key]),
+        )
+        for key in first
+    }
+    if "title" in keys:
+        with stage("match", len(tokens)):
+            groups: list[list[int]] = similar_groups(tokens, threshold)
+        results["title"] = (
+            [(str(n + 1), [offsets[i] for i in g]) for n, g in enumerate(groups)],
+            sum(1 for t in tokens if t),
+        )
+    return results
+
+
+def next_record_start(file: Path, pos: int) -> int:
+    """Position of the first record starting after byte pos"""
+    with open(file, "rb") as fh:
+        fh.seek(pos)
+        while block := fh.read(65536):
+            end: int = block.find(RT)
+            if end != -1:
+                return pos + end + 1
+            pos += len(block)
+    return pos
+
+
+def chunks(file: Path, jobs: int) -> list[tuple[int, int]]:
+    """Split a file into about jobs (start, end) byte ranges on record
+    boundaries"""
+    size: int = os.path.getsize(file)
+    starts: list[int] = sorted(
+        {0} | {next_record_start(file, size * n // jobs) for n in range(1, jobs)}
+    )
+    return [(s, e) for s, e in zip(starts, starts[1:] + [size]) if s < e]
+
+
+def scan_chunk(
+    file: Path, start: int, end: int, keys: list[str]
+) -> tuple[dict[str, dict[str, list[int]]], list[tuple[int, set[str]]]]:
+    """Key values -> offsets (and title tokens) for the records in one chunk"""
+    found: dict[str, dict[str, list[int]]] = {k: {} for k in keys if k in KEYS}
+    tokens: list[tuple[int, set[str]]] = []
+    with open(file, "rb") as fh:
+        fh.seek(start)
+        for offset, raw in iter_raw(fh):
+            offset += start
+            if offset >= end:
+                break
+            for key, index in found.items():
+                for value in KEYS[key](raw):
+                    index.setdefault(value, []).append(offset)
+            if "title" in keys:
+                tokens.append((offset, title_tokens(raw)))
+    return found, tokens
+
+
+def parallel_duplicates(
+    file: Path, keys: list[str], threshold: float, jobs: int
+) -> dict[str, tuple[list[Group], int]]:
+    """Same as offset_duplicates() but chunks of the file are scanned in a
+    process pool and their key -> offsets maps merged in file order"""
+    merged: dict[str, dict[str, list[int]]] = {k: {} for k in keys if k in KEYS}
+    offsets: list[int] = []
+    tokens: list[set[str]] = []
+    bounds: list[tuple[int, int]] = chunks(file, jobs)
+    with ProcessPoolExecutor(jobs) as pool:
+        for found, chunk_tokens in pool.map(
+            scan_chunk,
+            [file] * len(bounds),
+            [s for s, _ in bounds],
+            [e for _, e in bounds],
+            [keys] * len(bounds),
+        ):
+            for key, index in found.items():
+                for value, value_offsets in index.items():
+                    merged[key].setdefault(value, []).extend(value_offsets)
+            for offset, t in chunk_tokens:
+                offsets.append(offset)
+                tokens.append(t)
+
+    results: dict[str, tuple[list[Group], int]] = {
+        key: (
+            sorted(
+                ((v, o) for v, o in merged[key].items() if len(o) > 1),
+                key=lambda g: g[1][0],
+            ),
+            len(merged[key]),
+        )
+        for key in merged
+    }
+    if "title" in keys:
+        with stage("match", len(tokens)):
+            groups: list[list[int]] = similar_groups(tokens, threshold)
+        results["title"] = (
+            [(str(n + 1), [offsets[i] for i in g]) for n, g in enumerate(groups)],
+            sum(1 for t in tokens if t),
+        )
+    return results
+
+
+def counted_duplicates(
+    file: Path, keys: list[str]
+) -> dict[str, tuple[list[Group], int]]:
+    """Two passes: count each key value, then collect offsets for repeated
+    ones only"""
+    counts: dict[str, dict[str, int]] = {k: {} for k in keys}
+    for _, raw in scan(file):
+        for key, count in counts.items():
+            for value in KEYS[key](raw):
+                count[value] = count.get(value, 0) + 1
+    groups: dict[str, dict[str, list[int]]] = {k: {} for k in keys}
+    for offset, raw in scan(file):
+        for key, count in counts.items():
+            for value in KEYS[key](raw):
+                if count[value] > 1:
+                    groups[key].setdefault(value, []).append(offset)
+    return {key: (list(groups[key].items()), len(counts[key])) for key in keys}
+
+
+def catalog_matches(file: Path, keys: list[str], db: Path) -> tuple[int, int]:
+    """Print records in file whose keys are already in the catalog index.
+    Returns (records with matches, total records)."""
+    matched: int = 0
+    total: int = 0
+    with CatalogIndex(db) as catalog:
+        for _, raw in scan(file):
+            total += 1
+            found: bool = False
+            for key in keys:
+                for value in KEYS[key](raw):
+                    hits: list[tuple[str, str]] = catalog.lookup(key, value)
+                    if hits:
+                        found = True
+                        click.echo(
+                            f"{record_title(raw)} matches catalog {key} {value}:"
+                        )
+                    for biblionumber, title in hits:
+                        click.echo(f"  {title} {staff_link(biblionumber)}")
+            matched += found
+    return matched, total
+
+
+def write_run(entries: Iterable[Entry], directory: str) -> str:
+    """Write sorted entries to a temporary run file, returns its path"""
+    with tempfile.NamedTemporaryFile(
+        "w", dir=directory, suffix=".run", delete=False, encoding="utf-8"
+    ) as fh:
+        for key, value, offset, n in entries:
+            fh.write(f"{key}\t{value}\t{offset}\t{n}\n")
+    return fh.name
+
+
+def read_run(fh: IO[str]) -> Iterator[Entry]:
+    for line in fh:
+        key, value, offset, n = line.rstrip("\n").split("\t")
+        yield key, value, int(offset), int(n)
+
+
+def merge_runs(runs: list[str]) -> Iterator[Entry]:
+    """k-way merge of sorted run files"""
+    handles: list[IO[str]] = [open(run, encoding="utf-8") for run in runs]
+    try:
+        yield from heapq.merge(*(read_run(fh) for fh in handles))
+    finally:
+        for fh in handles:
+            fh.close()
+
+
+def external_duplicates(
+    file: Path, keys: list[str], memory: int
+) -> dict[str, tuple[list[Group], int]]:
+    """Find duplicates with an external sort: (key, value, offset) entries are
+    sorted in memory-sized runs on disk, k-way merged, and adjacent equal
+    values reported. Memory stays around the budget whatever the file size."""
+    # (value, offsets, position of the value in its first record)
+    groups: dict[str, list[tuple[str, list[int], int]]] = {k: [] for k in keys}
+    unique: dict[str, int] = {k: 0 for k in keys}
+    with tempfile.TemporaryDirectory(prefix="dupes-") as tmp:
+        runs: list[str] = []
+        buffer: list[Entry] = []
+        used: int = 0
+        for offset, raw in scan(file):
+            for key in keys:
+                for n, value in enumerate(KEYS[key](raw)):
+                    # tabs & newlines are the run file's delimiters
+                    value = value.replace("\t", " ").replace("\n", " ")
+                    buffer.append((key, value, offset, n))
+                    used += ENTRY_OVERHEAD + len(value)
+            if used >= memory:
+                buffer.sort()
+                runs.append(write_run(buffer, tmp))
+                buffer, used = [], 0
+        buffer.sort()
+        runs.append(write_run(buffer, tmp))
+        del buffer
+        while len(runs) > MAX_RUNS:
+            merged: str = write_run(merge_runs(runs[:MAX_RUNS]), tmp)
+            runs = runs[MAX_RUNS:] + [merged]
+
+        current: tuple[str, str] | None = None
+        offsets: list[int] = []
+        first: int = 0
+        for key, value, offset, n in merge_runs(runs):
+            if (key, value) != current:
+                if current and len(offsets) > 1:
+                    groups[current[0]].append((current[1], offsets, first))
+                current, offsets, first = (key, value), [], n
+                unique[key] += 1
+            offsets.append(offset)
+        if current and len(offsets) > 1:
+            groups[current[0]].append((current[1], offsets, first))
+
+    # the merge is in value order, report groups in the order their values
+    # were first seen like the others
+    return {
+        key: (
+            [(v, o) for v, o, _ in sorted(groups[key], key=lambda g: (g[1][0], g[2]))],
+            unique[key],
+        )
+        for key in keys
+    }
+
+
+class DupesTests:
+    @staticmethod
+    def make_file(path: Path) -> list[int]:
+        """20 records with a repeated 001, ISBNs and OCLC number, the first
+        record has two ISBNs that are both repeated. Returns the offsets."""
+        raws: list[bytes] = []
+        for i in range(20):
+            control: str = {2: "r0", 19: "r3"}.get(i, f"r{i}")
+            isbns: list[str] = {
+                0: ["080442957x", "0306406152 (pbk.)"],
+                1: ["9780306406157"],
+                2: ["978-0-8044-2957-3"],
+            }.get(i, [f"9780000000{i:03d}"])
+            fields: list[tuple[str, bytes]] = [("001", control.encode())]
+            fields += [("020", b"  " + SD + b"a" + isbn.encode()) for isbn in isbns]
+            if i in (0, 7):
+                fields.append(("035", b"  " + SD + b"a(OCoLC)ocm00012345"))
+            fields.append(("245", b"10" + SD + f"aTitle number {i}".encode()))
+            raws.append(make_raw(fields))
+        path.write_bytes(b"".join(raws))
+        with open(path, "rb") as fh:
+            return [offset for offset, _ in iter_raw(fh)]
+
+    def test_modes_agree(self) -> None:
+        from unittest import mock
+
+        keys: list[str] = ["001", "isbn", "oclc"]
+        with tempfile.TemporaryDirectory() as tmp:
+            file = Path(tmp) / "records.mrc"
+            offsets: list[int] = self.make_file(file)
+            expected = offset_duplicates(file, keys, 0.8)
+            self.assertEqual(
+                expected,
+                {
+                    "001": (
+                        [
+                            ("r0", [offsets[0], offsets[2]]),
+                            ("r3", [offsets[3], offsets[19]]),
+                        ],
+                        18,
+                    ),
+                    # in the order they were first seen, not the order they're
+                    # repeated in or sort in
+                    "isbn": (
+                        [
+                            ("9780804429573", [offsets[0], offsets[2]]),
+                            ("9780306406157", [offsets[0], offsets[1]]),
+                        ],
+                        19,
+                    ),
+                    "oclc": ([("12345", [offsets[0], offsets[7]])], 1),
+                },
+            )
+            # a budget of 1 byte writes a run per record, with at most 3 runs
+            # merged at once they're merged in several rounds
+            merges = mock.Mock(wraps=merge_runs)
+            with (
+                mock.patch(f"{__name__}.MAX_RUNS", 3),
+                mock.patch(f"{__name__}.merge_runs", merges),
+            ):
+                self.assertEqual(external_duplicates(file, keys, 1), expected)
+            self.assertGreater(merges.call_count, 3)
+            self.assertEqual(external_duplicates(file, keys, 1 << 20), expected)
+            self.assertEqual(counted_duplicates(file, keys), expected)
+            self.assertEqual(
+                parallel_duplicates(file, [*keys, "title"], 0.8, 2),
+                offset_duplicates(file, [*keys, "title"], 0.8),
+            )
+            extract(file, Path(tmp) / "records.db")
+            with ColumnStore(Path(tmp) / "records.db") as store:
+                self.assertEqual({key: store.duplicates(key) for key in keys}, expected)
 
 
 @click.command()
@@ -11,37 +403,124 @@ from pymarc import Field, MARCReader, Record
     metavar="<input.mrc>",
     type=click.Path(exists=True, readable=True),
 )
-def print_duplicates(file: Path):
-    """Print records with duplicate 001s from a MARC file."""
-    count: int = 0
-    records: dict[str, list[Record]] = {}
-    reader = MARCReader(open(file, "rb"))
+@click.option(
+    "-k",
+    "--key",
+    "keys",
+    default=["001"],
+    multiple=True,
+    show_default=True,
+    help="match on 001, normalized ISBN, OCLC number (035), Koha biblionumber (999$c), or similar title/author/date, can be repeated",
+    type=click.Choice([*KEYS, "title"]),
+)
+@click.option(
+    "-t",
+    "--threshold",
+    default=0.8,
+    show_default=True,
+    help="title similarity (0-1) for --key title",
+    type=click.FloatRange(0, 1),
+)
+@click.option(
+    "-a",
+    "--against",
+    help="check records against a catalog index (see catalog_index.py) instead of each other",
+    metavar="<catalog.db>",
+    type=click.Path(exists=True, dir_okay=False),
+)
+@click.option(
+    "-j",
+    "--jobs",
+    default=1,
+    show_default=True,
+    help="scan with this many processes (0 for one per CPU), uncompressed binary MARC only",
+    type=click.IntRange(min=0),
+)
+@click.option(
+    "-m",
+    "--memory",
+    help="find duplicates with an on-disk external sort using about this much memory (e.g. 500M)",
+    metavar="SIZE",
+)
+@click.option(
+    "--two-pass",
+    is_flag=True,
+    help="count key values first then re-scan, uses the least memory",
+)
+@click.option(
+    "-c",
+    "--columns",
+    help="read key values from a column store of the file (see marc_columns.py) instead of scanning it",
+    metavar="<file.db>",
+    type=click.Path(exists=True, dir_okay=False),
+)
+@profile_option
+@test_option(DupesTests)
+def print_duplicates(
+    file: Path,
+    keys: tuple[str, ...],
+    threshold: float,
+    against: Path | None,
+    jobs: int,
+    memory: str | None,
+    two_pass: bool,
+    columns: Path | None,
+):
+    """Print records with duplicate 001s (or other keys) from a MARC file."""
+    if (two_pass or against or memory or columns) and "title" in keys:
+        raise click.UsageError("title matching only works within a file")
+    keys = tuple(dict.fromkeys(keys))
+    if against:
+        matched, total = catalog_matches(file, list(keys), against)
+        click.echo(f"{matched} of {total} records in {file} are already in {against}")
+        return
     click.echo(
         f"Scanning {file} for duplicates, this takes time depending on the file size."
     )
+    jobs = jobs or os.cpu_count() or 1
+    with open(file, "rb") as fh:
+        compressed: bool = sniff(fh) is not None  # type: ignore
+    # workers seek to byte offsets, which MARCXML & MARC-in-JSON don't have
+    seekable: bool = not compressed and file_format(file) == "marc"
+    # the default strategy times its own stages, the others are timed whole
+    with stage("find"):
+        if columns:
+            with ColumnStore(columns) as store:
+                if not store.is_current(file):
+                    raise click.UsageError(
+                        f"{columns} wasn't extracted from {file} as it is now, re-run marc_columns.py extract"
+                    )
+                results = {key: store.duplicates(key) for key in keys}
+        elif memory:
+            try:
+                budget: int = parse_size(memory)
+            except ValueError as e:
+                raise click.BadParameter(str(e), param_hint="--memory")
+            results = external_duplicates(file, list(keys), budget)
+        elif two_pass:
+            results = counted_duplicates(file, list(keys))
+        elif jobs > 1 and seekable:
+            results = parallel_duplicates(file, list(keys), threshold, jobs)
+        else:
+            results = offset_duplicates(file, list(keys), threshold)
 
-    for record in reader:
-        if record:
-            id_field: list[Field] = record.get_fields("001")
-            if id_field and len(id_field) == 1:
-                record_id: str | None = id_field[0].value()
-                if record_id:
-                    records.setdefault(record_id, []).append(record)
-
-    for record_id, recs in records.items():
-        if len(recs) > 1:
-            count += 1
-            for rec in recs:
-                link: str = ""
-                sysctl_field: Field | None = rec.get("999")
-                if sysctl_field:
-                    biblionumber: str | None = sysctl_field.get("c")
-                    if biblionumber:
-                        link: str = f"https://library-staff.cca.edu/cgi-bin/koha/catalogue/detail.pl?biblionumber={biblionumber}"
-                title: str = rec.title if rec.title else "[no title]"
-                click.echo(f"{title} {link}")
-
-    click.echo(f"{count} duplicates out of {len(records)} unique 001s")
+    # only the duplicates are decoded, by seeking back to them
+    offsets: list[int] = [
+        o for groups, _ in results.values() for _, g in groups for o in g
+    ]
+    with stage("describe", len(set(offsets))):
+        lines: dict[int, str] = read_at(file, offsets)
+    with stage("print"):
+        for key, (groups, unique) in results.items():
+            for value, group in groups:
+                # keep the original output format when we only look at 001s
+                if keys != ("001",):
+                    click.echo(f"{key} {value}:")
+                for offset in group:
+                    click.echo(lines[offset])
+    for key, (groups, unique) in results.items():
+        label: str = "titled records" if key == "title" else f"unique {key}s"
+        click.echo(f"{len(groups)} duplicates out of {unique} {label}")
 
 
 if __name__ == "__main__":
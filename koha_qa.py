@@ -0,0 +1,153 @@
+"""
+One entry point for all the scripts: `python koha_qa.py <command> ...` runs
+the same thing as `python <command>.py ...`.
+
+Subcommands are only imported when they run, so `--help` and quick commands
+like `break` don't pay for loading pydantic, pysftp or requests. The test
+command checks that stays true.
+"""
+
+from importlib import import_module
+from pathlib import Path
+import runpy
+import subprocess
+import sys
+
+import click
+
+from testing import test_command
+
+HERE: Path = Path(__file__).resolve().parent
+
+# command -> (module:attribute of its click command, help)
+COMMANDS: dict[str, tuple[str, str]] = {
+    "bench": ("bench:cli", "Benchmark the tools on synthetic MARC files."),
+    "break": ("break:main", "Break a MARC file into smaller ones."),
+    "catalog-index": ("catalog_index:main", "Add Koha export(s) to a catalog index."),
+    "comics-plus": ("comics_plus:process_marc", "Process Comics Plus MARC records."),
+    "dupes": ("dupes:print_duplicates", "Print records with duplicate keys."),
+    "marc-columns": ("marc_columns:cli", "Extract MARC files to a column store."),
+    "marc-index": ("marc_index:cli", "Build or query .idx offset indexes."),
+    "split-lang-codes": ("split_lang_codes:cli", "Split 041 language codes."),
+    "summon-update": (
+        "summon_update:put_file",
+        "Upload files to Summon's SFTP server.",
+    ),
+}
+# modules no command should import until it needs them
+HEAVY: tuple[str, ...] = (
+    "httpx",
+    "paramiko",
+    "pydantic",
+    "pydantic_marc",
+    "pysftp",
+    "requests",
+    "unittest",
+)
+# modules `koha-qa --help` shouldn't need at all
+PARSING: tuple[str, ...] = ("pymarc", "dotenv", "sqlite3")
+
+
+class LazyGroup(click.Group):
+    """Group that imports a subcommand's module when it's invoked. Help for
+    the group uses the help text in COMMANDS so it doesn't import anything."""
+
+    def list_commands(self, ctx: click.Context) -> list[str]:
+        return sorted([*super().list_commands(ctx), *COMMANDS])
+
+    def get_command(self, ctx: click.Context, name: str) -> click.Command | None:
+        if name not in COMMANDS:
+            return super().get_command(ctx, name)
+        module, attribute = COMMANDS[name][0].split(":")
+        # break is a keyword so it can only be imported by name
+        command: click.Command = getattr(import_module(module), attribute)
+        return command
+
+    def format_commands(self, ctx: click.Context, formatter) -> None:
+        rows: list[tuple[str, str]] = [
+            (name, help) for name, (_, help) in COMMANDS.items()
+        ]
+        rows.extend(
+            (name, command.get_short_help_str())
+            for name, command in self.commands.items()
+            if not command.hidden
+        )
+        with formatter.section("Commands"):
+            formatter.write_dl(sorted(rows))
+
+
+@click.group(cls=LazyGroup)
+@click.help_option("-h", "--help")
+def cli():
+    """Koha & Summon MARC record tools."""
+    pass
+
+
+# summon.py and linkcheck.py aren't click commands, pass their arguments on
+PASSTHROUGH: dict = {
+    "ignore_unknown_options": True,
+    "allow_extra_args": True,
+    "help_option_names": [],
+}
+
+
+@cli.command(context_settings=PASSTHROUGH)
+@click.argument("args", nargs=-1, type=click.UNPROCESSED)
+def summon(args: tuple[str, ...]) -> None:
+    """Check if a title or MARC records are in Summon."""
+    from summon import cli as summon_cli
+
+    summon_cli(list(args), prog="koha-qa summon")
+
+
+@cli.command(context_settings=PASSTHROUGH)
+@click.argument("args", nargs=-1, type=click.UNPROCESSED)
+def linkcheck(args: tuple[str, ...]) -> None:
+    """Check the URLs in Koha 856$u fields."""
+    sys.argv = ["linkcheck", *args]
+    runpy.run_path(str(HERE / "linkcheck" / "linkcheck.py"), run_name="__main__")
+
+
+def imported(*args: str) -> set[str]:
+    """Modules imported by running koha_qa.py with args"""
+    process = subprocess.run(
+        [sys.executable, "-X", "importtime", __file__, *args],
+        capture_output=True,
+        text=True,
+        cwd=HERE,
+    )
+    if process.returncode:
+        raise RuntimeError(process.stderr[-1000:])
+    # stderr lines look like "import time:  self | cumulative | module"
+    return {
+        line.split("|")[-1].strip()
+        for line in process.stderr.splitlines()
+        if line.startswith("import time:")
+    }
+
+
+class StartupTests:
+    def assert_not_imported(self, modules: set[str], names: tuple[str, ...]) -> None:
+        loaded: list[str] = [m for m in modules if m.split(".")[0] in names]
+        assert not loaded, f"imported {', '.join(sorted(loaded))}"
+
+    def test_help(self) -> None:
+        self.assert_not_imported(imported("--help"), HEAVY + PARSING)
+
+    def test_break(self) -> None:
+        self.assert_not_imported(imported("break", "--help"), HEAVY)
+
+    def test_command_help(self) -> None:
+        for name in ("comics-plus", "dupes", "split-lang-codes"):
+            self.assert_not_imported(imported(name, "--help"), HEAVY)
+
+
+cli.add_command(
+    test_command(
+        StartupTests, help="Check that commands start without importing slow modules."
+    )
+)
+
+
+if __name__ == "__main__":
+    cli(prog_name="koha-qa")
@@ -0,0 +1,571 @@
+"""
+MARC language code normalization: valid ISO 639-2/B codes, deprecated codes
+we still see in our records, and memoized splitting of concatenated codes
+like "engjpn" from 041 $a. The same few concatenated strings repeat across
+thousands of records so each distinct one is only worked out once.
+"""
+
+from functools import lru_cache
+from typing import Iterable, NamedTuple
+
+# ISO 639-2 language codes
+# https://www.loc.gov/standards/iso639-2/php/code_list.php
+CODES: frozenset[str] = frozenset(
+    [
+        "aar",
+        "abk",
+        "ace",
+        "ach",
+        "ada",
+        "ady",
+        "afa",
+        "afh",
+        "afr",
+        "ain",
+        "aka",
+        "akk",
+        "alb",
+        "ale",
+        "alg",
+        "alt",
+        "amh",
+        "ang",
+        "anp",
+        "apa",
+        "ara",
+        "arc",
+        "arg",
+        "arm",
+        "arn",
+        "arp",
+        "art",
+        "arw",
+        "asm",
+        "ast",
+        "ath",
+        "aus",
+        "ava",
+        "ave",
+        "awa",
+        "aym",
+        "aze",
+        "bad",
+        "bai",
+        "bak",
+        "bal",
+        "bam",
+        "ban",
+        "baq",
+        "bas",
+        "bat",
+        "bej",
+        "bel",
+        "bem",
+        "ben",
+        "ber",
+        "bho",
+        "bih",
+        "bik",
+        "bin",
+        "bis",
+        "bla",
+        "bnt",
+        "tib",
+        "bos",
+        "bra",
+        "bre",
+        "btk",
+        "bua",
+        "bug",
+        "bul",
+        "bur",
+        "byn",
+        "cad",
+        "cai",
+        "car",
+        "cat",
+        "cau",
+        "ceb",
+        "cel",
+        "cze",
+        "cha",
+        "chb",
+        "che",
+        "chg",
+        "chi",
+        "chk",
+        "chm",
+        "chn",
+        "cho",
+        "chp",
+        "chr",
+        "chu",
+        "chv",
+        "chy",
+        "cmc",
+        "cnr",
+        "cop",
+        "cor",
+        "cos",
+        "cpe",
+        "cpf",
+        "cpp",
+        "cre",
+        "crh",
+        "crp",
+        "csb",
+        "cus",
+        "wel",
+        "dak",
+        "dan",
+        "dar",
+        "day",
+        "del",
+        "den",
+        "ger",
+        "dgr",
+        "din",
+        "div",
+        "doi",
+        "dra",
+        "dsb",
+        "dua",
+        "dum",
+        "dut",
+        "dyu",
+        "dzo",
+        "efi",
+        "egy",
+        "eka",
+        "gre",
+        "elx",
+        "eng",
+        "enm",
+        "epo",
+        "est",
+        "ewe",
+        "ewo",
+        "fan",
+        "fao",
+        "per",
+        "fat",
+        "fij",
+        "fil",
+        "fin",
+        "fiu",
+        "fon",
+        "fre",
+        "frm",
+        "fro",
+        "frr",
+        "frs",
+        "fry",
+        "ful",
+        "fur",
+        "gaa",
+        "gay",
+        "gba",
+        "gem",
+        "geo",
+        "gez",
+        "gil",
+        "gla",
+        "gle",
+        "glg",
+        "glv",
+        "gmh",
+        "goh",
+        "gon",
+        "gor",
+        "got",
+        "grb",
+        "grc",
+        "grn",
+        "gsw",
+        "guj",
+        "gwi",
+        "hai",
+        "hat",
+        "hau",
+        "haw",
+        "heb",
+        "her",
+        "hil",
+        "him",
+        "hin",
+        "hit",
+        "hmn",
+        "hmo",
+        "hrv",
+        "hsb",
+        "hun",
+        "hup",
+        "iba",
+        "ibo",
+        "ice",
+        "ido",
+        "iii",
+        "ijo",
+        "iku",
+        "ile",
+        "ilo",
+        "ina",
+        "inc",
+        "ind",
+        "ine",
+        "inh",
+        "ipk",
+        "ira",
+        "iro",
+        "ita",
+        "jav",
+        "jbo",
+        "jpn",
+        "jpr",
+        "jrb",
+        "kaa",
+        "kab",
+        "kac",
+        "kal",
+        "kam",
+        "kan",
+        "kar",
+        "kas",
+        "kau",
+        "kaw",
+        "kaz",
+        "kbd",
+        "kha",
+        "khi",
+        "khm",
+        "kho",
+        "kik",
+        "kin",
+        "kir",
+        "kmb",
+        "kok",
+        "kom",
+        "kon",
+        "kor",
+        "kos",
+        "kpe",
+        "krc",
+        "krl",
+        "kro",
+        "kru",
+        "kua",
+        "kum",
+        "kur",
+        "kut",
+        "lad",
+        "lah",
+        "lam",
+        "lao",
+        "lat",
+        "lav",
+        "lez",
+        "lim",
+        "lin",
+        "lit",
+        "lol",
+        "loz",
+        "ltz",
+        "lua",
+        "lub",
+        "lug",
+        "lui",
+        "lun",
+        "luo",
+        "lus",
+        "mac",
+        "mad",
+        "mag",
+        "mah",
+        "mai",
+        "mak",
+        "mal",
+        "man",
+        "mao",
+        "map",
+        "mar",
+        "mas",
+        "may",
+        "mdf",
+        "mdr",
+        "men",
+        "mga",
+        "mic",
+        "min",
+        "mis",
+        "mkh",
+        "mlg",
+        "mlt",
+        "mnc",
+        "mni",
+        "mno",
+        "moh",
+        "mon",
+        "mos",
+        "mul",
+        "mun",
+        "mus",
+        "mwl",
+        "mwr",
+        "myn",
+        "myv",
+        "nah",
+        "nai",
+        "nap",
+        "nau",
+        "nav",
+        "nbl",
+        "nde",
+        "ndo",
+        "nds",
+        "nep",
+        "new",
+        "nia",
+        "nic",
+        "niu",
+        "nno",
+        "nob",
+        "nog",
+        "non",
+        "nor",
+        "nqo",
+        "nso",
+        "nub",
+        "nwc",
+        "nya",
+        "nym",
+        "nyn",
+        "nyo",
+        "nzi",
+        "oci",
+        "oji",
+        "ori",
+        "orm",
+        "osa",
+        "oss",
+        "ota",
+        "oto",
+        "paa",
+        "pag",
+        "pal",
+        "pam",
+        "pan",
+        "pap",
+        "pau",
+        "peo",
+        "phi",
+        "phn",
+        "pli",
+        "pol",
+        "pon",
+        "por",
+        "pra",
+        "pro",
+        "pus",
+        "qaa",
+        "que",
+        "raj",
+        "rap",
+        "rar",
+        "roa",
+        "roh",
+        "rom",
+        "rum",
+        "run",
+        "rup",
+        "rus",
+        "sad",
+        "sag",
+        "sah",
+        "sai",
+        "sal",
+        "sam",
+        "san",
+        "sas",
+        "sat",
+        "scn",
+        "sco",
+        "sel",
+        "sem",
+        "sga",
+        "sgn",
+        "shn",
+        "sid",
+        "sin",
+        "sio",
+        "sit",
+        "sla",
+        "slo",
+        "slv",
+        "sma",
+        "sme",
+        "smi",
+        "smj",
+        "smn",
+        "smo",
+        "sms",
+        "sna",
+        "snd",
+        "snk",
+        "sog",
+        "som",
+        "son",
+        "sot",
+        "spa",
+        "srd",
+        "srn",
+        "srp",
+        "srr",
+        "ssa",
+        "ssw",
+        "suk",
+        "sun",
+        "sus",
+        "sux",
+        "swa",
+        "swe",
+        "syc",
+        "syr",
+        "tah",
+        "tai",
+        "tam",
+        "tat",
+        "tel",
+        "tem",
+        "ter",
+        "tet",
+        "tgk",
+        "tgl",
+        "tha",
+        "tig",
+        "tir",
+        "tiv",
+        "tkl",
+        "tlh",
+        "tli",
+        "tmh",
+        "tog",
+        "ton",
+        "tpi",
+        "tsi",
+        "tsn",
+        "tso",
+        "tuk",
+        "tum",
+        "tup",
+        "tur",
+        "tut",
+        "tvl",
+        "twi",
+        "tyv",
+        "udm",
+        "uga",
+        "uig",
+        "ukr",
+        "umb",
+        "und",
+        "urd",
+        "uzb",
+        "vai",
+        "ven",
+        "vie",
+        "vol",
+        "vot",
+        "wak",
+        "wal",
+        "war",
+        "was",
+        "wen",
+        "wln",
+        "wol",
+        "xal",
+        "xho",
+        "yao",
+        "yap",
+        "yid",
+        "yor",
+        "ypk",
+        "zap",
+        "zbl",
+        "zen",
+        "zgh",
+        "zha",
+        "znd",
+        "zul",
+        "zun",
+        "zxx",
+        "zza",
+    ]
+)
+# deprecated or wrong codes -> the code to use
+DEPRECATED: dict[str, str] = {
+    # we have a number of records using the wrong code for Japanese
+    "jap": "jpn",
+    # NOTE: assumes language is Inuktitut & not another Inuit language
+    # like Iñupiaq (ipk). This is true for our collection though & Inuktitut
+    # is the most common. Note that `iku` also covers Inuinnaqtun.
+    # https://en.wikipedia.org/wiki/Eskaleut_languages#Internal_classification
+    "esk": "iku",
+}
+# codes that don't name one language, so 008/35-37 can't be checked against 041
+NON_SPECIFIC: frozenset[str] = frozenset(["mul", "und", "zxx", "mis"])
+
+
+class Split(NamedTuple):
+    """Result of splitting a 041 $a value"""
+
+    # valid codes, in order
+    codes: tuple[str, ...]
+    # 3-letter pieces that aren't a code
+    unrecognized: tuple[str, ...]
+    # False if the value's length isn't a multiple of 3 so it couldn't be split
+    divisible: bool
+
+
+def normalize(code: str) -> str | None:
+    """The valid code for a 3-letter code (lowercased, deprecated codes
+    replaced) or None if it isn't one"""
+    code = code.lower()
+    if code in CODES:
+        return code
+    return DEPRECATED.get(code)
+
+
+@lru_cache(maxsize=None)
+def split(value: str) -> Split:
+    """Split a 041 $a value like "engjpn" into valid codes. A value that's
+    already a valid code is returned as is."""
+    if value in CODES:
+        return Split((value,), (), True)
+    if len(value) % 3:
+        return Split((), (), False)
+    found: list[str] = []
+    unrecognized: list[str] = []
+    for i in range(0, len(value), 3):
+        piece: str = value[i : i + 3].lower()
+        code: str | None = normalize(piece)
+        if code:
+            found.append(code)
+        else:
+            unrecognized.append(piece)
+    return Split(tuple(dict.fromkeys(found)), tuple(unrecognized), True)
+
+
+def check_008(language: str, codes: Iterable[str]) -> str | None:
+    """Problem with a record's 008/35-37 language given its 041 $a codes,
+    if there is one"""
+    if not language.strip() or language in ("|||", "###"):
+        return None
+    code: str | None = normalize(language)
+    if code is None:
+        return f"008/35-37 {language} is not a valid language code"
+    if code != language:
+        return f"008/35-37 {language} should be {code}"
+    codes = list(codes)
+    if codes and code not in NON_SPECIFIC and code not in codes:
+        return f"008/35-37 {language} is not one of the 041 $a codes {' '.join(codes)}"
+    return None
@@ -1,3 +1,5 @@
+import argparse
+import contextlib
 import csv
 from datetime import date
 import io
@@ -6,10 +8,18 @@ from pathlib import Path
 import os
 import signal
 import sys
+from typing import Iterator
 
 from dotenv import dotenv_values
 import httpx
 
+# shared MARC modules are in the parent directory
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+from marc_index import has, scan  # noqa: E402
+from marc_columns import ColumnStore, is_store  # noqa: E402
+from marc_io import is_marc_path, open_marc  # noqa: E402
+from profiling import Profile, stage, timed  # noqa: E402
+
 config: dict = {
     **dotenv_values(".env"),  # load shared development variables
     **os.environ,  # override loaded values with environment variables
@@ -41,10 +51,29 @@ def quote(list):
     return output.getvalue().strip()
 
 
+def marc_bibs(path: str) -> Iterator[list[str]]:
+    """Rows like the Koha report's from a MARC export, only the 245, 856 and
+    999 of records with an 856 are read"""
+    with open_marc(path) as fh:
+        for record in scan(fh, ("245", "856", "999"), has("856")):
+            urls = record.subfields("856", "u")
+            if urls:
+                yield [
+                    " | ".join(urls),
+                    record.subfield("245", "a") or "",
+                    record.subfield("999", "c") or "",
+                ]
+
+
 def main() -> None:
     count = 0
-    report = httpx.get(config["LINKCHECK_REPORT"])
-    for bib in report.json():
+    if is_marc_path(config["LINKCHECK_REPORT"]):
+        bibs = marc_bibs(config["LINKCHECK_REPORT"])
+    elif is_store(config["LINKCHECK_REPORT"]):
+        bibs = ColumnStore(config["LINKCHECK_REPORT"]).urls()
+    else:
+        bibs = httpx.get(config["LINKCHECK_REPORT"]).json()
+    for bib in timed("read", bibs):
         # bibs are arrays like [urls string, title, biblionumber]
         urls, title, id = bib
         # urls are separated by " | "
@@ -54,7 +83,8 @@ def main() -> None:
             if config.get("LINKCHECK_LIMIT") and count > int(config["LINKCHECK_LIMIT"]):
                 break
             try:
-                r = httpx.get(url, follow_redirects=True)
+                with stage("check", 1):
+                    r = httpx.get(url, follow_redirects=True)
                 status = r.status_code
                 if not statuses.get(status):
                     statuses[status] = 0
@@ -108,8 +138,18 @@ def signal_handler(sig, frame) -> None:
 
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Check the URLs in Koha 856$u fields, see readme.md for settings"
+    )
+    parser.add_argument(
+        "--profile",
+        help="write cProfile stats to FILE and print time & memory per stage",
+        metavar="FILE",
+    )
+    args = parser.parse_args()
     # TODO this doesn't seem to work with httpx it cancels the current request
     # TODO but the script keeps running
     signal.signal(signal.SIGINT, signal_handler)
-    main()
-    summarize()
+    with Profile(args.profile) if args.profile else contextlib.nullcontext():
+        main()
+        summarize()
@@ -0,0 +1,92 @@
+"""
+MinHash locality-sensitive hashing for finding near-duplicate records without
+comparing every pair. Each record's tokens get a MinHash signature which is
+split into bands; records sharing any band land in the same bucket and only
+records sharing a bucket are compared.
+
+With the defaults (32 hashes, 8 bands of 4) pairs with Jaccard similarity
+around 0.55 have a 50% chance of becoming candidates and pairs at 0.8 are
+found 98% of the time.
+"""
+
+from hashlib import blake2b
+import random
+from typing import Iterable, Iterator
+
+PRIME: int = (1 << 61) - 1
+
+
+def jaccard(a: set[str], b: set[str]) -> float:
+    if not a or not b:
+        return 0.0
+    return len(a & b) / len(a | b)
+
+
+class MinHashLSH:
+    """Bucket token sets by banded MinHash signatures"""
+
+    def __init__(self, num_perm: int = 32, bands: int = 8, seed: int = 1):
+        if num_perm % bands:
+            raise ValueError("num_perm must be divisible by bands")
+        rng = random.Random(seed)
+        self.perms: list[tuple[int, int]] = [
+            (rng.randrange(1, PRIME), rng.randrange(0, PRIME)) for _ in range(num_perm)
+        ]
+        self.rows: int = num_perm // bands
+        self.buckets: list[dict[tuple[int, ...], list[int]]] = [
+            {} for _ in range(bands)
+        ]
+
+    def signature(self, tokens: Iterable[str]) -> list[int]:
+        # hash each token once (stable across processes, unlike hash())
+        hashes: list[int] = [
+            int.from_bytes(blake2b(t.encode(), digest_size=8).digest(), "little")
+            for t in tokens
+        ]
+        return [min((a * h + b) % PRIME for h in hashes) for a, b in self.perms]
+
+    def add(self, item: int, tokens: Iterable[str]) -> None:
+        """Add item (e.g. a record number) with its tokens"""
+        signature: list[int] = self.signature(tokens)
+        for band, buckets in enumerate(self.buckets):
+            key = tuple(signature[band * self.rows : (band + 1) * self.rows])
+            buckets.setdefault(key, []).append(item)
+
+    def candidates(self) -> Iterator[list[int]]:
+        """Buckets with more than one item"""
+        for buckets in self.buckets:
+            for items in buckets.values():
+                if len(items) > 1:
+                    yield items
+
+
+def similar_groups(
+    token_sets: list[set[str]], threshold: float = 0.8, lsh: MinHashLSH | None = None
+) -> list[list[int]]:
+    """Groups of positions in token_sets whose Jaccard similarity is at least
+    threshold (transitively), found via LSH candidates"""
+    lsh = lsh or MinHashLSH()
+    for i, tokens in enumerate(token_sets):
+        if tokens:
+            lsh.add(i, tokens)
+
+    # union-find so records already grouped aren't compared again
+    parent: list[int] = list(range(len(token_sets)))
+
+    def root(i: int) -> int:
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    for items in lsh.candidates():
+        for n, i in enumerate(items):
+            for j in items[n + 1 :]:
+                ri, rj = root(i), root(j)
+                if ri != rj and jaccard(token_sets[i], token_sets[j]) >= threshold:
+                    parent[max(ri, rj)] = min(ri, rj)
+
+    groups: dict[int, list[int]] = {}
+    for i in range(len(token_sets)):
+        groups.setdefault(root(i), []).append(i)
+    return sorted((g for g in groups.values() if len(g) > 1), key=lambda g: g[0])
@@ -0,0 +1,461 @@
+"""
+Extract a MARC file into a column store for catalog-wide questions ("how many
+records have several 041$a?", "which 856 hosts are most common?") so they're
+answered by a query over the store instead of a script that re-parses the
+whole export.
+
+The store is a SQLite database with one row per subfield (or control field)
+of columns record, field, tag, indicators, code and value. Values are
+dictionary encoded: each distinct value is stored once in the strings table
+and subfields refer to it by id, so the repeated publishers, places, item
+types and subjects of a catalog take little space and GROUP BY value compares
+integers. The same match keys dupes.py uses are extracted too, so it and
+linkcheck can read their keys and URLs from the store.
+
+SQLite instead of Arrow/Parquet or NumPy arrays because it's in the standard
+library and the queries are plain SQL: `subfield_values` is a view with the
+values joined back in, and `host(url)` is available in queries.
+"""
+
+import csv
+from pathlib import Path
+import sqlite3
+import sys
+import tempfile
+from typing import Callable, Iterator
+from urllib.parse import urlsplit
+
+import click
+
+from marc_index import SD, LazyField, directory, iter_raw
+from marc_io import open_marc
+from match_keys import KEYS, make_raw
+from profiling import profile_option, stage, timed
+from testing import test_command
+
+SCHEMA = """
+CREATE TABLE meta (
+    source TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL
+);
+CREATE TABLE records (
+    record INTEGER PRIMARY KEY, -- position in the file, 0-based
+    offset INTEGER NOT NULL,
+    leader TEXT NOT NULL,
+    valid INTEGER NOT NULL
+);
+CREATE TABLE strings (
+    id INTEGER PRIMARY KEY,
+    value TEXT NOT NULL
+);
+CREATE TABLE subfields (
+    record INTEGER NOT NULL,
+    field INTEGER NOT NULL, -- position among the record's extracted fields
+    tag TEXT NOT NULL,
+    indicators TEXT, -- NULL for control fields
+    code TEXT, -- NULL for control fields
+    value INTEGER NOT NULL -- strings.id
+);
+CREATE TABLE keys (
+    key TEXT NOT NULL,
+    value TEXT NOT NULL,
+    record INTEGER NOT NULL
+);
+CREATE VIEW subfield_values AS
+    SELECT subfields.record, subfields.field, subfields.tag,
+        subfields.indicators, subfields.code, strings.value
+    FROM subfields JOIN strings ON strings.id = subfields.value;
+"""
+# built after the rows are inserted, which is faster than keeping them updated
+INDEXES = """
+CREATE INDEX subfields_tag ON subfields (tag, code, record);
+CREATE INDEX keys_value ON keys (key, value);
+"""
+# rows are written in batches of this size
+BATCH = 50000
+
+# name -> (description, SQL) of canned queries
+QUERIES: dict[str, tuple[str, str]] = {
+    "multiple-041a": (
+        "records with more than one 041$a",
+        """SELECT count(*) AS records FROM (
+            SELECT record FROM subfields WHERE tag = '041' AND code = 'a'
+            GROUP BY record HAVING count(*) > 1
+        )""",
+    ),
+    "856-hosts": (
+        "most common 856$u hosts",
+        """SELECT host(value) AS host, count(*) AS urls FROM subfield_values
+        WHERE tag = '856' AND code = 'u' GROUP BY 1 ORDER BY 2 DESC""",
+    ),
+    "isbn-by-itemtype": (
+        "share of records with an 020$a by 942$c item type",
+        """SELECT types.value AS itemtype, count(*) AS records,
+            count(isbn.record) AS with_isbn,
+            round(100.0 * count(isbn.record) / count(*), 1) AS percent
+        FROM (
+            SELECT DISTINCT record, value FROM subfield_values
+            WHERE tag = '942' AND code = 'c'
+        ) AS types
+        LEFT JOIN (
+            SELECT DISTINCT record FROM subfields WHERE tag = '020' AND code = 'a'
+        ) AS isbn ON isbn.record = types.record
+        GROUP BY 1 ORDER BY 2 DESC""",
+    ),
+}
+
+
+def host(url: str | None) -> str | None:
+    try:
+        return urlsplit(url.strip()).hostname if url else None
+    except ValueError:
+        return None
+
+
+def is_store(path: str | Path) -> bool:
+    """Whether a file is a SQLite database, i.e. possibly a column store"""
+    try:
+        with open(path, "rb") as fh:
+            return fh.read(16) == b"SQLite format 3\x00"
+    except OSError:
+        return False
+
+
+def rows(
+    raw: bytes,
+    n: int,
+    tags: frozenset[str] | None,
+    string: Callable[[str], int],
+) -> Iterator[tuple[int, int, str, str | None, str | None, int]]:
+    """subfields rows of raw record number n, string() gives a value's id"""
+    marc8: bool = raw[9:10] != b"a"
+    i: int = 0
+    for tag, start, end in directory(raw):
+        if tags is not None and tag not in tags:
+            continue
+        if marc8:
+            field = LazyField(tag, raw[start:end], True)
+            if field.data is not None:
+                yield n, i, tag, None, None, string(field.data)
+            else:
+                indicators: str = "".join(field.indicators or ())
+                for s in field.subfields:
+                    yield n, i, tag, indicators, s.code, string(s.value)
+        # UTF-8 fields are decoded whole then split, like LazyField would
+        elif tag < "010" and tag.isdigit():
+            yield n, i, tag, None, None, string(
+                raw[start:end].decode("utf-8", "replace")
+            )
+        else:
+            first, *subfields = raw[start:end].decode("utf-8", "replace").split("\x1f")
+            indicators = first[:2].ljust(2)
+            for subfield in subfields:
+                if subfield:
+                    yield n, i, tag, indicators, subfield[0], string(subfield[1:])
+        i += 1
+
+
+def extract(
+    file: str | Path, db: str | Path, tags: tuple[str, ...] | None = None
+) -> int:
+    """Write the column store for file to db, replacing it, with only the
+    fields with tags (all of them if tags is None). Returns the number of
+    records extracted."""
+    path = Path(db)
+    # built under another name so a failed run doesn't leave half a store
+    partial: Path = path.with_name(path.name + ".part")
+    partial.unlink(missing_ok=True)
+    conn = sqlite3.connect(partial)
+    conn.execute("PRAGMA journal_mode = OFF")
+    conn.execute("PRAGMA synchronous = OFF")
+    conn.executescript(SCHEMA)
+    stat = Path(file).stat()
+    conn.execute(
+        "INSERT INTO meta VALUES (?, ?, ?)",
+        (str(file), stat.st_size, stat.st_mtime_ns),
+    )
+    ids: dict[str, int] = {}
+    strings: list[tuple[int, str]] = []
+
+    def string(value: str) -> int:
+        id: int | None = ids.get(value)
+        if id is None:
+            id = ids[value] = len(ids) + 1
+            strings.append((id, value))
+        return id
+
+    records: list[tuple[int, int, str, bool]] = []
+    subfields: list[tuple] = []
+    keys: list[tuple[str, str, int]] = []
+
+    def write() -> None:
+        with stage("write"):
+            conn.executemany("INSERT INTO strings VALUES (?, ?)", strings)
+            conn.executemany("INSERT INTO records VALUES (?, ?, ?, ?)", records)
+            conn.executemany(
+                "INSERT INTO subfields VALUES (?, ?, ?, ?, ?, ?)", subfields
+            )
+            conn.executemany("INSERT INTO keys VALUES (?, ?, ?)", keys)
+        for batch in (strings, records, subfields, keys):
+            batch.clear()
+
+    count: int = 0
+    selected: frozenset[str] | None = frozenset(tags) if tags else None
+    with open_marc(file) as fh:
+        for n, (offset, raw) in enumerate(timed("read", iter_raw(fh))):
+            with stage("extract", 1):
+                before: int = len(subfields)
+                subfields.extend(rows(raw, n, selected, string))
+                # like ScannedRecord.valid, a record is valid if it has fields
+                valid: bool = len(subfields) > before or any(directory(raw))
+                records.append((n, offset, raw[:24].decode("ascii", "replace"), valid))
+                for name, key in KEYS.items():
+                    keys.extend((name, value, n) for value in key(raw))
+            count += 1
+            if len(subfields) >= BATCH:
+                write()
+    write()
+    with stage("index"):
+        conn.executescript(INDEXES)
+    conn.commit()
+    conn.close()
+    partial.replace(path)
+    return count
+
+
+class ColumnStore:
+    """Queries on a column store written by extract()"""
+
+    def __init__(self, path: str | Path):
+        if not is_store(path):
+            raise ValueError(f"{path} isn't a column store, see marc_columns.py")
+        self.path = Path(path)
+        self.db = sqlite3.connect(f"{self.path.resolve().as_uri()}?mode=ro", uri=True)
+        self.db.create_function("host", 1, host, deterministic=True)
+
+    def __enter__(self) -> "ColumnStore":
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+    def close(self) -> None:
+        self.db.close()
+
+    def __len__(self) -> int:
+        return self.db.execute("SELECT count(*) FROM records").fetchone()[0]
+
+    @property
+    def source(self) -> str:
+        return self.db.execute("SELECT source FROM meta").fetchone()[0]
+
+    def is_current(self, file: str | Path) -> bool:
+        """Whether the store was extracted from file as it is now"""
+        stat = Path(file).stat()
+        size, mtime_ns = self.db.execute("SELECT size, mtime_ns FROM meta").fetchone()
+        return (size, mtime_ns) == (stat.st_size, stat.st_mtime_ns)
+
+    def query(self, sql: str, *params) -> sqlite3.Cursor:
+        return self.db.execute(sql, params)
+
+    def duplicates(self, key: str) -> tuple[list[tuple[str, list[int]]], int]:
+        """Groups of (value, offsets of the records sharing it) for a match
+        key, ordered by their first record, and the number of unique values,
+        like dupes.offset_duplicates()"""
+        groups: dict[str, list[int]] = {}
+        for value, offset in self.db.execute(
+            """SELECT keys.value, records.offset FROM keys
+            JOIN records ON records.record = keys.record
+            WHERE keys.key = ? AND keys.value IN (
+                SELECT value FROM keys WHERE key = ?
+                GROUP BY value HAVING count(*) > 1
+            ) ORDER BY keys.rowid""",
+            (key, key),
+        ):
+            groups.setdefault(value, []).append(offset)
+        unique: int = self.db.execute(
+            "SELECT count(DISTINCT value) FROM keys WHERE key = ?", (key,)
+        ).fetchone()[0]
+        return sorted(groups.items(), key=lambda g: g[1][0]), unique
+
+    def urls(self) -> Iterator[list[str]]:
+        """Rows like the linkcheck Koha report's: [856$u values joined with
+        " | ", first 245$a, first 999$c] of records with an 856$u"""
+
+        def row(found: dict[str, list[str]]) -> list[str]:
+            return [
+                " | ".join(found["856"]),
+                found["245"][0] if found["245"] else "",
+                found["999"][0] if found["999"] else "",
+            ]
+
+        current: int | None = None
+        found: dict[str, list[str]] = {}
+        # rows were inserted in file order
+        for record, tag, value in self.db.execute(
+            """SELECT subfields.record, subfields.tag, strings.value
+            FROM subfields JOIN strings ON strings.id = subfields.value
+            WHERE (subfields.tag, subfields.code) IN
+                (VALUES ('245', 'a'), ('856', 'u'), ('999', 'c'))
+            ORDER BY subfields.rowid"""
+        ):
+            if record != current:
+                if found.get("856"):
+                    yield row(found)
+                current = record
+                found = {"245": [], "856": [], "999": []}
+            found[tag].append(value.strip())
+        if found.get("856"):
+            yield row(found)
+
+
+class MARCColumnsTests:
+    RAWS: list[bytes] = [
+        make_raw(
+            [
+                ("001", b"a1"),
+                ("020", b"  " + SD + b"a0306406152"),
+                ("041", b"0 " + SD + b"aeng" + SD + b"afre"),
+                ("245", b"10" + SD + b"aColor theory"),
+                ("856", b"40" + SD + b"uhttps://example.org/a"),
+                ("942", b"  " + SD + b"cBOOK"),
+                ("999", b"  " + SD + b"c1"),
+            ]
+        ),
+        make_raw(
+            [
+                ("001", b"a2"),
+                ("245", b"10" + SD + b"aCaf\xe2e society"),
+                ("856", b"40" + SD + b"uhttp://EXAMPLE.org/b" + SD + b"zfree"),
+                ("856", b"40" + SD + b"uhttps://other.net/c"),
+                ("942", b"  " + SD + b"cEBOOK"),
+                ("999", b"  " + SD + b"c2"),
+            ],
+            utf8=False,
+        ),
+        make_raw(
+            [
+                ("001", b"a3"),
+                ("020", b"  " + SD + b"a978-0-306-40615-7 (pbk.)"),
+                ("041", b"0 " + SD + b"aeng"),
+                ("245", b"10" + SD + b"aColor theory :" + SD + b"bsecond edition"),
+                ("942", b"  " + SD + b"cBOOK"),
+                ("999", b"  " + SD + b"c3"),
+            ]
+        ),
+    ]
+
+    def test_query(self) -> None:
+        with tempfile.TemporaryDirectory() as tmp:
+            file = Path(tmp) / "export.mrc"
+            file.write_bytes(b"".join(self.RAWS))
+            with open(file, "rb") as fh:
+                offsets: list[int] = [offset for offset, _ in iter_raw(fh)]
+            db = Path(tmp) / "export.db"
+            self.assertEqual(extract(file, db), 3)
+            self.assertFalse(db.with_name("export.db.part").exists())
+            with ColumnStore(db) as store:
+                self.assertEqual(len(store), 3)
+                self.assertTrue(store.is_current(file))
+                self.assertEqual(
+                    store.query(QUERIES["multiple-041a"][1]).fetchall(), [(1,)]
+                )
+                self.assertEqual(
+                    store.query(QUERIES["856-hosts"][1]).fetchall(),
+                    [("example.org", 2), ("other.net", 1)],
+                )
+                self.assertEqual(
+                    store.query(QUERIES["isbn-by-itemtype"][1]).fetchall(),
+                    [("BOOK", 2, 2, 100.0), ("EBOOK", 1, 0, 0.0)],
+                )
+                # MARC-8 values are stored decoded
+                self.assertEqual(
+                    store.query(
+                        "SELECT record, value FROM subfield_values WHERE tag = ?"
+                        " AND code = ? ORDER BY record",
+                        "245",
+                        "a",
+                    ).fetchall(),
+                    [(0, "Color theory"), (1, "Café society"), (2, "Color theory :")],
+                )
+                self.assertEqual(
+                    store.duplicates("isbn"),
+                    ([("9780306406157", [offsets[0], offsets[2]])], 1),
+                )
+                self.assertEqual(store.duplicates("001"), ([], 3))
+                self.assertEqual(
+                    list(store.urls()),
+                    [
+                        ["https://example.org/a", "Color theory", "1"],
+                        [
+                            "http://EXAMPLE.org/b | https://other.net/c",
+                            "Café society",
+                            "2",
+                        ],
+                    ],
+                )
+            # only the fields asked for, but every match key
+            self.assertEqual(extract(file, db, ("245",)), 3)
+            with ColumnStore(db) as store:
+                self.assertEqual(
+                    store.query("SELECT DISTINCT tag FROM subfields").fetchall(),
+                    [("245",)],
+                )
+                self.assertEqual(store.duplicates("isbn")[1], 1)
+            self.assertRaises(ValueError, ColumnStore, file)
+
+
+@click.group()
+@click.help_option("-h", "--help")
+def cli():
+    """Extract MARC files into column stores and query them."""
+    pass
+
+
+@cli.command("extract")
+@click.help_option("-h", "--help")
+@click.argument(
+    "file", metavar="<file.mrc>", type=click.Path(exists=True, dir_okay=False)
+)
+@click.argument("db", metavar="<file.db>", type=click.Path(dir_okay=False))
+@click.option(
+    "-t",
+    "--tag",
+    "tags",
+    multiple=True,
+    help="only extract fields with this tag, can be repeated (default: all)",
+)
+@profile_option
+def extract_command(file: str, db: str, tags: tuple[str, ...]) -> None:
+    """Write a column store of <file.mrc> to <file.db>, replacing it."""
+    count: int = extract(file, db, tags or None)
+    click.echo(f"Extracted {count} records from {file} to {db}")
+
+
+@cli.command()
+@click.help_option("-h", "--help")
+@click.argument("db", metavar="<file.db>", type=click.Path(exists=True, dir_okay=False))
+@click.argument("sql", metavar="<query name or SQL>", required=False)
+def query(db: str, sql: str | None) -> None:
+    """Print the results of a query as tab-separated values. Without a query,
+    list the canned ones."""
+    if not sql:
+        for name, (description, _) in QUERIES.items():
+            click.echo(f"{name:<20}{description}")
+        return
+    with ColumnStore(db) as store:
+        try:
+            cursor: sqlite3.Cursor = store.query(QUERIES.get(sql, ("", sql))[1])
+        except sqlite3.Error as e:
+            raise click.UsageError(f"{e} in query: {sql}")
+        writer = csv.writer(sys.stdout, delimiter="\t", lineterminator="\n")
+        writer.writerow(column[0] for column in cursor.description)
+        writer.writerows(cursor)
+
+
+cli.add_command(test_command(MARCColumnsTests))
+
+
+if __name__ == "__main__":
+    cli()
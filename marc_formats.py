@@ -0,0 +1,312 @@
+"""
+Read MARCXML and MARC-in-JSON as raw MARC records. marc_index.iter_raw hands
+a stream over when its first byte is "<" (MARCXML) or "{" (MARC-in-JSON, one
+record per line as pymarc's Record.as_json() writes them) and every record
+is converted to binary MARC, so all the tools that read through iter_raw
+take these formats, compressed or not, without a MARCEdit conversion first.
+
+MARCXML is parsed incrementally with iterparse. Each record is converted as
+soon as it's complete and then dropped from the tree, along with anything
+outside records (e.g. OAI-PMH headers), so memory use stays flat however
+big the document is. Both formats are Unicode, so converted records are
+UTF-8 (leader/09 "a"). Records don't have byte offsets in the binary sense,
+iter_raw yields their position in the file (0, 1, 2...) instead.
+"""
+
+import contextlib
+import io
+import json
+from pathlib import Path
+import re
+import sys
+import tempfile
+from typing import BinaryIO, Iterator
+from xml.etree import ElementTree
+
+import click
+from pymarc import Field, Indicators, Record, Subfield, record_to_xml
+
+from marc_index import SD, as_marc, iter_raw
+from marc_io import BLANK, file_format, text_format
+from testing import test_command
+
+MARCXML = "http://www.loc.gov/MARC21/slim"
+RECORD: tuple[str, ...] = ("record", f"{{{MARCXML}}}record")
+# JSON lines are read in blocks of this many bytes
+BLOCK: int = 1 << 20
+
+
+class _Prefixed:
+    """Binary reader that returns bytes already read from fh first"""
+
+    def __init__(self, head: bytes, fh: BinaryIO):
+        self.head = head
+        self.fh = fh
+
+    def read(self, size: int = -1) -> bytes:
+        head: bytes = self.head
+        self.head = b""
+        if size < 0:
+            return head + self.fh.read()
+        return head + self.fh.read(max(size - len(head), 0))
+
+
+def _leader(text: str | None) -> bytes:
+    """A 24 byte leader, Unicode with MARC 21's fixed positions filled in
+    (as_marc fills in the length & base address)"""
+    leader: bytes = (text or "").encode("ascii", "replace").ljust(24)[:24]
+    return leader[:9] + b"a22" + leader[12:20] + b"4500"
+
+
+def _tag(tag: str | None) -> str:
+    return (tag or "").ljust(3)[:3]
+
+
+def _code(code: str | None) -> bytes:
+    """An indicator or subfield code, blank if it's missing"""
+    return (code or " ")[:1].encode()
+
+
+def _local(tag: str) -> str:
+    """Element name without its namespace"""
+    return tag.rpartition("}")[2]
+
+
+def xml_record(record: ElementTree.Element) -> bytes:
+    """Raw MARC from a MARCXML <record> element"""
+    leader: str | None = None
+    fields: list[tuple[str, bytes]] = []
+    for element in record:
+        name: str = _local(element.tag)
+        if name == "leader":
+            leader = element.text
+        elif name == "controlfield":
+            fields.append((_tag(element.get("tag")), (element.text or "").encode()))
+        elif name == "datafield":
+            data: list[bytes] = [_code(element.get("ind1")), _code(element.get("ind2"))]
+            for subfield in element:
+                if _local(subfield.tag) == "subfield":
+                    data += [
+                        SD,
+                        _code(subfield.get("code")),
+                        (subfield.text or "").encode(),
+                    ]
+            fields.append((_tag(element.get("tag")), b"".join(data)))
+    return as_marc(_leader(leader), fields)
+
+
+def xml_records(fh: BinaryIO) -> Iterator[tuple[int, bytes]]:
+    """(position, raw record) for each record in a MARCXML document, a
+    <collection> of records or a single <record>"""
+    parents: list[ElementTree.Element] = []
+    records: int = 0  # <record> elements open, 0 or 1
+    position: int = 0
+    for event, element in ElementTree.iterparse(fh, events=("start", "end")):
+        if event == "start":
+            parents.append(element)
+            records += element.tag in RECORD
+            continue
+        parents.pop()
+        if element.tag in RECORD:
+            records -= 1
+            yield position, xml_record(element)
+            position += 1
+        elif records:
+            # a field or subfield, kept until its record is converted
+            continue
+        # done with this element, drop it from the tree so memory stays flat
+        if parents:
+            del parents[-1][-1]
+
+
+def json_record(record: dict) -> bytes:
+    """Raw MARC from a MARC-in-JSON record: {"leader": "...", "fields":
+    [{"001": "..."}, {"245": {"ind1": "1", "ind2": "0", "subfields":
+    [{"a": "..."}]}}]}"""
+    fields: list[tuple[str, bytes]] = []
+    for field in record.get("fields", []):
+        for tag, value in field.items():
+            if isinstance(value, dict):
+                data: list[bytes] = [_code(value.get("ind1")), _code(value.get("ind2"))]
+                for subfield in value.get("subfields", []):
+                    for code, text in subfield.items():
+                        data += [SD, _code(code), str(text).encode()]
+                fields.append((_tag(tag), b"".join(data)))
+            else:
+                fields.append((_tag(tag), str(value).encode()))
+    return as_marc(_leader(record.get("leader")), fields)
+
+
+def _lines(fh: BinaryIO) -> Iterator[bytes]:
+    rest: bytes = b""
+    while block := fh.read(BLOCK):
+        *lines, rest = (rest + block).split(b"\n")
+        yield from lines
+    if rest:
+        yield rest
+
+
+def json_records(fh: BinaryIO) -> Iterator[tuple[int, bytes]]:
+    """(position, raw record) for each line of a MARC-in-JSON lines file.
+    Lines that aren't a MARC-in-JSON record are skipped with a warning."""
+    position: int = 0
+    for number, line in enumerate(_lines(fh), 1):
+        if not line.strip():
+            continue
+        try:
+            raw: bytes = json_record(json.loads(line))
+        except (ValueError, AttributeError, TypeError) as e:
+            print(
+                f"Warning: line {number}: not a MARC-in-JSON record: {e}",
+                file=sys.stderr,
+            )
+            continue
+        yield position, raw
+        position += 1
+
+
+def text_records(fh: BinaryIO, head: bytes = b"") -> Iterator[tuple[int, bytes]]:
+    """(position, raw record) for each record in a MARCXML or MARC-in-JSON
+    stream, head being any bytes already read from the start of it"""
+    # expat won't take blank lines before an <?xml ...?> declaration
+    stream = _Prefixed(head.lstrip(BLANK), fh)
+    if text_format(head) == "xml":
+        return xml_records(stream)  # type: ignore
+    return json_records(stream)  # type: ignore
+
+
+def sample_records() -> list[Record]:
+    """Records for the tests: diacritics, characters XML escapes, blank
+    indicators and a record without control fields"""
+    first = Record(leader="00000nam a2200000 a 4500")
+    first.add_field(
+        Field(tag="001", data="12345"),
+        Field(tag="008", data="240101s2024    fr a          000 0 fre d"),
+        Field(
+            tag="245",
+            indicators=Indicators("1", "0"),
+            subfields=[
+                Subfield(code="a", value="L'étranger /"),
+                Subfield(code="c", value="Albert Camus."),
+            ],
+        ),
+        Field(
+            tag="650",
+            indicators=Indicators(" ", "0"),
+            subfields=[Subfield(code="a", value='Tags <b> & "quotes"')],
+        ),
+    )
+    second = Record(leader="00000cam a2200000 i 4500")
+    second.add_field(
+        Field(
+            tag="245",
+            indicators=Indicators("0", "0"),
+            subfields=[Subfield(code="a", value="東京物語")],
+        )
+    )
+    return [first, second]
+
+
+class MarcFormatsTests:
+    def read(self, data: bytes) -> list[tuple[int, bytes]]:
+        return list(iter_raw(io.BytesIO(data)))
+
+    def test_xml(self) -> None:
+        records: list[Record] = sample_records()
+        expected = [(n, record.as_marc()) for n, record in enumerate(records)]
+        body: bytes = b"".join(record_to_xml(record) for record in records)
+        declaration = b'<?xml version="1.0" encoding="UTF-8"?>\n'
+        prefixed: bytes = re.sub(rb"<(/?)", rb"<\1marc:", body)
+        documents: dict[str, bytes] = {
+            "no namespace": b"<collection>" + body + b"</collection>",
+            "namespace": declaration
+            + f'<collection xmlns="{MARCXML}">'.encode()
+            + body
+            + b"</collection>",
+            "prefix": f'<marc:collection xmlns:marc="{MARCXML}">'.encode()
+            + prefixed
+            + b"</marc:collection>",
+            # OAI-PMH's own <record>s aren't MARC records
+            "OAI-PMH": b'<OAI-PMH xmlns="http://www.openarchives.org/OAI/2.0/">'
+            + b"<ListRecords>"
+            + b"".join(
+                b"<record><header><identifier>oai:%d</identifier></header>" % n
+                + b"<metadata>"
+                + record_to_xml(record, namespace=True)
+                + b"</metadata></record>"
+                for n, record in enumerate(records)
+            )
+            + b"</ListRecords></OAI-PMH>",
+        }
+        for name, document in documents.items():
+            with self.subTest(name):
+                self.assertEqual(self.read(document), expected)
+        # a document that's a single record
+        self.assertEqual(
+            self.read(record_to_xml(records[0], namespace=True)), expected[:1]
+        )
+
+    def test_json(self) -> None:
+        from unittest import mock
+
+        records: list[Record] = sample_records()
+        lines: list[bytes] = [record.as_json().encode() for record in records]
+        data: bytes = b"\n".join([lines[0], b"", b"not json", lines[1] + b"\r", b""])
+        err = io.StringIO()
+        # small blocks so records are split across them
+        with mock.patch(f"{__name__}.BLOCK", 16), contextlib.redirect_stderr(err):
+            raws: list[tuple[int, bytes]] = list(json_records(io.BytesIO(data)))
+        self.assertEqual(
+            raws, [(n, record.as_marc()) for n, record in enumerate(records)]
+        )
+        self.assertTrue(
+            err.getvalue().startswith("Warning: line 3: not a MARC-in-JSON record")
+        )
+
+    def test_sniff(self) -> None:
+        records: list[Record] = sample_records()
+        expected = [(n, record.as_marc()) for n, record in enumerate(records)]
+        xml: bytes = (
+            b'<?xml version="1.0" encoding="UTF-8"?>\n'
+            + f'<collection xmlns="{MARCXML}">'.encode()
+            + b"".join(record_to_xml(record) for record in records)
+            + b"</collection>"
+        )
+        jsonl: bytes = b"\n".join(record.as_json().encode() for record in records)
+        with tempfile.TemporaryDirectory() as tmp:
+            path = Path(tmp) / "records"
+            # byte order marks and blank lines, more than read_head's first read
+            for prefix in (
+                b"",
+                b"\xef\xbb\xbf",
+                b"\n\n",
+                b"\xef\xbb\xbf\r\n" + b" " * 100,
+            ):
+                for format, data in (("xml", xml), ("json", jsonl)):
+                    with self.subTest(format, prefix=prefix):
+                        self.assertEqual(self.read(prefix + data), expected)
+                        path.write_bytes(prefix + data)
+                        self.assertEqual(file_format(path), format)
+            # binary MARC is read as is
+            marc: bytes = b"".join(raw for _, raw in expected)
+            path.write_bytes(marc)
+            self.assertEqual(file_format(path), "marc")
+            self.assertEqual(
+                self.read(marc),
+                [(0, expected[0][1]), (len(expected[0][1]), expected[1][1])],
+            )
+
+
+@click.group()
+@click.help_option("-h", "--help")
+def cli():
+    """Read MARCXML and MARC-in-JSON lines as binary MARC, run with test to
+    check it."""
+    pass
+
+
+cli.add_command(test_command(MarcFormatsTests))
+
+
+if __name__ == "__main__":
+    cli()
@@ -0,0 +1,712 @@
+"""
+Build and read a compact offset index (a ".idx" sidecar) for a MARC file so
+tools can seek straight to record i, or to a record by 001 or 999$c, instead
+of scanning the file from the start.
+
+The sidecar is a small binary file next to the MARC file (records.mrc ->
+records.mrc.idx) containing a header, an array of record byte offsets, an
+array of record lengths, and newline-separated 001 and 999$c keys.
+
+It also has the low-level helpers the other scripts use to read raw records
+without decoding them: iter_raw, directory, and scan, which only looks at
+the fields a job needs and can filter records before they're decoded.
+iter_raw reads MARCXML and MARC-in-JSON too, converting their records to raw
+MARC (see marc_formats.py), but the index needs binary MARC to seek in.
+"""
+
+from array import array
+import io
+import os
+from pathlib import Path
+import re
+import struct
+import sys
+import tempfile
+from typing import BinaryIO, Callable, Collection, Iterator
+
+import click
+from click.testing import CliRunner
+from pymarc import Record, Subfield
+
+from marc_io import file_format, open_marc, read_head, text_format
+from testing import test_command
+
+MAGIC = b"KQIDX1"
+# source file size, source file mtime (ns), record count
+HEADER = struct.Struct("<QqI")
+KEYS_LENGTH = struct.Struct("<I")
+# directory entry: tag, field length, field offset
+ENTRY = struct.Struct("3s4s5s")
+
+FT = b"\x1e"  # field terminator
+RT = b"\x1d"  # record terminator
+SD = b"\x1f"  # subfield delimiter
+# ISBN in a 020$a, the same as pymarc's
+ISBN = re.compile(r"([0-9\-xX]+)")
+
+
+def iter_raw(fh: BinaryIO) -> Iterator[tuple[int, bytes]]:
+    """Yield (byte offset, raw record bytes) for each record in a MARC stream.
+
+    Uses the record length in the leader like pymarc does, but if that length
+    doesn't land on a record terminator we fall back to reading up to the
+    next terminator so one bad leader doesn't break the rest of the file.
+    MARCXML and MARC-in-JSON streams are converted record by record, their
+    "offsets" are record positions (0, 1, 2...) rather than byte offsets.
+    """
+    first5: bytes = read_head(fh)
+    if text_format(first5):
+        # imported here, marc_formats builds its records with as_marc below
+        from marc_formats import text_records
+
+        yield from text_records(fh, first5)
+        return
+    offset = 0
+    while first5:
+        try:
+            length = int(first5)
+        except ValueError:
+            length = 0
+        chunk: bytes = first5 + fh.read(max(length - 5, 0)) if length > 5 else first5
+        if not chunk.endswith(RT):
+            # bad leader length, resync on the record terminator
+            while not chunk.endswith(RT):
+                byte: bytes = fh.read(1)
+                if not byte:
+                    break
+                chunk += byte
+        yield offset, chunk
+        offset += len(chunk)
+        first5 = fh.read(5)
+
+
+def as_marc(leader: bytes, fields: list[tuple[str, bytes]]) -> bytes:
+    """Raw record from a leader (24 bytes, length and base address are filled
+    in) and (tag, field data without the terminator) pairs"""
+    entries: list[bytes] = []
+    body: list[bytes] = []
+    start: int = 0
+    for tag, data in fields:
+        entries.append(b"%s%04d%05d" % (tag.encode(), len(data) + 1, start))
+        body.append(data + FT)
+        start += len(data) + 1
+    base: int = 24 + 12 * len(fields) + 1
+    length: int = base + start + 1
+    return b"".join(
+        [
+            b"%05d" % length,
+            leader[5:12],
+            b"%05d" % base,
+            leader[17:],
+            *entries,
+            FT,
+            *body,
+            RT,
+        ]
+    )
+
+
+def directory(raw: bytes) -> Iterator[tuple[str, int, int]]:
+    """Yield (tag, start, end) for each field from a raw record's directory.
+    Start and end are absolute positions in raw and end excludes the field
+    terminator."""
+    try:
+        base = int(raw[12:17])
+    except ValueError:
+        return
+    entries: bytes = raw[24 : base - 1]
+    if len(entries) % 12 == 0 and FT not in entries:
+        # well-formed directory, unpack every entry at once
+        for tag, length, offset in ENTRY.iter_unpack(entries):
+            try:
+                start = base + int(offset)
+                end = start + int(length)
+            except ValueError:
+                continue
+            if raw[end - 1 : end] == FT:
+                end -= 1
+            yield tag.decode("ascii", "replace"), start, end
+        return
+    for pos in range(24, base - 1, 12):
+        entry: bytes = raw[pos : pos + 12]
+        if len(entry) < 12 or entry[:1] == FT:
+            return
+        try:
+            length = int(entry[3:7])
+            start: int = base + int(entry[7:12])
+        except ValueError:
+            continue
+        end: int = start + length
+        if raw[end - 1 : end] == FT:
+            end -= 1
+        yield entry[:3].decode("ascii", "replace"), start, end
+
+
+def control_value(raw: bytes, tag: str) -> str | None:
+    """Value of the first control field with tag, without decoding the record"""
+    for t, start, end in directory(raw):
+        if t == tag:
+            return raw[start:end].decode("utf-8", "replace").strip()
+    return None
+
+
+def subfield_value(raw: bytes, tag: str, code: str) -> str | None:
+    """Value of the first tag$code subfield, without decoding the record"""
+    marker: bytes = code.encode("ascii")
+    for t, start, end in directory(raw):
+        if t == tag:
+            for subfield in raw[start:end].split(SD)[1:]:
+                if subfield[:1] == marker:
+                    return subfield[1:].decode("utf-8", "replace").strip()
+    return None
+
+
+def subfield_values(raw: bytes, tag: str, *codes: str) -> list[str]:
+    """Values of every tag$code subfield, in order, without decoding the record"""
+    markers: tuple[bytes, ...] = tuple(c.encode("ascii") for c in codes)
+    values: list[str] = []
+    for t, start, end in directory(raw):
+        if t == tag:
+            for subfield in raw[start:end].split(SD)[1:]:
+                if subfield[:1] in markers:
+                    values.append(subfield[1:].decode("utf-8", "replace").strip())
+    return values
+
+
+def _text(value: bytes, marc8: bool) -> str:
+    if not marc8:
+        return value.decode("utf-8", "replace")
+    # imported here because marc_reader uses this module
+    from marc_reader import marc8_to_unicode
+
+    try:
+        return marc8_to_unicode(value)[0]
+    except UnicodeDecodeError:
+        return value.decode("iso8859-1")
+
+
+class LazyField:
+    """Read-only field of a ScannedRecord, decoded when it's first accessed.
+    Has the parts of pymarc's Field API we use: tag, indicators, data,
+    subfields, get(), get_subfields(), value() and field["a"]."""
+
+    __slots__ = ("tag", "indicators", "data", "subfields")
+
+    def __init__(self, tag: str, value: bytes, marc8: bool = False):
+        self.tag = tag
+        self.indicators: tuple[str, str] | None = None
+        self.data: str | None = None
+        self.subfields: list[Subfield] = []
+        # control fields are numeric tags below 010, like pymarc
+        if tag < "010" and tag.isdigit():
+            self.data = value.decode("iso8859-1" if marc8 else "utf-8", "replace")
+            return
+        indicators, *subfields = value.split(SD)
+        first, second = indicators[:2].decode("ascii", "replace").ljust(2)
+        self.indicators = (first, second)
+        for subfield in subfields:
+            if subfield:
+                code: str = subfield[:1].decode("ascii", "replace")
+                self.subfields.append(Subfield(code, _text(subfield[1:], marc8)))
+
+    @property
+    def control_field(self) -> bool:
+        return self.data is not None
+
+    @property
+    def indicator1(self) -> str | None:
+        return self.indicators[0] if self.indicators else None
+
+    @property
+    def indicator2(self) -> str | None:
+        return self.indicators[1] if self.indicators else None
+
+    def get(self, code: str, default: str | None = None) -> str | None:
+        for subfield in self.subfields:
+            if subfield.code == code:
+                return subfield.value
+        return default
+
+    def get_subfields(self, *codes: str) -> list[str]:
+        return [s.value for s in self.subfields if s.code in codes]
+
+    def value(self) -> str:
+        if self.data is not None:
+            return self.data
+        return " ".join(s.value.strip() for s in self.subfields)
+
+    def __getitem__(self, code: str) -> str:
+        value: str | None = self.get(code)
+        if value is None:
+            raise KeyError(code)
+        return value
+
+    def __str__(self) -> str:
+        if self.data is not None:
+            data: str = self.data.replace(" ", "\\")
+            return f"={self.tag}  {data}"
+        indicators: str = "".join(
+            "\\" if i in (" ", "\\") else i for i in self.indicators or ()
+        )
+        subfields: str = "".join(f"${s.code}{s.value}" for s in self.subfields)
+        return f"={self.tag}  {indicators}{subfields}"
+
+
+class ScannedRecord:
+    """A read-only record that keeps the raw bytes and only the directory
+    entries with the given tags (all of them if tags is None) as a string of
+    tags and an array of (start, end) positions. Fields are decoded into
+    LazyFields the first time they're accessed, get_fields(), get(), title
+    and isbn work like pymarc's Record. control(), subfields() and has() read
+    the raw bytes directly, record() decodes the scanned fields into a pymarc
+    Record. valid is False if the directory couldn't be read."""
+
+    __slots__ = ("offset", "raw", "valid", "tags", "spans", "_fields")
+
+    def __init__(
+        self, raw: bytes, tags: Collection[str] | None = None, offset: int = 0
+    ):
+        self.offset = offset
+        self.raw = raw
+        self.valid: bool = False
+        self.spans = array("L")
+        found: list[str] = []
+        for tag, start, end in directory(raw):
+            self.valid = True
+            if tags is None or tag in tags:
+                found.append(tag)
+                self.spans.append(start)
+                self.spans.append(end)
+        self.tags: str = "".join(found)
+        self._fields: list[LazyField | None] | None = None
+
+    def __len__(self) -> int:
+        return len(self.spans) // 2
+
+    def _entries(self) -> Iterator[tuple[str, int, int]]:
+        for i in range(len(self)):
+            yield self.tags[i * 3 : i * 3 + 3], self.spans[i * 2], self.spans[i * 2 + 1]
+
+    def has(self, tag: str) -> bool:
+        return any(self.tags[i : i + 3] == tag for i in range(0, len(self.tags), 3))
+
+    __contains__ = has
+
+    def control(self, tag: str) -> str | None:
+        """Value of the first control field with tag"""
+        for t, start, end in self._entries():
+            if t == tag:
+                return self.raw[start:end].decode("utf-8", "replace").strip()
+        return None
+
+    def subfields(self, tag: str, *codes: str) -> list[str]:
+        """Values of every tag$code subfield, in order"""
+        markers: tuple[bytes, ...] = tuple(c.encode("ascii") for c in codes)
+        values: list[str] = []
+        for t, start, end in self._entries():
+            if t == tag:
+                for subfield in self.raw[start:end].split(SD)[1:]:
+                    if subfield[:1] in markers:
+                        values.append(subfield[1:].decode("utf-8", "replace").strip())
+        return values
+
+    def subfield(self, tag: str, code: str) -> str | None:
+        """Value of the first tag$code subfield"""
+        values: list[str] = self.subfields(tag, code)
+        return values[0] if values else None
+
+    @property
+    def leader(self) -> str:
+        return self.raw[:24].decode("ascii", "replace")
+
+    def field(self, i: int) -> LazyField:
+        """The ith scanned field, decoded"""
+        if self._fields is None:
+            self._fields = [None] * len(self)
+        field: LazyField | None = self._fields[i]
+        if field is None:
+            field = LazyField(
+                self.tags[i * 3 : i * 3 + 3],
+                self.raw[self.spans[i * 2] : self.spans[i * 2 + 1]],
+                self.raw[9:10] != b"a",
+            )
+            self._fields[i] = field
+        return field
+
+    def get_fields(self, *tags: str) -> list[LazyField]:
+        """Fields with any of tags, or all the scanned fields"""
+        return [
+            self.field(i)
+            for i in range(len(self))
+            if not tags or self.tags[i * 3 : i * 3 + 3] in tags
+        ]
+
+    def get(self, tag: str, default=None):
+        """First field with tag"""
+        for i in range(len(self)):
+            if self.tags[i * 3 : i * 3 + 3] == tag:
+                return self.field(i)
+        return default
+
+    def __getitem__(self, tag: str) -> LazyField:
+        field: LazyField | None = self.get(tag)
+        if field is None:
+            raise KeyError(tag)
+        return field
+
+    @property
+    def title(self) -> str | None:
+        """245 $a and $b, like pymarc's Record.title"""
+        field: LazyField | None = self.get("245")
+        if not field:
+            return None
+        title: str | None = field.get("a")
+        if title:
+            subtitle: str | None = field.get("b")
+            if subtitle:
+                title += f" {subtitle}"
+        return title
+
+    @property
+    def isbn(self) -> str | None:
+        """First 020$a ISBN without hyphens or qualifiers, like pymarc's
+        Record.isbn"""
+        field: LazyField | None = self.get("020")
+        value: str | None = field.get("a") if field else None
+        match: re.Match | None = ISBN.search(value) if value else None
+        return match.group(1).replace("-", "") if match else None
+
+    def record(self) -> Record:
+        """pymarc Record of the scanned fields (and the leader). Decoding is
+        left to pymarc so it's the same as reading the whole record, it
+        raises the same exceptions for a record pymarc can't read."""
+        entries: list[bytes] = []
+        values: list[bytes] = []
+        position: int = 0
+        for tag, start, end in self._entries():
+            value: bytes = self.raw[start:end] + FT
+            entries.append(b"%s%04d%05d" % (tag.encode("ascii"), len(value), position))
+            values.append(value)
+            position += len(value)
+        base: int = 24 + 12 * len(entries) + 1
+        leader: bytes = (
+            b"%05d" % (base + position + 1)
+            + self.raw[5:12]
+            + b"%05d" % base
+            + self.raw[17:24]
+        )
+        return Record(data=leader + b"".join(entries) + FT + b"".join(values) + RT)
+
+
+# scan filter, e.g. has("856")
+Predicate = Callable[[ScannedRecord], bool]
+
+
+def has(*tags: str) -> Predicate:
+    """Filter for records with any of these tags"""
+    return lambda record: any(record.has(tag) for tag in tags)
+
+
+def subfield_in(tag: str, code: str, *values: str) -> Predicate:
+    """Filter for records whose first tag$code is one of values, ignoring
+    case, e.g. subfield_in("942", "n", "1", "true") for suppressed records"""
+    wanted: frozenset[str] = frozenset(v.casefold() for v in values)
+    return lambda record: (record.subfield(tag, code) or "").casefold() in wanted
+
+
+def scan(
+    fh: BinaryIO,
+    tags: Collection[str] | None = None,
+    where: Predicate | None = None,
+) -> Iterator[ScannedRecord]:
+    """ScannedRecords with only the given tags for the records in a MARC
+    stream that where() accepts. where only sees the scanned tags."""
+    tags = frozenset(tags) if tags is not None else None
+    for offset, raw in iter_raw(fh):
+        record = ScannedRecord(raw, tags, offset)
+        if where is None or where(record):
+            yield record
+
+
+def index_path(path: str | Path) -> Path:
+    """Sidecar path for a MARC file: records.mrc -> records.mrc.idx"""
+    return Path(f"{path}.idx")
+
+
+def _encode_keys(keys: list[str]) -> bytes:
+    data: bytes = "\n".join(keys).encode("utf-8")
+    return KEYS_LENGTH.pack(len(data)) + data
+
+
+def _decode_keys(fh: BinaryIO, count: int) -> list[str]:
+    (length,) = KEYS_LENGTH.unpack(fh.read(KEYS_LENGTH.size))
+    keys: list[str] = fh.read(length).decode("utf-8").split("\n") if count else []
+    return keys
+
+
+def _little_endian(a: array) -> array:
+    if sys.byteorder == "big":
+        a = array(a.typecode, a)
+        a.byteswap()
+    return a
+
+
+def build_index(path: str | Path, idx: str | Path | None = None) -> Path:
+    """Scan a MARC file once and write its .idx sidecar. Returns the sidecar path."""
+    if file_format(path) != "marc":
+        raise ValueError(f"{path} isn't binary MARC, only binary MARC can be indexed")
+    idx = Path(idx) if idx else index_path(path)
+    offsets = array("Q")
+    lengths = array("I")
+    ids: list[str] = []
+    biblionumbers: list[str] = []
+    with open_marc(path) as fh:
+        for offset, raw in iter_raw(fh):
+            offsets.append(offset)
+            lengths.append(len(raw))
+            ids.append(control_value(raw, "001") or "")
+            biblionumbers.append(subfield_value(raw, "999", "c") or "")
+    stat: os.stat_result = os.stat(path)
+    with open(idx, "wb") as out:
+        out.write(MAGIC)
+        out.write(HEADER.pack(stat.st_size, stat.st_mtime_ns, len(offsets)))
+        _little_endian(offsets).tofile(out)
+        _little_endian(lengths).tofile(out)
+        out.write(_encode_keys(ids))
+        out.write(_encode_keys(biblionumbers))
+    return idx
+
+
+class MARCIndex:
+    """Random access to the records of a MARC file through its .idx sidecar.
+
+    Use MARCIndex.open(path) to (re)build the sidecar when it is missing or
+    older than the MARC file. Lookups by 001 or 999$c only touch the index,
+    reading a record is a single seek + read. Offsets in compressed files are
+    positions in the decompressed stream, so seeking there is much slower.
+    """
+
+    def __init__(self, path: str | Path, idx: str | Path | None = None):
+        self.path = Path(path)
+        self.idx = Path(idx) if idx else index_path(path)
+        self.offsets = array("Q")
+        self.lengths = array("I")
+        with open(self.idx, "rb") as fh:
+            if fh.read(len(MAGIC)) != MAGIC:
+                raise ValueError(f"{self.idx} is not a MARC index file")
+            self.size, self.mtime_ns, count = HEADER.unpack(fh.read(HEADER.size))
+            self.offsets.fromfile(fh, count)
+            self.lengths.fromfile(fh, count)
+            self.ids: list[str] = _decode_keys(fh, count)
+            self.biblionumbers: list[str] = _decode_keys(fh, count)
+        if sys.byteorder == "big":
+            self.offsets.byteswap()
+            self.lengths.byteswap()
+        self._by_id: dict[str, list[int]] | None = None
+        self._by_biblionumber: dict[str, list[int]] | None = None
+        self._fh: BinaryIO | None = None
+
+    @classmethod
+    def open(cls, path: str | Path, idx: str | Path | None = None) -> "MARCIndex":
+        """Load the index for path, building it first if it's missing or stale"""
+        idx = Path(idx) if idx else index_path(path)
+        if not idx.exists():
+            build_index(path, idx)
+        index = cls(path, idx)
+        if not index.is_current():
+            build_index(path, idx)
+            index = cls(path, idx)
+        return index
+
+    def is_current(self) -> bool:
+        """Whether the MARC file is unchanged since the index was built"""
+        stat: os.stat_result = os.stat(self.path)
+        return stat.st_size == self.size and stat.st_mtime_ns == self.mtime_ns
+
+    def __len__(self) -> int:
+        return len(self.offsets)
+
+    def __enter__(self) -> "MARCIndex":
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+    def close(self) -> None:
+        if self._fh:
+            self._fh.close()
+            self._fh = None
+
+    def raw(self, i: int) -> bytes:
+        """Raw bytes of record i"""
+        if self._fh is None:
+            self._fh = open_marc(self.path)
+        self._fh.seek(self.offsets[i])
+        return self._fh.read(self.lengths[i])
+
+    def record(self, i: int) -> Record:
+        """Record i parsed with pymarc"""
+        return Record(data=self.raw(i))
+
+    def raws(
+        self, offset: int = 0, limit: int | None = None
+    ) -> Iterator[tuple[int, bytes]]:
+        """Yield (position, raw record) for limit records starting at offset"""
+        stop: int = len(self) if limit is None else min(offset + limit, len(self))
+        for i in range(offset, stop):
+            yield i, self.raw(i)
+
+    def records(
+        self, offset: int = 0, limit: int | None = None
+    ) -> Iterator[tuple[int, Record]]:
+        """Yield (position, record) for limit records starting at offset"""
+        for i, raw in self.raws(offset, limit):
+            yield i, Record(data=raw)
+
+    def find(self, record_id: str) -> list[int]:
+        """Positions of records whose 001 is record_id"""
+        if self._by_id is None:
+            self._by_id = _positions(self.ids)
+        return self._by_id.get(record_id, [])
+
+    def find_biblionumber(self, biblionumber: str) -> list[int]:
+        """Positions of records whose 999$c is biblionumber"""
+        if self._by_biblionumber is None:
+            self._by_biblionumber = _positions(self.biblionumbers)
+        return self._by_biblionumber.get(biblionumber, [])
+
+
+def _positions(keys: list[str]) -> dict[str, list[int]]:
+    positions: dict[str, list[int]] = {}
+    for i, key in enumerate(keys):
+        if key:
+            positions.setdefault(key, []).append(i)
+    return positions
+
+
+class MARCIndexTests:
+    @staticmethod
+    def make_raw(record_id: str, biblionumber: str) -> bytes:
+        return as_marc(
+            b"00000nam a2200000 a 4500",
+            [
+                ("001", record_id.encode()),
+                ("245", b"10" + SD + b"aTitle " + record_id.encode()),
+                ("999", b"  " + SD + b"c" + biblionumber.encode()),
+            ],
+        )
+
+    def test_iter_raw_offsets(self) -> None:
+        raws: list[bytes] = [self.make_raw(f"id{i}", str(10 + i)) for i in range(3)]
+        data: bytes = b"".join(raws)
+        offsets: list[int] = [0, len(raws[0]), len(raws[0]) + len(raws[1])]
+        self.assertEqual(list(iter_raw(io.BytesIO(data))), list(zip(offsets, raws)))
+        # a bad leader length resyncs on the record terminator
+        bad: bytes = data[: offsets[1]] + b"00030" + data[offsets[1] + 5 :]
+        found: list[tuple[int, bytes]] = list(iter_raw(io.BytesIO(bad)))
+        self.assertEqual([offset for offset, _ in found], offsets)
+        self.assertEqual(found[2][1], raws[2])
+        self.assertEqual(list(iter_raw(io.BytesIO(b""))), [])
+
+    def test_index_round_trip(self) -> None:
+        raws: list[bytes] = [self.make_raw(f"id{i}", str(10 + i)) for i in range(4)]
+        with tempfile.TemporaryDirectory() as tmp:
+            for name in ("records.mrc", "records.mrc.gz"):
+                path = Path(tmp) / name
+                with open_marc(path, "wb") as out:
+                    out.write(b"".join(raws[:3]))
+                with MARCIndex.open(path) as index:
+                    self.assertTrue(index_path(path).exists())
+                    self.assertEqual(len(index), 3)
+                    self.assertEqual([index.raw(i) for i in range(3)], raws[:3])
+                    self.assertEqual(
+                        list(index.raws(1, 5)), [(1, raws[1]), (2, raws[2])]
+                    )
+                    self.assertEqual(index.find("id2"), [2])
+                    self.assertEqual(index.find_biblionumber("11"), [1])
+                    self.assertEqual(index.find("id9"), [])
+                    self.assertEqual(index.record(0)["245"]["a"], "Title id0")
+                # a changed file makes the sidecar stale and open() rebuilds it
+                with open_marc(path, "wb") as out:
+                    out.write(b"".join(raws))
+                self.assertFalse(MARCIndex(path).is_current())
+                with MARCIndex.open(path) as index:
+                    self.assertTrue(index.is_current())
+                    self.assertEqual(index.raw(3), raws[3])
+            # positions outside the file are an error, not a traceback or wrap
+            runner = CliRunner()
+            for n in ("4", "-1"):
+                result = runner.invoke(cli, ["get", str(path), "-n", n])
+                self.assertEqual(result.exit_code, 1)
+                self.assertIn(f"no record {n}, {path} has 4", result.output)
+            result = runner.invoke(cli, ["get", str(path), "-n", "3"])
+            self.assertEqual(result.exit_code, 0)
+            self.assertIn("Title id3", result.output)
+            xml = Path(tmp) / "records.xml"
+            xml.write_text("<collection/>")
+            self.assertRaises(ValueError, build_index, xml)
+
+
+@click.group()
+@click.help_option("-h", "--help")
+def cli():
+    """Build or query .idx offset indexes for MARC files."""
+    pass
+
+
+@cli.command()
+@click.help_option("-h", "--help")
+@click.argument(
+    "file", metavar="<file.mrc>", type=click.Path(exists=True, dir_okay=False)
+)
+def build(file: Path) -> None:
+    """Write the <file.mrc>.idx sidecar"""
+    try:
+        idx: Path = build_index(file)
+    except ValueError as e:
+        raise click.ClickException(str(e))
+    click.echo(f"Indexed {len(MARCIndex(file, idx))} records to {idx}")
+
+
+@cli.command()
+@click.help_option("-h", "--help")
+@click.argument(
+    "file", metavar="<file.mrc>", type=click.Path(exists=True, dir_okay=False)
+)
+@click.option(
+    "-n", "--number", type=int, multiple=True, help="record position (0-based)"
+)
+@click.option("-i", "--id", "ids", multiple=True, help="001 control number")
+@click.option("-b", "--biblionumber", multiple=True, help="Koha 999$c biblionumber")
+def get(
+    file: Path,
+    number: tuple[int, ...],
+    ids: tuple[str, ...],
+    biblionumber: tuple[str, ...],
+) -> None:
+    """Print records by position, 001, or 999$c"""
+    try:
+        index: MARCIndex = MARCIndex.open(file)
+    except ValueError as e:
+        raise click.ClickException(str(e))
+    with index:
+        for i in number:
+            if not 0 <= i < len(index):
+                raise click.ClickException(f"no record {i}, {file} has {len(index)}")
+        positions: list[int] = list(number)
+        for record_id in ids:
+            positions.extend(index.find(record_id))
+        for bn in biblionumber:
+            positions.extend(index.find_biblionumber(bn))
+        if not positions:
+            click.echo("No matching records", err=True)
+        for i in positions:
+            click.echo(index.record(i))
+            click.echo("")
+
+
+cli.add_command(test_command(MARCIndexTests))
+
+
+if __name__ == "__main__":
+    cli()
@@ -0,0 +1,208 @@
+"""
+Open MARC files that may be compressed. Reading detects gzip, bzip2 and
+zstandard by their magic bytes so a misnamed file still works, writing picks
+the compression from the file extension (records.mrc.gz, records.mrc.zst).
+Once decompressed, a file's first byte tells binary MARC from MARCXML ("<")
+and MARC-in-JSON lines ("{"), see marc_formats.py.
+
+zstandard support needs the optional `zstandard` package.
+"""
+
+import bz2
+import gzip
+import hashlib
+from pathlib import Path
+from typing import BinaryIO
+
+# file extension -> compression name
+EXTENSIONS: dict[str, str] = {
+    ".gz": "gz",
+    ".bz2": "bz2",
+    ".zst": "zst",
+    ".zstd": "zst",
+}
+MAGIC: dict[bytes, str] = {
+    b"\x1f\x8b": "gz",
+    b"BZh": "bz2",
+    b"\x28\xb5\x2f\xfd": "zst",
+}
+MARC_EXTENSIONS: tuple[str, ...] = (".mrc", ".marc", ".xml", ".jsonl", ".ndjson")
+# first byte of a text format, after any byte order mark or blank lines
+TEXT_FORMATS: dict[bytes, str] = {b"<": "xml", b"{": "json"}
+BLANK = b"\xef\xbb\xbf \t\r\n"
+UNITS: dict[str, int] = {"": 1, "K": 1024, "M": 1024**2, "G": 1024**3}
+
+
+def parse_size(value: str) -> int:
+    """Parse a byte size like 500000, 500K, 20M or 1G"""
+    number: str = value.strip().upper().removesuffix("B")
+    unit: str = number[-1] if number and number[-1] in UNITS else ""
+    try:
+        return int(float(number.removesuffix(unit)) * UNITS[unit])
+    except ValueError:
+        raise ValueError(f"{value} is not a size like 500K or 20M")
+
+
+def compression_for(path: str | Path) -> str | None:
+    """Compression implied by a file name's extension, e.g. "gz" for x.mrc.gz"""
+    return EXTENSIONS.get(Path(path).suffix.lower())
+
+
+def is_marc_path(path: str | Path) -> bool:
+    """Whether a file name looks like a (possibly compressed) MARC, MARCXML or
+    MARC-in-JSON lines file"""
+    name: str = str(path).lower()
+    for ext in EXTENSIONS:
+        name = name.removesuffix(ext)
+    return name.endswith(MARC_EXTENSIONS)
+
+
+def text_format(head: bytes) -> str | None:
+    """ "xml" or "json" if the first bytes of a (decompressed) file are MARCXML
+    or MARC-in-JSON, None if they aren't, i.e. they're binary MARC"""
+    return TEXT_FORMATS.get(head.lstrip(BLANK)[:1])
+
+
+def read_head(fh: BinaryIO, size: int = 5) -> bytes:
+    """The first size bytes of a stream, or more if they're only a byte order
+    mark and whitespace, up to the first byte that isn't, so text_format()
+    sees it. A binary MARC leader starts with digits so it's read as is."""
+    head: bytes = fh.read(size)
+    while head and not head.lstrip(BLANK):
+        more: bytes = fh.read(64)
+        if not more:
+            break
+        head += more
+    return head
+
+
+def file_format(path: str | Path) -> str:
+    """ "marc", "xml" or "json", the format of a (possibly compressed) MARC file"""
+    with open_marc(path) as fh:
+        return text_format(read_head(fh)) or "marc"
+
+
+def _zstandard():
+    try:
+        import zstandard
+    except ImportError:
+        raise RuntimeError(
+            "Reading or writing .zst files requires the zstandard package: uv pip install zstandard"
+        )
+    return zstandard
+
+
+def sniff(fh: BinaryIO) -> str | None:
+    """Compression of a seekable binary stream, judged by its first bytes"""
+    start: int = fh.tell()
+    head: bytes = fh.read(4)
+    fh.seek(start)
+    for magic, compression in MAGIC.items():
+        if head.startswith(magic):
+            return compression
+    return None
+
+
+def decompress(fh: BinaryIO, compression: str | None) -> BinaryIO:
+    """Wrap a binary stream so reads return decompressed bytes"""
+    if compression == "gz":
+        return gzip.GzipFile(fileobj=fh, mode="rb")  # type: ignore
+    if compression == "bz2":
+        return bz2.BZ2File(fh, "rb")  # type: ignore
+    if compression == "zst":
+        return _zstandard().ZstdDecompressor().stream_reader(fh, closefd=True)
+    return fh
+
+
+def compress(fh: BinaryIO, compression: str | None) -> BinaryIO:
+    """Wrap a binary stream so writes are compressed. Closing the returned
+    stream finishes the compressed data but leaves fh open."""
+    if compression == "gz":
+        return gzip.GzipFile(fileobj=fh, mode="wb")  # type: ignore
+    if compression == "bz2":
+        return bz2.BZ2File(fh, "wb")  # type: ignore
+    if compression == "zst":
+        return _zstandard().ZstdCompressor().stream_writer(fh, closefd=False)
+    return fh
+
+
+def open_marc(path: str | Path, mode: str = "rb") -> BinaryIO:
+    """Open a MARC file for binary reading ("rb") or writing ("wb"), handling
+    .gz, .bz2 and .zst compression transparently."""
+    if mode == "rb":
+        fh: BinaryIO = open(path, "rb")
+        return decompress(fh, sniff(fh))
+    if mode == "wb":
+        compression: str | None = compression_for(path)
+        fh = open(path, "wb")
+        if compression:
+            return _ClosingWriter(compress(fh, compression), fh)
+        return fh
+    raise ValueError(f"open_marc mode must be 'rb' or 'wb', not {mode}")
+
+
+class _ClosingWriter:
+    """Compressed writer that also closes the underlying file"""
+
+    def __init__(self, writer: BinaryIO, fh: BinaryIO):
+        self.writer = writer
+        self.fh = fh
+
+    def write(self, data: bytes) -> int:
+        return self.writer.write(data)
+
+    def flush(self) -> None:
+        self.writer.flush()
+
+    def close(self) -> None:
+        self.writer.close()
+        self.fh.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+
+class DigestReader:
+    """Pass-through binary reader that counts, and SHA-256 hashes, the bytes
+    read through it plus the number of MARC records (record terminators), so
+    a file can be checked while it's being copied or uploaded."""
+
+    def __init__(self, fh: BinaryIO):
+        self.fh = fh
+        self.size: int = 0
+        self.records: int = 0
+        self.sha256 = hashlib.sha256()
+
+    def read(self, size: int = -1) -> bytes:
+        data: bytes = self.fh.read(size)
+        self.size += len(data)
+        self.records += data.count(b"\x1d")
+        self.sha256.update(data)
+        return data
+
+    def close(self) -> None:
+        self.fh.close()
+
+
+class DigestWriter:
+    """Pass-through binary writer that counts and SHA-256 hashes the bytes
+    written to the underlying file (i.e. after any compression)."""
+
+    def __init__(self, fh: BinaryIO):
+        self.fh = fh
+        self.size: int = 0
+        self.sha256 = hashlib.sha256()
+
+    def write(self, data: bytes) -> int:
+        self.size += len(data)
+        self.sha256.update(data)
+        return self.fh.write(data)
+
+    def flush(self) -> None:
+        self.fh.flush()
+
+    def close(self) -> None:
+        self.fh.close()
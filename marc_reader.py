@@ -0,0 +1,191 @@
+"""
+Decode raw MARC records into pymarc Records, whatever their character set.
+
+Records with leader/09 "a" are UTF-8 and go straight to pymarc. Anything else
+is MARC-8: pymarc converts MARC-8 one character at a time in Python, so we
+decode those records' fields as bytes and convert each subfield ourselves.
+Values that are plain ASCII (most of them) mean the same in MARC-8 and are
+used as is, the others are converted with pymarc's tables once per distinct
+value and cached, since the same publisher names, places and subjects repeat
+across a file. Converted records are marked as UTF-8 (leader/09 "a") like
+pymarc does when it writes them.
+
+Problems are reported per record instead of the record silently turning into
+None: characters pymarc can't map, invalid UTF-8, or why a record couldn't be
+decoded at all.
+"""
+
+import contextlib
+from functools import lru_cache
+import io
+import re
+from typing import BinaryIO, Iterator, NamedTuple
+
+import click
+from pymarc import Field, Record, Subfield
+from pymarc.marc8 import MARC8ToUnicode
+
+from marc_index import SD, iter_raw
+from match_keys import make_raw
+from profiling import stage, timed
+from testing import test_command
+
+# bytes that mean the same in MARC-8 and ASCII: printable, no escape sequences
+ASCII = re.compile(rb"[\x20-\x7e]*")
+
+
+class Decoded(NamedTuple):
+    offset: int
+    raw: bytes
+    # None if the record couldn't be decoded at all
+    record: Record | None
+    errors: list[str]
+
+
+@lru_cache(maxsize=65536)
+def _convert(value: bytes) -> tuple[str, str | None]:
+    # pymarc writes unmappable characters to stderr, keep them as the problem
+    messages = io.StringIO()
+    with contextlib.redirect_stderr(messages):
+        text: str = MARC8ToUnicode().translate(value)
+    return text, messages.getvalue().strip().replace("\n", "; ") or None
+
+
+def marc8_to_unicode(value: bytes) -> tuple[str, str | None]:
+    """Unicode (NFC) text of a MARC-8 value and a description of any
+    characters that couldn't be converted (they become spaces), or None"""
+    if ASCII.fullmatch(value):
+        return value.decode("ascii"), None
+    try:
+        return _convert(value)
+    except (IndexError, TypeError):
+        raise UnicodeDecodeError(
+            "marc8", value, 0, len(value), "invalid multibyte character encoding"
+        )
+
+
+def _utf8(raw: bytes) -> tuple[Record, list[str]]:
+    try:
+        return Record(data=raw), []
+    except UnicodeDecodeError as e:
+        record = Record(data=raw, utf8_handling="replace")
+        return record, [f"invalid UTF-8 ({e.reason}) replaced with �"]
+
+
+def _marc8(raw: bytes) -> tuple[Record, list[str]]:
+    record = Record(data=raw, to_unicode=False)
+    errors: list[str] = []
+    for i, field in enumerate(record.fields):
+        if field.control_field:
+            # pymarc reads MARC-8 control fields as Latin-1
+            record.fields[i] = Field(tag=field.tag, data=field.data.decode("iso8859-1"))
+            continue
+        subfields: list[Subfield] = []
+        for subfield in field.subfields:
+            try:
+                text, problem = marc8_to_unicode(subfield.value)
+            except UnicodeDecodeError as e:
+                raise ValueError(f"{field.tag}${subfield.code}: {e}")
+            if problem:
+                errors.append(f"{field.tag}${subfield.code}: {problem}")
+            subfields.append(Subfield(code=subfield.code, value=text))
+        record.fields[i] = Field(
+            tag=field.tag, indicators=field.indicators, subfields=subfields
+        )
+    record.to_unicode = True
+    record.leader.coding_scheme = "a"
+    return record, errors
+
+
+def decode(raw: bytes) -> tuple[Record | None, list[str]]:
+    """Decode a raw record, UTF-8 or MARC-8. Returns the record (None if it
+    can't be decoded) and a list of problems found decoding it."""
+    try:
+        if raw[9:10] == b"a":
+            return _utf8(raw)
+        return _marc8(raw)
+    except Exception as e:
+        return None, [str(e) or type(e).__name__]
+
+
+def read_records(fh: BinaryIO) -> Iterator[Decoded]:
+    """Decode every record in a MARC stream, including the ones that fail"""
+    for offset, raw in timed("read", iter_raw(fh)):
+        with stage("decode", 1):
+            record, errors = decode(raw)
+        yield Decoded(offset, raw, record, errors)
+
+
+class MarcReaderTests:
+    def test_ascii(self) -> None:
+        _convert.cache_clear()
+        self.assertEqual(
+            marc8_to_unicode(b"Paris : Gallimard, 1942."),
+            ("Paris : Gallimard, 1942.", None),
+        )
+        # plain ASCII values don't go through pymarc or the cache
+        self.assertEqual(_convert.cache_info().currsize, 0)
+
+    def test_convert(self) -> None:
+        _convert.cache_clear()
+        # MARC-8 diacritics come before the letter, Unicode is NFC
+        for _ in range(3):
+            self.assertEqual(marc8_to_unicode(b"Caf\xe2e"), ("Café", None))
+        info = _convert.cache_info()
+        self.assertEqual((info.misses, info.hits), (1, 2))
+        self.assertEqual(marc8_to_unicode(b"\xe8Uber"), ("Über", None))
+
+    def test_decode_marc8(self) -> None:
+        def raw(title: bytes, utf8: bool) -> bytes:
+            return make_raw(
+                [
+                    ("001", b"12345"),
+                    ("245", b"10" + SD + b"a" + title + SD + b"cAlbert Camus."),
+                ],
+                utf8,
+            )
+
+        record, errors = decode(raw(b"L'\xe2etranger", False))
+        self.assertEqual(errors, [])
+        self.assertEqual(record.leader[9], "a")  # type: ignore
+        self.assertEqual(
+            record.as_marc(),  # type: ignore
+            decode(raw("L'étranger".encode(), True))[0].as_marc(),  # type: ignore
+        )
+
+    def test_unconvertible(self) -> None:
+        # imported here, marc_runner imports this module
+        from marc_runner import transform_batch
+
+        raws: list[bytes] = [
+            make_raw([("245", b"10" + SD + b"aTitle")], utf8=False),
+            make_raw([("245", b"10" + SD + b"a\xd5Title")], utf8=False),
+        ]
+        results, events = transform_batch(
+            lambda record, n: record, list(enumerate(raws, 1))
+        )
+        # the character becomes a space and the record is kept
+        self.assertEqual(Record(data=results[1])["245"]["a"], " Title")  # type: ignore
+        self.assertEqual(
+            "".join(text for _, text in events),
+            "Warning: record 2: 245$a: Unable to parse character 0xd5 in g0=66 g1=69\n",
+        )
+        # a broken escape sequence loses the record, but says where
+        record, errors = decode(make_raw([("245", b"10" + SD + b"aTitle\x1b")], False))
+        self.assertIsNone(record)
+        self.assertEqual(len(errors), 1)
+        self.assertTrue(errors[0].startswith("245$a: 'marc8' codec can't decode"))
+
+
+@click.group()
+@click.help_option("-h", "--help")
+def cli():
+    """Decode MARC-8 and UTF-8 records, run with test to check it."""
+    pass
+
+
+cli.add_command(test_command(MarcReaderTests))
+
+
+if __name__ == "__main__":
+    cli()
@@ -0,0 +1,482 @@
+"""
+Run a per-record transform over a MARC file, optionally in a process pool.
+Raw records are read in batches, each batch is decoded and transformed by a
+worker, and the results are written in input order. Anything the transform
+prints (warnings about deleted records, invalid codes, etc.) is captured per
+batch and replayed in order too, so output looks the same as a serial run.
+
+A RecordCache remembers the output for each input record (by a hash of its
+bytes) so records that were already transformed in an earlier run can be
+skipped or have their output reused instead of being transformed again.
+"""
+
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor
+import contextlib
+from functools import partial
+from hashlib import blake2b
+import io
+import os
+from pathlib import Path
+import sqlite3
+import sys
+import tempfile
+from typing import Callable, Iterator
+
+import click
+from pymarc import Field, Indicators, Record, Subfield
+
+from marc_index import SD, directory, iter_raw
+from marc_io import open_marc
+from marc_reader import decode
+from match_keys import make_raw
+from profiling import stage, timed
+from testing import test_command
+
+# records per batch sent to a worker
+BATCH = 500
+
+# transform(record, position) -> record to write, or None to drop it.
+# position is the record's 1-based number in the input file.
+Transform = Callable[[Record, int], Record | None]
+# select(raw record) -> whether to transform it, others are copied as is
+Select = Callable[[bytes], bool]
+# (stream name, text) written by a transform
+Output = list[tuple[str, str]]
+
+CACHE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS records (
+    hash BLOB PRIMARY KEY,
+    version TEXT NOT NULL,
+    output BLOB NOT NULL
+);
+"""
+
+
+class _Capture(io.StringIO):
+    """Text stream that records writes, in order, with the stream's name"""
+
+    def __init__(self, name: str, events: Output):
+        super().__init__()
+        self.name = name
+        self.events = events
+
+    def write(self, text: str) -> int:
+        # reject bytes like a text stream does, click probes with write(b"")
+        if not isinstance(text, str):
+            raise TypeError("write() argument must be str")
+        self.events.append((self.name, text))
+        return len(text)
+
+
+class RecordCache:
+    """Transformed output of input records, keyed by a hash of the input
+    record's bytes. version identifies the transform (e.g. a hash of the
+    script) and entries from other versions are dropped, so changing the
+    transform invalidates the cache."""
+
+    def __init__(self, path: str | Path, version: str):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.version = version
+        self.db = sqlite3.connect(self.path)
+        with self.db:
+            self.db.executescript(CACHE_SCHEMA)
+            self.db.execute("DELETE FROM records WHERE version != ?", (version,))
+
+    def __enter__(self) -> "RecordCache":
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+    def close(self) -> None:
+        self.db.close()
+
+    @staticmethod
+    def key(raw: bytes) -> bytes:
+        return blake2b(raw, digest_size=16).digest()
+
+    def get(self, raw: bytes) -> bytes | None:
+        """Output for this input record, None if it hasn't been seen. A
+        record the transform dropped has empty output."""
+        row = self.db.execute(
+            "SELECT output FROM records WHERE hash = ?", (self.key(raw),)
+        ).fetchone()
+        return row[0] if row else None
+
+    def put(self, pairs: list[tuple[bytes, bytes]]) -> None:
+        """Remember the output of (input record, output) pairs"""
+        with self.db:
+            self.db.executemany(
+                "INSERT OR REPLACE INTO records VALUES (?, ?, ?)",
+                ((self.key(raw), self.version, out) for raw, out in pairs),
+            )
+
+
+def transform_batch(
+    transform: Transform,
+    raws: list[tuple[int, bytes]],
+    capture: bool = True,
+    select: Select | None = None,
+) -> tuple[list[bytes], Output]:
+    """Decode and transform a batch of (record number, raw record). Returns
+    each record's transformed bytes (empty if it was dropped or couldn't be
+    decoded) and what was printed while transforming them (unless capture
+    is False), including problems decoding a record. Records select()
+    rejects are returned byte for byte without being decoded. A transform
+    that raises is reported as a RuntimeError naming the record."""
+    events: Output = []
+    results: list[bytes] = []
+    streams = (
+        (
+            contextlib.redirect_stdout(_Capture("stdout", events)),
+            contextlib.redirect_stderr(_Capture("stderr", events)),
+        )
+        if capture
+        else ()
+    )
+    with contextlib.ExitStack() as stack:
+        for stream in streams:
+            stack.enter_context(stream)
+        for n, raw in raws:
+            if select:
+                with stage("select", 1):
+                    selected: bool = select(raw)
+                if not selected:
+                    results.append(raw)
+                    continue
+            with stage("decode", 1):
+                record, errors = decode(raw)
+            for error in errors:
+                print(f"Warning: record {n}: {error}", file=sys.stderr)
+            with stage("transform", 1):
+                try:
+                    result: Record | None = transform(record, n) if record else None
+                except Exception as e:
+                    raise RuntimeError(f"record {n}: {e!r}") from e
+            with stage("serialize", 1):
+                results.append(result.as_marc() if result is not None else b"")
+    return results, events
+
+
+def batches(fh, size: int = BATCH) -> Iterator[tuple[list[bytes], int]]:
+    """(raw records, number of the first) in batches of size"""
+    batch: list[bytes] = []
+    start: int = 1
+    for _, raw in timed("read", iter_raw(fh)):
+        batch.append(raw)
+        if len(batch) >= size:
+            yield batch, start
+            start += len(batch)
+            batch = []
+    if batch:
+        yield batch, start
+
+
+def replay(events: Output) -> None:
+    for name, text in events:
+        stream = sys.stdout if name == "stdout" else sys.stderr
+        stream.write(text)
+
+
+def run(
+    input: str | Path,
+    output: str | Path | None,
+    transform: Transform,
+    jobs: int = 1,
+    batch: int = BATCH,
+    cache: RecordCache | None = None,
+    reuse: bool = False,
+    select: Select | None = None,
+) -> tuple[int, int]:
+    """Transform every record of input, writing the results to output (if
+    not None) in input order. transform has to be picklable (a module level
+    function or functools.partial of one) when jobs > 1, 0 jobs means one per
+    CPU. Records found in cache aren't transformed again: they are skipped,
+    or with reuse their cached output is written. If select is given only
+    the records it accepts are decoded and transformed, the rest are copied
+    to output unchanged. Returns the number of (records written, records
+    found in the cache)."""
+    jobs = jobs or os.cpu_count() or 1
+    written: int = 0
+    cached: int = 0
+    out = open_marc(output, "wb") if output else None
+
+    def split(raws: list[bytes], start: int) -> tuple[list, list]:
+        """Cached output (or None) for each record, and the records to do"""
+        with stage("cache"):
+            hits: list[bytes | None] = [
+                cache.get(raw) if cache else None for raw in raws
+            ]
+        todo: list[tuple[int, bytes]] = [
+            (start + i, raw) for i, raw in enumerate(raws) if hits[i] is None
+        ]
+        return hits, todo
+
+    def emit(hits, todo, results: list[bytes], events: Output) -> None:
+        nonlocal written, cached
+        replay(events)
+        if cache:
+            with stage("cache"):
+                cache.put([(raw, data) for (_, raw), data in zip(todo, results)])
+        done = iter(results)
+        for hit in hits:
+            if hit is None:
+                data: bytes = next(done)
+            else:
+                cached += 1
+                if not reuse:
+                    continue
+                data = hit
+            if data:
+                if out:
+                    with stage("write", 1):
+                        out.write(data)
+                written += 1
+
+    try:
+        with open_marc(input) as fh:
+            if jobs == 1:
+                for raws, start in batches(fh, batch):
+                    hits, todo = split(raws, start)
+                    emit(
+                        hits,
+                        todo,
+                        *transform_batch(transform, todo, False, select),
+                    )
+                return written, cached
+            with ProcessPoolExecutor(jobs) as pool:
+                # a few batches in flight per worker, not the whole file
+                pending: deque[tuple[list, list, Future]] = deque()
+                for raws, start in batches(fh, batch):
+                    hits, todo = split(raws, start)
+                    pending.append(
+                        (
+                            hits,
+                            todo,
+                            pool.submit(transform_batch, transform, todo, True, select),
+                        )
+                    )
+                    if len(pending) >= jobs * 2:
+                        hits, todo, future = pending.popleft()
+                        emit(hits, todo, *future.result())
+                while pending:
+                    hits, todo, future = pending.popleft()
+                    emit(hits, todo, *future.result())
+    finally:
+        if out:
+            out.close()
+    return written, cached
+
+
+def _numbered(record: Record, n: int, fail: int = 0) -> Record | None:
+    """Transform for the tests: prints each record's number and title, warns
+    about every 3rd, drops every 4th, adds a 500 to the others and raises on
+    record number fail"""
+    if n == fail:
+        raise ValueError(record.title)
+    print(n, record.title)
+    if n % 3 == 0:
+        print(f"warning {n}", file=sys.stderr)
+    if n % 4 == 0:
+        return None
+    record.add_field(
+        Field(
+            tag="500",
+            indicators=Indicators(" ", " "),
+            subfields=[Subfield("a", f"record {n}")],
+        )
+    )
+    return record
+
+
+def _selected(raw: bytes) -> bool:
+    """select for the tests: only records with a 500"""
+    return any(tag == "500" for tag, _, _ in directory(raw))
+
+
+def make_file(path: Path, raws: list[bytes]) -> Path:
+    path.write_bytes(b"".join(raws))
+    return path
+
+
+def titled(n: int) -> bytes:
+    return make_raw([("001", str(n).encode()), ("245", b"10" + SD + b"aTitle %d" % n)])
+
+
+class MarcRunnerTests:
+    def run_captured(self, *args, **kwargs) -> tuple[tuple[int, int], str]:
+        """run() with stdout and stderr captured together, in order"""
+        out = io.StringIO()
+        with contextlib.redirect_stdout(out), contextlib.redirect_stderr(out):
+            counts: tuple[int, int] = run(*args, **kwargs)
+        return counts, out.getvalue()
+
+    def test_run_in_order(self) -> None:
+        with tempfile.TemporaryDirectory() as tmp:
+            input: Path = make_file(
+                Path(tmp) / "in.mrc", [titled(n) for n in range(1, 24)]
+            )
+            expected: str = "".join(
+                f"{n} Title {n}\n" + (f"warning {n}\n" if n % 3 == 0 else "")
+                for n in range(1, 24)
+            )
+            outputs: list[bytes] = []
+            for jobs in (1, 3):
+                output = Path(tmp) / f"out{jobs}.mrc"
+                counts, printed = self.run_captured(
+                    input, output, _numbered, jobs, batch=4
+                )
+                self.assertEqual(counts, (18, 0))
+                self.assertEqual(printed, expected)
+                outputs.append(output.read_bytes())
+            self.assertEqual(outputs[0], outputs[1])
+            with open(Path(tmp) / "out3.mrc", "rb") as fh:
+                records: list[Record] = [Record(data=raw) for _, raw in iter_raw(fh)]
+            self.assertEqual(
+                [(r["001"].data, r["500"]["a"]) for r in records],  # type: ignore
+                [(str(n), f"record {n}") for n in range(1, 24) if n % 4],
+            )
+
+    def test_failing_batch(self) -> None:
+        with tempfile.TemporaryDirectory() as tmp:
+            input: Path = make_file(
+                Path(tmp) / "in.mrc", [titled(n) for n in range(1, 24)]
+            )
+            for jobs in (1, 3):
+                output = Path(tmp) / f"out{jobs}.mrc"
+                with self.assertRaisesRegex(
+                    RuntimeError, r"^record 10: ValueError\('Title 10'\)$"
+                ):
+                    self.run_captured(
+                        input, output, partial(_numbered, fail=10), jobs, batch=4
+                    )
+                # the batches before the failing one are written
+                with open(output, "rb") as fh:
+                    self.assertEqual(
+                        [Record(data=raw)["001"].data for _, raw in iter_raw(fh)],  # type: ignore
+                        ["1", "2", "3", "5", "6", "7"],
+                    )
+
+    def test_select(self) -> None:
+        # records without a 500 are copied as is, even ones that can't be decoded
+        def with_500(n: int) -> bytes:
+            return make_raw(
+                [("245", b"10" + SD + b"aTitle %d" % n), ("500", b"  " + SD + b"aold")]
+            )
+
+        broken: bytes = titled(3)[:12] + b"99999" + titled(3)[17:]
+        raws: list[bytes] = [titled(1), with_500(2), broken, titled(4), with_500(5)]
+        with tempfile.TemporaryDirectory() as tmp:
+            input: Path = make_file(Path(tmp) / "in.mrc", raws)
+            for jobs in (1, 2):
+                output = Path(tmp) / f"out{jobs}.mrc"
+                counts, printed = self.run_captured(
+                    input, output, _numbered, jobs, batch=2, select=_selected
+                )
+                self.assertEqual(counts, (5, 0))
+                self.assertEqual(printed, "2 Title 2\n5 Title 5\n")
+                with open(output, "rb") as fh:
+                    written: list[bytes] = [raw for _, raw in iter_raw(fh)]
+                self.assertEqual(
+                    [written[0], written[2], written[3]], [raws[0], broken, raws[3]]
+                )
+                for n, raw in ((2, written[1]), (5, written[4])):
+                    self.assertEqual(
+                        [f.value() for f in Record(data=raw).get_fields("500")],
+                        ["old", f"record {n}"],
+                    )
+
+    def test_decode_errors(self) -> None:
+        raws: list[bytes] = [
+            titled(1),
+            make_raw([("001", b"2"), ("245", b"10" + SD + b"aTitle \xff2")]),
+            titled(3)[:12] + b"99999" + titled(3)[17:],
+        ]
+        with tempfile.TemporaryDirectory() as tmp:
+            input: Path = make_file(Path(tmp) / "in.mrc", raws)
+            for jobs in (1, 2):
+                output = Path(tmp) / f"out{jobs}.mrc"
+                counts, printed = self.run_captured(
+                    input, output, _numbered, jobs, batch=2
+                )
+                # the record that can't be decoded isn't written, the others are
+                self.assertEqual(counts, (2, 0))
+                self.assertEqual(
+                    printed,
+                    "1 Title 1\n"
+                    "Warning: record 2: invalid UTF-8 (invalid start byte) replaced with �\n"
+                    "2 Title �2\n"
+                    "Warning: record 3: Base address exceeds size of record\n",
+                )
+
+    def test_record_cache(self) -> None:
+        with tempfile.TemporaryDirectory() as tmp:
+            path = Path(tmp) / "data" / "cache.db"
+            with RecordCache(path, "v1") as cache:
+                self.assertIsNone(cache.get(b"one"))
+                cache.put([(b"one", b"ONE"), (b"dropped", b"")])
+                self.assertEqual(cache.get(b"one"), b"ONE")
+                self.assertEqual(cache.get(b"dropped"), b"")
+                self.assertIsNone(cache.get(b"two"))
+            with RecordCache(path, "v1") as cache:
+                self.assertEqual(cache.get(b"one"), b"ONE")
+            # another version drops the entries, they don't come back
+            with RecordCache(path, "v2") as cache:
+                self.assertIsNone(cache.get(b"one"))
+            with RecordCache(path, "v1") as cache:
+                self.assertIsNone(cache.get(b"one"))
+
+    def test_run_cached(self) -> None:
+        with tempfile.TemporaryDirectory() as tmp:
+            first: Path = make_file(
+                Path(tmp) / "1.mrc", [titled(n) for n in range(1, 9)]
+            )
+            # record 2 changed and a 9th added
+            second: Path = make_file(
+                Path(tmp) / "2.mrc",
+                [titled(1), titled(20)] + [titled(n) for n in range(3, 10)],
+            )
+            for jobs in (1, 2):
+                output = Path(tmp) / "out.mrc"
+                with RecordCache(Path(tmp) / f"{jobs}.db", "v1") as cache:
+                    counts, _ = self.run_captured(
+                        first, output, _numbered, jobs, 3, cache
+                    )
+                    self.assertEqual(counts, (6, 0))
+                    # only new or changed records are transformed and written
+                    counts, printed = self.run_captured(
+                        second, output, _numbered, jobs, 3, cache
+                    )
+                    self.assertEqual(counts, (2, 7))
+                    self.assertEqual(printed, "2 Title 20\n9 Title 9\nwarning 9\n")
+                    with open(output, "rb") as fh:
+                        self.assertEqual(
+                            [Record(data=raw).title for _, raw in iter_raw(fh)],
+                            ["Title 20", "Title 9"],
+                        )
+                    # reuse writes the cached output of the others, which is
+                    # what transforming them again would write
+                    counts, printed = self.run_captured(
+                        second, output, _numbered, jobs, 3, cache, reuse=True
+                    )
+                    self.assertEqual((counts, printed), ((7, 9), ""))
+                fresh = Path(tmp) / "fresh.mrc"
+                self.run_captured(second, fresh, _numbered, jobs, 3)
+                self.assertEqual(output.read_bytes(), fresh.read_bytes())
+
+
+@click.group()
+@click.help_option("-h", "--help")
+def cli():
+    """Process pool runner for comics_plus.py and split_lang_codes.py, run
+    with test to check it."""
+    pass
+
+
+cli.add_command(test_command(MarcRunnerTests))
+
+
+if __name__ == "__main__":
+    cli()
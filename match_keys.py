@@ -0,0 +1,242 @@
+"""
+Match keys for finding duplicate records. Each key function takes a raw MARC
+record and returns a list of normalized values (a record can have several
+ISBNs) so they can be put in a hash index without decoding the whole record.
+"""
+
+import re
+from typing import Callable
+import unicodedata
+
+import click
+
+from marc_index import (
+    SD,
+    ScannedRecord,
+    as_marc,
+    control_value,
+    directory,
+    subfield_values,
+)
+from testing import test_command
+
+# 035$a prefixes for OCLC numbers, e.g. (OCoLC)ocm12345678
+OCLC_PREFIX = re.compile(r"^\(OCoLC\)\s*(?:ocm|ocn|on)?\s*0*(\d+)", re.IGNORECASE)
+STOPWORDS: frozenset[str] = frozenset(["a", "an", "and", "the", "of", "in", "on"])
+
+
+def normalize_isbn(value: str) -> str | None:
+    """Normalize an ISBN to 13 digits, dropping qualifiers like "(pbk.)" and
+    hyphens. Returns None for values that aren't an ISBN-10 or ISBN-13."""
+    isbn: str = re.sub(r"[\s-]", "", value.split("(")[0]).upper()
+    isbn = re.match(r"[0-9X]*", isbn).group()  # type: ignore
+    if len(isbn) == 13 and isbn.isdigit():
+        return isbn
+    if len(isbn) == 10 and isbn[:9].isdigit():
+        core: str = "978" + isbn[:9]
+        total: int = sum(int(d) * (1 if i % 2 == 0 else 3) for i, d in enumerate(core))
+        return core + str((10 - total % 10) % 10)
+    return None
+
+
+def normalize_oclc(value: str) -> str | None:
+    """OCLC number from a 035$a like "(OCoLC)ocm00012345" -> "12345" """
+    match: re.Match | None = OCLC_PREFIX.match(value.strip())
+    return match.group(1) if match else None
+
+
+def control_number(raw: bytes) -> list[str]:
+    """The 001, if the record has exactly one"""
+    values: list[bytes] = [raw[s:e] for tag, s, e in directory(raw) if tag == "001"]
+    if len(values) == 1 and values[0]:
+        return [values[0].decode("utf-8", "replace")]
+    return []
+
+
+def isbns(raw: bytes) -> list[str]:
+    """Normalized ISBN-13s from 020$a"""
+    values = (normalize_isbn(v) for v in subfield_values(raw, "020", "a"))
+    return list(dict.fromkeys(v for v in values if v))
+
+
+def oclc_numbers(raw: bytes) -> list[str]:
+    """OCLC numbers from 035$a"""
+    values = (normalize_oclc(v) for v in subfield_values(raw, "035", "a"))
+    return list(dict.fromkeys(v for v in values if v))
+
+
+def biblionumbers(raw: bytes) -> list[str]:
+    """Koha biblionumber from 999$c"""
+    return subfield_values(raw, "999", "c")[:1]
+
+
+# name -> key function, for exact matching
+KEYS: dict[str, Callable[[bytes], list[str]]] = {
+    "001": control_number,
+    "isbn": isbns,
+    "oclc": oclc_numbers,
+    "biblionumber": biblionumbers,
+}
+
+
+def text_values(raw: bytes, tag: str, *codes: str) -> list[str]:
+    """subfield_values, but MARC-8 records (leader/09 not "a") are converted
+    to Unicode like a ScannedRecord's fields so keys built from text are the
+    same whichever encoding a copy of a record is in"""
+    if raw[9:10] == b"a":
+        return subfield_values(raw, tag, *codes)
+    return [
+        value.strip()
+        for field in ScannedRecord(raw, (tag,)).get_fields(tag)
+        for value in field.get_subfields(*codes)
+    ]
+
+
+def words(text: str) -> list[str]:
+    """Lowercase ASCII words with accents and punctuation removed"""
+    text = unicodedata.normalize("NFKD", text)
+    text = "".join(c for c in text if not unicodedata.combining(c))
+    return re.findall(r"[a-z0-9]+", text.lower())
+
+
+def title_tokens(raw: bytes) -> set[str]:
+    """Tokens for fuzzy matching: 245$a$b words, first author's surname and
+    the publication year. Empty if the record has no title."""
+    title: list[str] = [
+        w
+        for w in words(" ".join(text_values(raw, "245", "a", "b")))
+        if w not in STOPWORDS
+    ]
+    if not title:
+        return set()
+    tokens: set[str] = set(title)
+    for tag in ("100", "110", "111"):
+        author: list[str] = text_values(raw, tag, "a")
+        if author:
+            surname: list[str] = words(author[0].split(",")[0])
+            if surname:
+                tokens.add(f"author:{surname[0]}")
+            break
+    fixed: str | None = control_value(raw, "008")
+    year: str = fixed[7:11] if fixed else ""
+    if not year.isdigit():
+        dates: list[str] = text_values(raw, "264", "c") + text_values(raw, "260", "c")
+        found: list[str] = re.findall(r"\d{4}", " ".join(dates))
+        year = found[0] if found else ""
+    if year:
+        tokens.add(f"year:{year}")
+    return tokens
+
+
+def make_raw(fields: list[tuple[str, bytes]], utf8: bool = True) -> bytes:
+    """Raw record for the tests, leader/09 "a" or blank (MARC-8)"""
+    leader: bytes = b"00000nam a2200000 a 4500" if utf8 else b"00000nam  2200000 a 4500"
+    return as_marc(leader, fields)
+
+
+class MatchKeysTests:
+    def test_normalize_isbn(self) -> None:
+        for value in (
+            "0-306-40615-2 (pbk.)",
+            "0306406152 (v. 1-2)",
+            "978-0-306-40615-7",
+            "9780306406157 : $25.00",
+        ):
+            self.assertEqual(normalize_isbn(value), "9780306406157")
+        # ISBN-10 check digit X, upper or lower case
+        self.assertEqual(normalize_isbn("080442957x"), "9780804429573")
+        for value in ("", "12345", "(pbk.)", "97803064061", "ISBN 9780306406157"):
+            self.assertIsNone(normalize_isbn(value))
+
+    def test_normalize_oclc(self) -> None:
+        for value in (
+            "(OCoLC)ocm00012345",
+            "(OCoLC) 12345",
+            "(ocolc)ocn12345",
+            "  (OCoLC)on00012345  ",
+        ):
+            self.assertEqual(normalize_oclc(value), "12345")
+        self.assertEqual(normalize_oclc("(OCoLC)on1234567890"), "1234567890")
+        for value in ("", "(OCoLC)", "(DLC)12345", "ocm12345"):
+            self.assertIsNone(normalize_oclc(value))
+
+    def test_keys(self) -> None:
+        raw: bytes = make_raw(
+            [
+                ("001", b"ocm12345"),
+                ("020", b"  " + SD + b"a0306406152 (pbk.)"),
+                ("020", b"  " + SD + b"a978-0-306-40615-7" + SD + b"qhardcover"),
+                ("035", b"  " + SD + b"a(OCoLC)ocm00012345"),
+                ("035", b"  " + SD + b"a(DLC)  99012345"),
+                ("999", b"  " + SD + b"c4321" + SD + b"d4321"),
+            ]
+        )
+        keys: dict[str, list[str]] = {name: key(raw) for name, key in KEYS.items()}
+        self.assertEqual(
+            keys,
+            {
+                "001": ["ocm12345"],
+                "isbn": ["9780306406157"],
+                "oclc": ["12345"],
+                "biblionumber": ["4321"],
+            },
+        )
+        # two 001s aren't a usable control number
+        self.assertEqual(control_number(make_raw([("001", b"1"), ("001", b"2")])), [])
+
+    def test_marc8_title_tokens(self) -> None:
+        fixed: bytes = b"240101s2020    xxu           000 0 eng d"
+        utf8: bytes = make_raw(
+            [
+                ("008", fixed),
+                ("100", b"1 " + SD + "aMüller, Hans.".encode()),
+                ("245", b"10" + SD + "aThe café :".encode() + SD + b"ba novel"),
+            ]
+        )
+        # MARC-8 puts combining diacritics (0xE8 umlaut, 0xE2 acute) first
+        marc8: bytes = make_raw(
+            [
+                ("008", fixed),
+                ("100", b"1 " + SD + b"aM\xe8uller, Hans."),
+                ("245", b"10" + SD + b"aThe caf\xe2e :" + SD + b"ba novel"),
+            ],
+            utf8=False,
+        )
+        tokens: set[str] = {"cafe", "novel", "author:muller", "year:2020"}
+        self.assertEqual(title_tokens(utf8), tokens)
+        self.assertEqual(title_tokens(marc8), tokens)
+        self.assertEqual(text_values(marc8, "245", "a"), ["The café :"])
+        self.assertEqual(
+            title_tokens(make_raw([("100", b"1 " + SD + b"aNo title")])), set()
+        )
+
+    def test_similar_groups(self) -> None:
+        from lsh import jaccard, similar_groups
+
+        titles: list[bytes] = [
+            b"aThe history of color theory in design",
+            b"aHistory of colour theory in design",
+            b"aA field guide to the birds of California",
+            b"aThe history of color theory in design.",
+        ]
+        tokens: list[set[str]] = [
+            title_tokens(make_raw([("245", b"10" + SD + title)])) for title in titles
+        ]
+        self.assertEqual(jaccard(tokens[0], tokens[3]), 1.0)
+        self.assertEqual(jaccard(set(), set()), 0.0)
+        self.assertEqual(similar_groups(tokens), [[0, 3]])
+        self.assertEqual(similar_groups(tokens, threshold=0.6), [[0, 1, 3]])
+
+
+@click.group()
+@click.help_option("-h", "--help")
+def cli():
+    """Match keys for dupes.py, run with test to check them."""
+    pass
+
+
+cli.add_command(test_command(MatchKeysTests))
+
+
+if __name__ == "__main__":
+    cli()
@@ -0,0 +1,243 @@
+"""
+Profiling for the command line tools. With `--profile FILE` a command runs
+under cProfile and writes its stats to FILE (`python -m pstats FILE` or
+snakeviz to look at them), then prints the wall & CPU time, records/second
+and peak traced memory of each stage of the run (read, decode, transform,
+validate, write...) so it's clear where the time goes.
+
+Stages are marked in the code with `with stage("transform", 1): ...` or by
+wrapping an iterator in timed(). Outside a profiled run these return a shared
+do-nothing context or the iterator itself, so marking hot loops costs next to
+nothing. A stage's time doesn't include the stages nested in it. cProfile and
+tracemalloc slow everything down, so compare stages with each other rather
+than with an unprofiled run. With --jobs only the main process is profiled:
+work done by worker processes doesn't appear, and summon_update.py's upload
+threads are timed separately so their stages overlap.
+"""
+
+import cProfile
+import functools
+import sys
+import threading
+import time
+import tracemalloc
+from typing import Callable, Iterable, Iterator, TypeVar
+
+import click
+
+T = TypeVar("T")
+
+# the profile of the running command, None unless it has --profile
+_profile: "Profile | None" = None
+
+
+class Stats:
+    """Totals for one stage"""
+
+    __slots__ = ("records", "wall", "cpu", "peak")
+
+    def __init__(self):
+        self.records: int = 0
+        self.wall: float = 0.0
+        self.cpu: float = 0.0
+        self.peak: int = 0
+
+
+class Stage:
+    """A stage being timed. records can be added to until it exits."""
+
+    __slots__ = (
+        "profile",
+        "stats",
+        "records",
+        "wall",
+        "cpu",
+        "child_wall",
+        "child_cpu",
+    )
+
+    def __init__(self, profile: "Profile", stats: Stats, records: int):
+        self.profile = profile
+        self.stats = stats
+        self.records = records
+        self.child_wall: float = 0.0
+        self.child_cpu: float = 0.0
+
+    def __enter__(self) -> "Stage":
+        stack: list[Stage] = self.profile.stack()
+        if stack:
+            self.profile.mark_peak(stack[-1].stats)
+        stack.append(self)
+        self.wall = time.perf_counter()
+        self.cpu = time.thread_time()
+        return self
+
+    def __exit__(self, *args) -> None:
+        wall: float = time.perf_counter() - self.wall
+        cpu: float = time.thread_time() - self.cpu
+        stack: list[Stage] = self.profile.stack()
+        stack.pop()
+        stats: Stats = self.stats
+        stats.records += self.records
+        stats.wall += wall - self.child_wall
+        stats.cpu += cpu - self.child_cpu
+        peak: int = self.profile.mark_peak(stats)
+        if stack:
+            parent: Stage = stack[-1]
+            parent.child_wall += wall
+            parent.child_cpu += cpu
+            parent.stats.peak = max(parent.stats.peak, peak)
+
+
+class _NoStage:
+    """stage() outside a profiled run. It's one shared instance, used from
+    several threads by summon_update.py, so it keeps no state: records can
+    be set like a Stage's but always reads 0."""
+
+    __slots__ = ()
+
+    @property
+    def records(self) -> int:
+        return 0
+
+    @records.setter
+    def records(self, value: int) -> None:
+        pass
+
+    def __enter__(self) -> "_NoStage":
+        return self
+
+    def __exit__(self, *args) -> None:
+        pass
+
+
+NO_STAGE = _NoStage()
+
+
+class Profile:
+    """Profile everything run inside `with Profile(path):`"""
+
+    def __init__(self, path: str):
+        self.path = path
+        self.stages: dict[str, Stats] = {}
+        self.local = threading.local()
+        self.profiler = cProfile.Profile()
+        self.peak: int = 0
+
+    def stack(self) -> list[Stage]:
+        """Stages entered, innermost last, in the current thread"""
+        try:
+            return self.local.stack
+        except AttributeError:
+            self.local.stack = []
+            return self.local.stack
+
+    def mark_peak(self, stats: Stats) -> int:
+        """Count the traced memory peak since the last mark towards stats"""
+        peak: int = tracemalloc.get_traced_memory()[1]
+        tracemalloc.reset_peak()
+        stats.peak = max(stats.peak, peak)
+        self.peak = max(self.peak, peak)
+        return peak
+
+    def stage(self, name: str, records: int = 0) -> Stage:
+        stats: Stats | None = self.stages.get(name)
+        if stats is None:
+            stats = self.stages[name] = Stats()
+        return Stage(self, stats, records)
+
+    def __enter__(self) -> "Profile":
+        global _profile
+        _profile = self
+        tracemalloc.start()
+        self.wall = time.perf_counter()
+        self.cpu = time.process_time()
+        self.profiler.enable()
+        return self
+
+    def __exit__(self, *args) -> None:
+        global _profile
+        self.profiler.disable()
+        wall: float = time.perf_counter() - self.wall
+        cpu: float = time.process_time() - self.cpu
+        self.peak = max(self.peak, tracemalloc.get_traced_memory()[1])
+        tracemalloc.stop()
+        _profile = None
+        self.profiler.dump_stats(self.path)
+        self.report(wall, cpu)
+
+    def report(self, wall: float, cpu: float) -> None:
+        def row(name: str, records: int, wall: float, cpu: float, peak: int) -> str:
+            rate: str = f"{records / wall:.0f}" if records and wall > 0 else "-"
+            return (
+                f"{name:<16}{records or '-':>10}{wall:>10.2f}{cpu:>10.2f}"
+                f"{rate:>12}{peak / 1024**2:>10.1f}"
+            )
+
+        lines: list[str] = [
+            f"{'stage':<16}{'records':>10}{'wall s':>10}{'cpu s':>10}"
+            f"{'records/s':>12}{'peak MB':>10}"
+        ]
+        for name, s in self.stages.items():
+            lines.append(row(name, s.records, s.wall, s.cpu, s.peak))
+        # time spent outside any stage: startup, setup, reporting... stages
+        # running in parallel threads can add up to more than the total
+        lines.append(
+            row(
+                "other",
+                0,
+                max(wall - sum(s.wall for s in self.stages.values()), 0.0),
+                max(cpu - sum(s.cpu for s in self.stages.values()), 0.0),
+                0,
+            )
+        )
+        records: int = max((s.records for s in self.stages.values()), default=0)
+        lines.append(row("total", records, wall, cpu, self.peak))
+        lines.append(
+            f"Wrote profile to {self.path}, see it with: python -m pstats {self.path}"
+        )
+        print("\n".join(lines), file=sys.stderr)
+
+
+def stage(name: str, records: int = 0) -> Stage | _NoStage:
+    """Time the code in a `with` block as stage name, which handled records"""
+    if _profile is None:
+        return NO_STAGE
+    return _profile.stage(name, records)
+
+
+def _timed(profile: Profile, name: str, iterable: Iterable[T]) -> Iterator[T]:
+    iterator: Iterator[T] = iter(iterable)
+    while True:
+        with profile.stage(name) as s:
+            try:
+                item: T = next(iterator)
+            except StopIteration:
+                return
+            s.records = 1
+        yield item
+
+
+def timed(name: str, iterable: Iterable[T]) -> Iterator[T]:
+    """iterable with the time taken to produce each item timed as stage name"""
+    if _profile is None:
+        return iter(iterable)
+    return _timed(_profile, name, iterable)
+
+
+def profile_option(command: Callable) -> Callable:
+    """Decorator adding --profile to a click command"""
+
+    @functools.wraps(command)
+    def profiled(*args, profile: str | None = None, **kwargs):
+        if not profile:
+            return command(*args, **kwargs)
+        with Profile(profile):
+            return command(*args, **kwargs)
+
+    return click.option(
+        "--profile",
+        metavar="FILE",
+        help="write cProfile stats to FILE and print time & memory per stage",
+        type=click.Path(dir_okay=False, writable=True),
+    )(profiled)
@@ -1,525 +1,20 @@
 # a lot our 041 language codes are all stuffed into one $a subfield
 # instead of a separate $a for each language code
 # 041 1_ $aengjpn -> 041 1_ $aeng$ajpn
-import sys
-import unittest
+import contextlib
+from functools import partial
+import io
 from pathlib import Path
-from typing import Any, Literal, Set
+from typing import Any, Set
 
 import click
-from pymarc import Field, Indicators, MARCReader, MARCWriter, Record, Subfield
-
-# List of ISO 639.2 language codes
-# https://www.loc.gov/standards/iso639-2/php/code_list.php
-codes: list[str] = [
-    "aar",
-    "abk",
-    "ace",
-    "ach",
-    "ada",
-    "ady",
-    "afa",
-    "afh",
-    "afr",
-    "ain",
-    "aka",
-    "akk",
-    "alb",
-    "ale",
-    "alg",
-    "alt",
-    "amh",
-    "ang",
-    "anp",
-    "apa",
-    "ara",
-    "arc",
-    "arg",
-    "arm",
-    "arn",
-    "arp",
-    "art",
-    "arw",
-    "asm",
-    "ast",
-    "ath",
-    "aus",
-    "ava",
-    "ave",
-    "awa",
-    "aym",
-    "aze",
-    "bad",
-    "bai",
-    "bak",
-    "bal",
-    "bam",
-    "ban",
-    "baq",
-    "bas",
-    "bat",
-    "bej",
-    "bel",
-    "bem",
-    "ben",
-    "ber",
-    "bho",
-    "bih",
-    "bik",
-    "bin",
-    "bis",
-    "bla",
-    "bnt",
-    "tib",
-    "bos",
-    "bra",
-    "bre",
-    "btk",
-    "bua",
-    "bug",
-    "bul",
-    "bur",
-    "byn",
-    "cad",
-    "cai",
-    "car",
-    "cat",
-    "cau",
-    "ceb",
-    "cel",
-    "cze",
-    "cha",
-    "chb",
-    "che",
-    "chg",
-    "chi",
-    "chk",
-    "chm",
-    "chn",
-    "cho",
-    "chp",
-    "chr",
-    "chu",
-    "chv",
-    "chy",
-    "cmc",
-    "cnr",
-    "cop",
-    "cor",
-    "cos",
-    "cpe",
-    "cpf",
-    "cpp",
-    "cre",
-    "crh",
-    "crp",
-    "csb",
-    "cus",
-    "wel",
-    "cze",
-    "dak",
-    "dan",
-    "dar",
-    "day",
-    "del",
-    "den",
-    "ger",
-    "dgr",
-    "din",
-    "div",
-    "doi",
-    "dra",
-    "dsb",
-    "dua",
-    "dum",
-    "dut",
-    "dyu",
-    "dzo",
-    "efi",
-    "egy",
-    "eka",
-    "gre",
-    "elx",
-    "eng",
-    "enm",
-    "epo",
-    "est",
-    "baq",
-    "ewe",
-    "ewo",
-    "fan",
-    "fao",
-    "per",
-    "fat",
-    "fij",
-    "fil",
-    "fin",
-    "fiu",
-    "fon",
-    "fre",
-    "fre",
-    "frm",
-    "fro",
-    "frr",
-    "frs",
-    "fry",
-    "ful",
-    "fur",
-    "gaa",
-    "gay",
-    "gba",
-    "gem",
-    "geo",
-    "ger",
-    "gez",
-    "gil",
-    "gla",
-    "gle",
-    "glg",
-    "glv",
-    "gmh",
-    "goh",
-    "gon",
-    "gor",
-    "got",
-    "grb",
-    "grc",
-    "gre",
-    "grn",
-    "gsw",
-    "guj",
-    "gwi",
-    "hai",
-    "hat",
-    "hau",
-    "haw",
-    "heb",
-    "her",
-    "hil",
-    "him",
-    "hin",
-    "hit",
-    "hmn",
-    "hmo",
-    "hrv",
-    "hsb",
-    "hun",
-    "hup",
-    "arm",
-    "iba",
-    "ibo",
-    "ice",
-    "ido",
-    "iii",
-    "ijo",
-    "iku",
-    "ile",
-    "ilo",
-    "ina",
-    "inc",
-    "ind",
-    "ine",
-    "inh",
-    "ipk",
-    "ira",
-    "iro",
-    "ice",
-    "ita",
-    "jav",
-    "jbo",
-    "jpn",
-    "jpr",
-    "jrb",
-    "kaa",
-    "kab",
-    "kac",
-    "kal",
-    "kam",
-    "kan",
-    "kar",
-    "kas",
-    "geo",
-    "kau",
-    "kaw",
-    "kaz",
-    "kbd",
-    "kha",
-    "khi",
-    "khm",
-    "kho",
-    "kik",
-    "kin",
-    "kir",
-    "kmb",
-    "kok",
-    "kom",
-    "kon",
-    "kor",
-    "kos",
-    "kpe",
-    "krc",
-    "krl",
-    "kro",
-    "kru",
-    "kua",
-    "kum",
-    "kur",
-    "kut",
-    "lad",
-    "lah",
-    "lam",
-    "lao",
-    "lat",
-    "lav",
-    "lez",
-    "lim",
-    "lin",
-    "lit",
-    "lol",
-    "loz",
-    "ltz",
-    "lua",
-    "lub",
-    "lug",
-    "lui",
-    "lun",
-    "luo",
-    "lus",
-    "mac",
-    "mad",
-    "mag",
-    "mah",
-    "mai",
-    "mak",
-    "mal",
-    "man",
-    "mao",
-    "map",
-    "mar",
-    "mas",
-    "may",
-    "mdf",
-    "mdr",
-    "men",
-    "mga",
-    "mic",
-    "min",
-    "mis",
-    "mac",
-    "mkh",
-    "mlg",
-    "mlt",
-    "mnc",
-    "mni",
-    "mno",
-    "moh",
-    "mon",
-    "mos",
-    "mao",
-    "may",
-    "mul",
-    "mun",
-    "mus",
-    "mwl",
-    "mwr",
-    "bur",
-    "myn",
-    "myv",
-    "nah",
-    "nai",
-    "nap",
-    "nau",
-    "nav",
-    "nbl",
-    "nde",
-    "ndo",
-    "nds",
-    "nep",
-    "new",
-    "nia",
-    "nic",
-    "niu",
-    "dut",
-    "nno",
-    "nob",
-    "nog",
-    "non",
-    "nor",
-    "nqo",
-    "nso",
-    "nub",
-    "nwc",
-    "nya",
-    "nym",
-    "nyn",
-    "nyo",
-    "nzi",
-    "oci",
-    "oji",
-    "ori",
-    "orm",
-    "osa",
-    "oss",
-    "ota",
-    "oto",
-    "paa",
-    "pag",
-    "pal",
-    "pam",
-    "pan",
-    "pap",
-    "pau",
-    "peo",
-    "per",
-    "phi",
-    "phn",
-    "pli",
-    "pol",
-    "pon",
-    "por",
-    "pra",
-    "pro",
-    "pus",
-    "qaa",
-    "que",
-    "raj",
-    "rap",
-    "rar",
-    "roa",
-    "roh",
-    "rom",
-    "rum",
-    "rum",
-    "run",
-    "rup",
-    "rus",
-    "sad",
-    "sag",
-    "sah",
-    "sai",
-    "sal",
-    "sam",
-    "san",
-    "sas",
-    "sat",
-    "scn",
-    "sco",
-    "sel",
-    "sem",
-    "sga",
-    "sgn",
-    "shn",
-    "sid",
-    "sin",
-    "sio",
-    "sit",
-    "sla",
-    "slo",
-    "slo",
-    "slv",
-    "sma",
-    "sme",
-    "smi",
-    "smj",
-    "smn",
-    "smo",
-    "sms",
-    "sna",
-    "snd",
-    "snk",
-    "sog",
-    "som",
-    "son",
-    "sot",
-    "spa",
-    "alb",
-    "srd",
-    "srn",
-    "srp",
-    "srr",
-    "ssa",
-    "ssw",
-    "suk",
-    "sun",
-    "sus",
-    "sux",
-    "swa",
-    "swe",
-    "syc",
-    "syr",
-    "tah",
-    "tai",
-    "tam",
-    "tat",
-    "tel",
-    "tem",
-    "ter",
-    "tet",
-    "tgk",
-    "tgl",
-    "tha",
-    "tib",
-    "tig",
-    "tir",
-    "tiv",
-    "tkl",
-    "tlh",
-    "tli",
-    "tmh",
-    "tog",
-    "ton",
-    "tpi",
-    "tsi",
-    "tsn",
-    "tso",
-    "tuk",
-    "tum",
-    "tup",
-    "tur",
-    "tut",
-    "tvl",
-    "twi",
-    "tyv",
-    "udm",
-    "uga",
-    "uig",
-    "ukr",
-    "umb",
-    "und",
-    "urd",
-    "uzb",
-    "vai",
-    "ven",
-    "vie",
-    "vol",
-    "vot",
-    "wak",
-    "wal",
-    "war",
-    "was",
-    "wel",
-    "wen",
-    "wln",
-    "wol",
-    "xal",
-    "xho",
-    "yao",
-    "yap",
-    "yid",
-    "yor",
-    "ypk",
-    "zap",
-    "zbl",
-    "zen",
-    "zgh",
-    "zha",
-    "chi",
-    "znd",
-    "zul",
-    "zun",
-    "zxx",
-    "zza",
-]
+from pymarc import Field, Indicators, Record, Subfield
+
+from lang_codes import CODES, check_008, split
+from marc_index import SD, ScannedRecord, directory
+from marc_runner import run
+from profiling import profile_option
+from testing import test_command
 
 
 def sort_subfield_codes(code_list: list[str]) -> tuple[Set[str], Set[str]]:
@@ -527,7 +22,7 @@ def sort_subfield_codes(code_list: list[str]) -> tuple[Set[str], Set[str]]:
     invalid_codes: Set[str] = set()
     valid_codes: Set[str] = set()
     for code in code_list:
-        if code not in codes:
+        if code not in CODES:
             invalid_codes.add(code)
         else:
             valid_codes.add(code)
@@ -546,64 +41,101 @@ def copy_non_a_subfields(original_field: Field, new_field: Field) -> None:
 
 
 def split_lang_codes(record: Record, debug: bool = False) -> Record:
-    """Split multiple language codes in 041 $a into separate subfields"""
+    """Split multiple language codes in 041 $a into separate subfields, then
+    check the 008/35-37 language against them"""
+    # $a codes of the 041s using MARC language codes, None if there are none
+    language_codes: list[str] | None = None
     for field in record.get_fields("041"):
         # only process fields that use the MARC language codes
         if field.indicator2 == " ":
             if debug:
                 click.echo(f"Processing field {field}")
-
-            # sort subfields into categories
-            invalid_codes, valid_codes = sort_subfield_codes(field.get_subfields("a"))
-
-            if invalid_codes:
-                if debug:
-                    click.echo(f"Invalid subfield values: {invalid_codes}")
-
-                for code in invalid_codes:
-                    if len(code) % 3 == 0:
-                        for i in range(0, len(code), 3):
-                            # this step also fixes uppercase codes
-                            split_code: str = code[i : i + 3].lower()
-                            if split_code in codes:
-                                valid_codes.add(split_code)
-                            # we have a number of records using the wrong code for Japanese
-                            elif split_code == "jap":
-                                valid_codes.add("jpn")
-                            elif split_code == "esk":
-                                # NOTE: assumes language is Inuktitut & not another Inuit language
-                                # like Iñupiaq (ipk). This is true for our collection though & Inuktitut
-                                # is the most common. Note that `iku` also covers Inuinnaqtun.
-                                # https://en.wikipedia.org/wiki/Eskaleut_languages#Internal_classification
-                                valid_codes.add("iku")
-                            else:
-                                click.echo(
-                                    f"Warning: unrecognized language code {split_code} after splitting {field} in record {record.title}. This code will be removed from the record.",
-                                    err=True,
-                                )
-                    else:
-                        click.echo(
-                            f"Warning: length of language code {code} in {field} in record {record.title} is not divisible by 3 so we don't know how to split it into valid codes. It will be removed from the record.",
-                            err=True,
-                        )
-                if len(valid_codes):
-                    new_field: Field = Field(
-                        tag="041",
-                        indicators=field.indicators,
-                        subfields=[
-                            Subfield(code="a", value=code) for code in valid_codes
-                        ],
+            if language_codes is None:
+                language_codes = []
+
+            values: list[str] = field.get_subfields("a")
+            invalid_codes, _ = sort_subfield_codes(values)
+            if not invalid_codes:
+                language_codes.extend(values)
+                continue
+            if debug:
+                click.echo(f"Invalid subfield values: {invalid_codes}")
+
+            # valid codes in field order, split ones in place of the originals
+            valid_codes: dict[str, None] = {}
+            for value in values:
+                result = split(value)
+                valid_codes.update(dict.fromkeys(result.codes))
+                if not result.divisible:
+                    click.echo(
+                        f"Warning: length of language code {value} in {field} in record {record.title} is not divisible by 3 so we don't know how to split it into valid codes. It will be removed from the record.",
+                        err=True,
+                    )
+                for piece in result.unrecognized:
+                    click.echo(
+                        f"Warning: unrecognized language code {piece} after splitting {field} in record {record.title}. This code will be removed from the record.",
+                        err=True,
                     )
-                    copy_non_a_subfields(field, new_field)
 
-                if debug:
-                    click.echo(f"New field: {new_field}")
+            new_field: Field | None = None
+            if valid_codes:
+                new_field = Field(
+                    tag="041",
+                    indicators=field.indicators,
+                    subfields=[Subfield(code="a", value=code) for code in valid_codes],
+                )
+                copy_non_a_subfields(field, new_field)
+            if debug:
+                click.echo(f"New field: {new_field}")
+
+            record.remove_field(field)
+            if new_field:
+                record.add_ordered_field(new_field)
+            language_codes.extend(valid_codes)
+
+    fixed: Field | None = record.get("008")
+    if language_codes is not None and fixed and fixed.data and len(fixed.data) >= 38:
+        problem: str | None = check_008(fixed.data[35:38], language_codes)
+        if problem:
+            click.echo(f"Warning: {problem} in record {record.title}", err=True)
+    return record
 
-                record.remove_field(field)
-                if "new_field" in locals():
-                    record.add_ordered_field(new_field)
 
-    return record
+def needs_fix(raw: bytes) -> bool:
+    """Whether split_lang_codes() would change a raw record, i.e. it has a
+    041 with a blank 2nd indicator and an $a that isn't a valid code, checked
+    without decoding the record. Records that don't need fixing have their
+    008/35-37 checked against their 041 $a codes here, split_lang_codes()
+    checks the rest once their codes are split."""
+    codes: list[str] | None = None
+    fixed: str | None = None
+    for tag, start, end in directory(raw):
+        if tag == "008" and fixed is None:
+            fixed = raw[start:end].decode("ascii", "replace")
+        if tag != "041":
+            continue
+        field: bytes = raw[start:end]
+        if field[1:2] != b" ":
+            continue
+        if codes is None:
+            codes = []
+        for subfield in field.split(SD)[1:]:
+            if subfield[:1] == b"a":
+                code: str = subfield[1:].decode("utf-8", "replace")
+                if code not in CODES:
+                    return True
+                codes.append(code)
+    if codes is not None and fixed and len(fixed) >= 38:
+        problem: str | None = check_008(fixed[35:38], codes)
+        if problem:
+            title: str | None = ScannedRecord(raw, ("245",)).title
+            click.echo(f"Warning: {problem} in record {title}", err=True)
+    return False
+
+
+def fix_record(record: Record, n: int, debug: bool = False) -> Record:
+    """split_lang_codes() as a marc_runner transform"""
+    return split_lang_codes(record, debug)
 
 
 def make_041(subfields: list[tuple[str, str]]) -> Field:
@@ -622,7 +154,7 @@ def make_record(subfields: list[tuple[str, str]]) -> Record:
     return r
 
 
-class SplitLangCodesTests(unittest.TestCase):
+class SplitLangCodesTests:
     def test_sort_subfield_codes(self) -> None:
         # 1 valid, 1 invalid
         i, v = sort_subfield_codes(["eng", "xxx"])
@@ -738,15 +270,65 @@ class SplitLangCodesTests(unittest.TestCase):
         assert len(r.get("041").get_subfields("a")) == 1  # type: ignore
         assert "en" in r.get("041").get_subfields("a")  # type: ignore
 
+    def test_lang_codes(self) -> None:
+        assert split("engjpn").codes == ("eng", "jpn")
+        # uppercase and deprecated codes are normalized
+        assert split("ENGjap").codes == ("eng", "jpn")
+        assert split("esk").codes == ("iku",)
+        assert split("engxyz").unrecognized == ("xyz",)
+        assert not split("english").divisible
+        # 008/35-37
+        assert check_008("eng", ["eng", "fre"]) is None
+        assert check_008("   ", ["eng"]) is None
+        assert check_008("mul", ["eng", "fre"]) is None
+        assert check_008("jap", ["jpn"]) is not None
+        assert check_008("xyz", ["eng"]) is not None
+        assert check_008("spa", ["eng"]) is not None
+
+    def test_needs_fix(self) -> None:
+        # valid codes, nothing to fix
+        assert not needs_fix(make_record([("a", "eng"), ("a", "fre")]).as_marc())
+        # combined codes
+        assert needs_fix(make_record([("a", "engspa")]).as_marc())
+        assert needs_fix(make_record([("a", "kor"), ("a", "oijasidojaisd")]).as_marc())
+        # invalid codes outside $a aren't changed
+        assert not needs_fix(make_record([("a", "eng"), ("h", "gerfre")]).as_marc())
+        # non-MARC codes (2nd indicator is not null)
+        r = Record()
+        r.add_field(
+            Field(
+                tag="041",
+                indicators=Indicators("1", "7"),
+                subfields=[Subfield(code="a", value="en")],
+            )
+        )
+        assert not needs_fix(r.as_marc())
+        # no 041 at all
+        r = Record()
+        r.add_field(Field(tag="001", data="123"))
+        assert not needs_fix(r.as_marc())
 
-def run_tests(verbose: bool) -> Literal[0, 1]:
-    loader = unittest.TestLoader()
-    suite: unittest.TestSuite = loader.loadTestsFromTestCase(SplitLangCodesTests)
-    runner = unittest.TextTestRunner(verbosity=2 if verbose else 0)
-    result: unittest.TextTestResult = runner.run(suite)
-
-    # Return 0 for success, 1 for failures
-    return 0 if result.wasSuccessful() else 1
+    def test_needs_fix_008(self) -> None:
+        # records with valid 041s are checked against their 008 as they're selected
+        r: Record = make_record([("a", "eng"), ("a", "fre")])
+        r.add_ordered_field(Field(tag="008", data=" " * 35 + "spa d"))
+        r.add_ordered_field(
+            Field(
+                tag="245",
+                indicators=Indicators("0", "0"),
+                subfields=[Subfield(code="a", value="Title")],
+            )
+        )
+        err = io.StringIO()
+        with contextlib.redirect_stderr(err):
+            assert not needs_fix(r.as_marc())
+        assert "008/35-37 spa is not one of the 041 $a codes eng fre" in err.getvalue()
+        assert "in record Title" in err.getvalue()
+        r["008"].data = " " * 35 + "eng d"  # type: ignore
+        err = io.StringIO()
+        with contextlib.redirect_stderr(err):
+            assert not needs_fix(r.as_marc())
+        assert not err.getvalue()
 
 
 @click.group()
@@ -769,27 +351,33 @@ def cli():
     type=click.Path(dir_okay=False, writable=True),
     required=False,
 )
-@click.option("--debug", "-d", is_flag=True, help="Print changes, do not write to file")
-def fix(input: Path, output: Path, debug: bool) -> None:
+@click.option(
+    "--debug",
+    "-d",
+    is_flag=True,
+    help="Print changes to the records that need fixing, do not write to file",
+)
+@click.option(
+    "--jobs",
+    "-j",
+    default=1,
+    show_default=True,
+    help="process records with this many processes (0 for one per CPU)",
+    type=click.IntRange(min=0),
+)
+@profile_option
+def fix(input: Path, output: Path, debug: bool, jobs: int) -> None:
     """Fix input records"""
-    with open(input, "rb") as input_fh:
-        if output:
-            writer = MARCWriter(open(output, "wb"))
-        reader = MARCReader(input_fh)
-        for record in reader:
-            if record:
-                new_record: Record = split_lang_codes(record, debug)
-                if not debug and output:
-                    writer.write(new_record)
-        if output:
-            writer.close()
+    run(
+        input,
+        None if debug else output,
+        partial(fix_record, debug=debug),
+        jobs,
+        select=needs_fix,
+    )
 
 
-@cli.command()
-@click.option("--verbose", "-v", is_flag=True, help="more verbose test output")
-def test(verbose: bool):
-    """Run the test suite."""
-    sys.exit(run_tests(verbose))
+cli.add_command(test_command(SplitLangCodesTests))
 
 
 if __name__ == "__main__":
@@ -8,7 +8,9 @@ import csv
 from datetime import datetime
 import hashlib
 import hmac
+from itertools import islice
 import os
+from pathlib import Path
 import re
 import signal
 import sys
@@ -17,8 +19,17 @@ from typing import List
 from urllib.parse import urlencode, quote_plus, unquote_plus
 
 from dotenv import dotenv_values
-from pymarc import Field, MARCReader, Record
-import requests
+
+from marc_index import (
+    LazyField,
+    MARCIndex,
+    ScannedRecord,
+    index_path,
+    scan,
+    subfield_in,
+)
+from marc_io import file_format, is_marc_path, open_marc
+from profiling import Profile, stage, timed
 
 config: dict = {
     **dotenv_values(".env"),  # load shared development variables
@@ -26,6 +37,11 @@ config: dict = {
 }
 config["ACCEPT"] = "application/json"
 config["PATH"] = "/2.0.0/search"
+# the only fields we use, the rest of each record isn't decoded, and these
+# are only decoded when they're used
+TAGS: tuple[str, ...] = ("020", "100", "245", "942", "999")
+# suppressed records 942$n = 1
+suppressed = subfield_in("942", "n", "1", "true")
 
 summary: dict[str, int] = {
     "Records": 0,
@@ -136,6 +152,9 @@ def search(params) -> list[dict]:
     # Summon API connection errors are common
     # TODO retry with a delay in between?
     time.sleep(1)
+    # requests is slow to import, only load it when we search
+    import requests
+
     try:
         response: requests.Response = requests.get(url, headers=headers)
         response.raise_for_status()
@@ -170,14 +189,14 @@ def get_first_author(record) -> str | None:
     Get author from MARC record. Pymarc's record.author includes identifier &
     dates which messes up Summon query.
     """
-    author: list[Field] = record.get_fields("100")
+    author: list[LazyField] = record.get_fields("100")
     if len(author):
         return author[0].get_subfields("a")[0]
     else:
         return None
 
 
-def make_query(record: Record) -> dict[str, str]:
+def make_query(record: ScannedRecord) -> dict[str, str]:
     """
     Create Summon query string from MARC record.
     """
@@ -259,52 +278,66 @@ def process_marc(file) -> None:
     """
     Parse MARC file and search for items.
     """
-    missing: list[Record] = []
-    reader = MARCReader(open(file, "rb"))
-    for i, record in enumerate(reader):
-        if args.limit and i >= args.limit:
-            break
-        if record:
-            # skip suppressed records 942$n = 1
-            try:
-                suppressed: str = record.get_fields("942")[0].get_subfields("n")[0]
-                if suppressed == "1" or suppressed.lower() == "true":
-                    continue
-            except IndexError:
-                pass
-
-            summary["Records"] += 1
-
-            isbn_fields: List[Field] = record.get_fields("020")
-            isbn_subfields: List[List[str]] = [
-                field.get_subfields("a") for field in isbn_fields
-            ]
-            isbns: List[str] = [
-                num_only(isbn) for sublist in isbn_subfields for isbn in sublist
-            ]
-            summary["Had ISBN"] += 1 if len(isbns) else 0
-
-            params: dict[str, str] = make_query(record)
-            docs: list[dict] = search(params)
-            if args.debug:
-                result(docs)
-
-            summary["Found"] += 1 if len(docs) else 0
-            if len(isbns):
-                for doc in docs:
-                    if has_match(doc.get("ISBN", []), isbns):
-                        summary["ISBN Matches"] += 1
-                        break
-                else:
-                    if args.missing:
-                        missing.append(record)
-
-        else:
-            summary["Malformed Records"] += 1
+    missing: list[ScannedRecord] = []
+    if args.offset and file_format(file) == "marc":
+        # seek straight to the first record using the .idx sidecar
+        idx: Path = index_path(file)
+        built: int | None = idx.stat().st_mtime_ns if idx.exists() else None
+        source = MARCIndex.open(file)
+        if idx.stat().st_mtime_ns != built:
+            print(f"Wrote record index {idx}", file=sys.stderr)
+        records = (
+            ScannedRecord(raw, TAGS) for _, raw in source.raws(args.offset, args.limit)
+        )
+    else:
+        source = open_marc(file)
+        records = scan(source, TAGS)
+        if args.offset:
+            # MARCXML & MARC-in-JSON can't be indexed, read past the first records
+            records = islice(records, args.offset, None)
+    with source:
+        for i, record in enumerate(timed("read", records)):
+            if args.limit and i >= args.limit:
+                break
+            # skip suppressed records before decoding them
+            if suppressed(record):
+                continue
+            if record.valid:
+                summary["Records"] += 1
+
+                with stage("parse", 1):
+                    isbn_fields: List[LazyField] = record.get_fields("020")
+                    isbn_subfields: List[List[str]] = [
+                        field.get_subfields("a") for field in isbn_fields
+                    ]
+                    isbns: List[str] = [
+                        num_only(isbn) for sublist in isbn_subfields for isbn in sublist
+                    ]
+                    summary["Had ISBN"] += 1 if len(isbns) else 0
+
+                    params: dict[str, str] = make_query(record)
+                with stage("search", 1):
+                    docs: list[dict] = search(params)
+                if args.debug:
+                    result(docs)
+
+                summary["Found"] += 1 if len(docs) else 0
+                if len(isbns):
+                    for doc in docs:
+                        if has_match(doc.get("ISBN", []), isbns):
+                            summary["ISBN Matches"] += 1
+                            break
+                    else:
+                        if args.missing:
+                            missing.append(record)
+
+            else:
+                summary["Malformed Records"] = summary.get("Malformed Records", 0) + 1
 
     summarize()
     if args and args.missing:
-        write_missing(missing)
+        with stage("write", len(missing)):
+            write_missing(missing)
 
 
 def quote_if_unquoted(s: str) -> str:
@@ -326,7 +359,7 @@ def signal_handler(sig, frame) -> None:
 def main() -> None:
     # if cli arg looks like a MARC file, parse it & search for items
     # otherwise treat as a title string for search
-    if args.query.endswith(".mrc") or args.query.endswith(".marc"):
+    if is_marc_path(args.query):
         process_marc(args.query)
     elif len(args.query) > 0:
         params = {
@@ -336,8 +369,8 @@ def main() -> None:
         result(search(params))
 
 
-if __name__ == "__main__":
-    parser = argparse.ArgumentParser(description="Find items in Summon")
+def cli(argv: list[str] | None = None, prog: str | None = None) -> None:
+    parser = argparse.ArgumentParser(prog=prog, description="Find items in Summon")
     parser.add_argument(
         "query",
         metavar="<file.mrc or title string>",
@@ -347,6 +380,13 @@ if __name__ == "__main__":
     parser.add_argument(
         "-l", "--limit", type=int, help="Number of searches to run", metavar="N"
     )
+    parser.add_argument(
+        "-o",
+        "--offset",
+        type=int,
+        help="Skip the first N records (uses a .idx sidecar, see marc_index.py)",
+        metavar="N",
+    )
     parser.add_argument(
         "-d",
         "--debug",
@@ -359,9 +399,22 @@ if __name__ == "__main__":
         help="write list of missing records to CSV file",
         metavar="missing.csv",
     )
+    parser.add_argument(
+        "--profile",
+        help="write cProfile stats to FILE and print time & memory per stage",
+        metavar="FILE",
+    )
     global args
-    args: argparse.Namespace = parser.parse_args()
+    args = parser.parse_args(argv)
 
     # catch SIGINT and print summary
     signal.signal(signal.SIGINT, signal_handler)
-    main()
+    if args.profile:
+        with Profile(args.profile):
+            main()
+    else:
+        main()
+
+
+if __name__ == "__main__":
+    cli()
@@ -1,14 +1,32 @@
 # puts MARC file to our Summon SFTP server
 # https://knowledge.exlibrisgroup.com/Summon/Product_Documentation/Configuring_The_Summon_Service/Working_with_Local_Collections_in_the_Summon_Service/Getting_Local_Collections_Loaded_into_the_Summon_Index/Summon%3A_Exporting_Catalog_Holdings_-_Uploading_to_Summon
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
+from hashlib import blake2b, sha256
+import json
 import logging
 import os
-from typing import Literal
+from pathlib import Path
+import re
+import sqlite3
+import tempfile
+import threading
+import time
+from typing import TYPE_CHECKING, Literal
 
 import click
+from click.testing import CliRunner
 from dotenv import dotenv_values
-from pymarc import MARCReader, Record
-import pysftp
+from pymarc import Field, Record, Subfield
+
+from marc_index import SD, iter_raw
+from marc_io import DigestReader, file_format, is_marc_path, open_marc
+from match_keys import biblionumbers, control_number, make_raw
+from profiling import profile_option, stage, timed
+from testing import test_option
+
+if TYPE_CHECKING:
+    import pysftp
 
 config = {
     **dotenv_values(".env"),  # load shared development variables
@@ -29,69 +47,823 @@ console.setFormatter(formatter)
 logging.getLogger("summon_update").addHandler(console)
 logger: logging.Logger = logging.getLogger("summon_update")
 
-# fix pysftp bug "AttributeError: 'Connection' object has no attribute '_sftp_live'"
-cnopts = pysftp.CnOpts()
-cnopts.hostkeys = None
+# remember remote names of unfinished uploads so a re-run resumes them
+STATE_FILE = Path(config.get("SUMMON_UPLOAD_STATE", "data/summon_uploads.json"))
+CHUNK: int = 32768
+state_lock = threading.Lock()
+# what was last uploaded, for --delta
+SNAPSHOT_FILE = Path(config.get("SUMMON_SNAPSHOT", "data/summon_snapshot.db"))
+SNAPSHOT_SCHEMA = """
+CREATE TABLE IF NOT EXISTS records (
+    biblionumber TEXT PRIMARY KEY,
+    hash BLOB NOT NULL,
+    control_number TEXT
+);
+"""
+# snapshot rows are written in batches of this size
+BATCH = 5000
 
 
-def rename(filetype: str) -> str:
+def rename(filetype: str, part: int | None = None) -> str:
     """rename MARC file using Summon CDI conventions
 
     Args:
         filetype (str): type of update (deletes, updates, full)
+        part (int | None): number of the file when uploading several at once
 
     Returns:
         str: filename formatted for Summon SFTP server
     """
-    return f"cca-catalog-{filetype}-{datetime.now().strftime('%F-%H-%M-%S')}.mrc"
+    suffix: str = f"-{part}" if part else ""
+    return (
+        f"cca-catalog-{filetype}-{datetime.now().strftime('%F-%H-%M-%S')}{suffix}.mrc"
+    )
+
+
+def manifest_count(file_path: str) -> int | None:
+    """Record count from a break.py manifest.json next to the file, if there is
+    one listing this file at its current size. Saves re-reading the file.
+    """
+    path = Path(file_path)
+    manifest: Path = path.parent / "manifest.json"
+    if not manifest.exists():
+        return None
+    with open(manifest) as fh:
+        files: list[dict] = json.load(fh).get("files", [])
+    for entry in files:
+        if entry.get("file") == path.name and entry.get("bytes") == path.stat().st_size:
+            return entry.get("records")
+    return None
+
+
+def looks_like_marc(file_path: str) -> bool:
+    """Whether the file starts with a plausible MARC leader (record length,
+    indicator & subfield code counts, base address)"""
+    with open_marc(file_path) as fh:
+        leader: bytes = fh.read(24)
+    return (
+        len(leader) == 24
+        and leader[:5].isdigit()
+        and leader[10:12] == b"22"
+        and leader[12:17].isdigit()
+    )
+
+
+def natural_key(path: Path) -> list[int | str]:
+    return [int(p) if p.isdigit() else p for p in re.split(r"(\d+)", path.name)]
+
+
+def expand(paths: tuple[str, ...]) -> list[str]:
+    """Files to upload, directories (like break.py output) are expanded to
+    the MARC files in them"""
+    files: list[str] = []
+    for path in map(Path, paths):
+        if path.is_dir():
+            # natural sort so records-2.mrc comes before records-10.mrc
+            files.extend(
+                str(f)
+                for f in sorted(path.iterdir(), key=natural_key)
+                if is_marc_path(f)
+            )
+        else:
+            files.append(str(path))
+    return files
+
+
+def state_key(file_path: str) -> str:
+    stat: os.stat_result = os.stat(file_path)
+    return f"{Path(file_path).resolve()}:{stat.st_size}:{stat.st_mtime_ns}"
+
+
+def load_state() -> dict[str, str]:
+    if STATE_FILE.exists():
+        with open(STATE_FILE) as fh:
+            return json.load(fh)
+    return {}
+
+
+def save_state(key: str, remote_path: str | None) -> None:
+    """Record (or forget, if remote_path is None) an upload's remote path"""
+    with state_lock:
+        state: dict[str, str] = load_state()
+        if remote_path:
+            state[key] = remote_path
+        else:
+            state.pop(key, None)
+        STATE_FILE.parent.mkdir(parents=True, exist_ok=True)
+        with open(STATE_FILE, "w") as fh:
+            json.dump(state, fh, indent=2)
+
+
+class Sessions:
+    """One SFTP connection per upload thread, reused for all of its files"""
+
+    def __init__(self, debug: Literal[1, None] = None):
+        self.debug = debug
+        self.local = threading.local()
+        self.connections: list["pysftp.Connection"] = []
+        self.lock = threading.Lock()
+
+    def get(self) -> "pysftp.Connection":
+        sftp: pysftp.Connection | None = getattr(self.local, "sftp", None)
+        if sftp is None:
+            # pysftp (paramiko) is slow to import, only load it to connect
+            import pysftp
+
+            # fix pysftp bug "AttributeError: 'Connection' object has no attribute '_sftp_live'"
+            cnopts = pysftp.CnOpts()
+            cnopts.hostkeys = None
+            sftp = pysftp.Connection(
+                cnopts=cnopts,
+                host=config["SUMMON_SFTP_HOST"],
+                log=self.debug,  # type: ignore
+                port=int(config.get("SUMMON_SFTP_PORT", 22)),
+                private_key=config["SUMMON_SFTP_KEY"],
+                username=config["SUMMON_SFTP_USER"],
+            )
+            self.local.sftp = sftp
+            with self.lock:
+                self.connections.append(sftp)
+        return sftp
+
+    def reset(self) -> None:
+        """Drop this thread's connection after an error, the next get()
+        reconnects"""
+        sftp: pysftp.Connection | None = getattr(self.local, "sftp", None)
+        self.local.sftp = None
+        if sftp is not None:
+            try:
+                sftp.close()
+            except Exception:
+                pass
+
+    def close(self) -> None:
+        for sftp in self.connections:
+            try:
+                sftp.close()
+            except Exception:
+                pass
+
+
+def delete_stub(biblionumber: str, control: str | None) -> bytes:
+    """Minimal deleted (leader/05 "d") record identifying a biblionumber"""
+    record = Record(leader="00000dam a2200000 a 4500")
+    if control:
+        record.add_field(Field(tag="001", data=control))
+    record.add_field(
+        Field(
+            tag="999",
+            indicators=[" ", " "],  # type: ignore
+            subfields=[Subfield(code="c", value=biblionumber)],
+        )
+    )
+    return record.as_marc()
+
+
+class Snapshot:
+    """Content hash of every record last uploaded to Summon, keyed by
+    biblionumber, so a new full export can be reduced to what changed"""
+
+    def __init__(self, path: str | Path):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.db = sqlite3.connect(self.path)
+        self.db.executescript(SNAPSHOT_SCHEMA)
+
+    def __enter__(self) -> "Snapshot":
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+    def close(self) -> None:
+        self.db.close()
+
+    def __len__(self) -> int:
+        return self.db.execute("SELECT count(*) FROM records").fetchone()[0]
+
+    def delta(
+        self, export: str, updates: Path | None, deletes: Path | None
+    ) -> tuple[int, int, int]:
+        """Compare a full export to the snapshot, writing new & changed
+        records (and any without a 999$c, which can't be tracked) to updates
+        and deleted stubs for biblionumbers missing from the export to
+        deletes. Either path can be None to only compare. The export's
+        hashes are staged until commit(). Returns the number of (updated,
+        deleted, unchanged) records."""
+        updated: int = 0
+        unchanged: int = 0
+        self.db.execute("DROP TABLE IF EXISTS temp.pending")
+        self.db.execute(
+            "CREATE TEMP TABLE pending (biblionumber TEXT PRIMARY KEY, hash BLOB, control_number TEXT)"
+        )
+        rows: list[tuple[str, bytes, str | None]] = []
+        out = open_marc(updates, "wb") if updates else None
+        try:
+            with open_marc(export) as fh:
+                for _, raw in timed("read", iter_raw(fh)):
+                    # flushed here so unchanged records, which skip the
+                    # rest of the loop, don't pile up
+                    if len(rows) >= BATCH:
+                        self._stage(rows)
+                        rows = []
+                    with stage("compare", 1):
+                        bn: list[str] = biblionumbers(raw)
+                        digest: bytes = blake2b(raw, digest_size=16).digest()
+                        if bn:
+                            control: list[str] = control_number(raw)
+                            rows.append(
+                                (bn[0], digest, control[0] if control else None)
+                            )
+                            old = self.db.execute(
+                                "SELECT hash FROM records WHERE biblionumber = ?", bn
+                            ).fetchone()
+                            if old and old[0] == digest:
+                                unchanged += 1
+                                continue
+                    if out:
+                        with stage("write", 1):
+                            out.write(raw)
+                    updated += 1
+            self._stage(rows)
+        finally:
+            if out:
+                out.close()
+
+        deleted: int = 0
+        missing = self.db.execute("""SELECT biblionumber, control_number FROM records
+            WHERE biblionumber NOT IN (SELECT biblionumber FROM pending)""")
+        out = open_marc(deletes, "wb") if deletes else None
+        try:
+            for biblionumber, control in missing:
+                if out:
+                    out.write(delete_stub(biblionumber, control))
+                deleted += 1
+        finally:
+            if out:
+                out.close()
+        return updated, deleted, unchanged
+
+    def _stage(self, rows: list[tuple[str, bytes, str | None]]) -> None:
+        self.db.executemany("INSERT OR REPLACE INTO pending VALUES (?, ?, ?)", rows)
+
+    def commit(self) -> None:
+        """Make the export compared by delta() the new snapshot, once its
+        updates & deletes have been uploaded"""
+        with self.db:
+            self.db.execute("DELETE FROM records")
+            self.db.execute("INSERT INTO records SELECT * FROM pending")
+        self.db.execute("DROP TABLE pending")
+
+
+def remote_size(sftp, remote_path: str) -> int:
+    try:
+        return sftp.stat(remote_path).st_size or 0
+    except IOError:
+        return 0
+
+
+def upload(sftp, file_path: str, remote_path: str) -> tuple[DigestReader, int]:
+    """Upload file_path to remote_path, resuming after whatever part of it is
+    already on the server. Records are counted and the bytes hashed as they
+    go (the resumed part is read locally so the totals cover the whole file).
+    Compressed files are decompressed since Summon wants plain MARC.
+    Returns the reader with the totals and the number of bytes resumed.
+    """
+    resumed: int = remote_size(sftp, remote_path)
+    with open_marc(file_path) as fh:
+        reader = DigestReader(fh)
+        remaining: int = resumed
+        while remaining > 0:
+            data: bytes = reader.read(min(CHUNK, remaining))
+            if not data:
+                break
+            remaining -= len(data)
+        with sftp.open(remote_path, "r+" if resumed else "w") as remote:
+            remote.set_pipelined(True)
+            remote.seek(resumed)
+            while data := reader.read(CHUNK):
+                remote.write(data)
+    uploaded: int = remote_size(sftp, remote_path)
+    if uploaded != reader.size:
+        raise IOError(f"{remote_path} is {uploaded} bytes, expected {reader.size}")
+    return reader, resumed
+
+
+def put_one(sessions: Sessions, file_path: str, remote_path: str, retries: int) -> bool:
+    """Upload one file with retries, each retry resumes the partial upload"""
+    key: str = state_key(file_path)
+    save_state(key, remote_path)
+    count: int | None = manifest_count(file_path)
+    if count:
+        logger.info(f"Number of records in {file_path}: {count}")
+    for attempt in range(retries + 1):
+        start: float = time.monotonic()
+        try:
+            with stage("upload") as timing:
+                reader, resumed = upload(sessions.get(), file_path, remote_path)
+                timing.records = reader.records
+        except Exception as e:
+            sessions.reset()
+            logger.warning(
+                f"Upload of {file_path} failed (attempt {attempt + 1} of {retries + 1}): {e}"
+            )
+            time.sleep(2**attempt)
+            continue
+        elapsed: float = max(time.monotonic() - start, 1e-6)
+        sent: int = reader.size - resumed
+        logger.info(
+            f"File {file_path} put to {remote_path}"
+            + (f" (resumed at byte {resumed})" if resumed else "")
+            + f", {sent / elapsed / 1024**2:.2f} MB/s"
+        )
+        if count is None:
+            logger.info(f"Number of records in {file_path}: {reader.records}")
+        elif count != reader.records:
+            logger.warning(
+                f"Uploaded {reader.records} records but manifest.json says {count}"
+            )
+        logger.info(
+            f"Uploaded {reader.size} bytes, SHA-256 {reader.sha256.hexdigest()}"
+        )
+        save_state(key, None)
+        return True
+    logger.error(f"Giving up on {file_path}, re-run to resume it")
+    return False
+
+
+def put_all(
+    files: list[str], remote_paths: list[str], debug, jobs: int, retries: int
+) -> bool:
+    """Upload files over up to `jobs` SFTP sessions, True if all succeeded"""
+    if not files:
+        return True
+    # unfinished uploads of the same files keep their remote names so they resume
+    state: dict[str, str] = load_state()
+    remote_paths = [state.get(state_key(f)) or r for f, r in zip(files, remote_paths)]
+    sessions = Sessions(debug)
+    try:
+        with ThreadPoolExecutor(min(jobs, len(files))) as pool:
+            results: list[bool] = list(
+                pool.map(
+                    lambda args: put_one(sessions, *args, retries),
+                    zip(files, remote_paths),
+                )
+            )
+    finally:
+        sessions.close()
+    if not all(results):
+        logger.error(f"{results.count(False)} of {len(files)} files failed to upload")
+    return all(results)
+
+
+def delta_paths(export: str) -> dict[str, Path]:
+    """Local updates & deletes files generated from an export"""
+    stem: str = Path(export).name.split(".")[0]
+    return {
+        filetype: SNAPSHOT_FILE.parent / f"{stem}-{filetype}.mrc"
+        for filetype in ("updates", "deletes")
+    }
+
+
+def put_delta(export: str, seed: bool, debug, jobs: int, retries: int) -> bool:
+    """Upload only what changed between the snapshot and a full export. The
+    snapshot is updated once both files are uploaded, a failed run leaves the
+    generated files in place so running it again resumes the uploads."""
+    paths: dict[str, Path] = delta_paths(export)
+    # reuse files left by a failed run of the same export so uploads resume
+    fresh: bool = all(
+        p.exists() and p.stat().st_mtime_ns >= os.stat(export).st_mtime_ns
+        for p in paths.values()
+    )
+    with Snapshot(SNAPSHOT_FILE) as snapshot:
+        if seed or fresh:
+            updated, deleted, unchanged = snapshot.delta(export, None, None)
+        else:
+            updated, deleted, unchanged = snapshot.delta(
+                export, paths["updates"], paths["deletes"]
+            )
+        logger.info(
+            f"{export}: {updated} new or changed, {deleted} deleted, {unchanged} unchanged records"
+            + (" (reusing files from the last run)" if fresh and not seed else "")
+        )
+        uploads: dict[str, Path] = {
+            t: p for t, p in paths.items() if (updated, deleted)[t == "deletes"]
+        }
+        if not seed and uploads:
+            ok: bool = put_all(
+                [str(p) for p in uploads.values()],
+                [f"{t}/{rename(t)}" for t in uploads],
+                debug,
+                jobs,
+                retries,
+            )
+            if not ok:
+                return False
+        snapshot.commit()
+    for path in paths.values():
+        path.unlink(missing_ok=True)
+    logger.info(f"Snapshot {SNAPSHOT_FILE} now has {updated + unchanged} records")
+    return True
+
+
+class FakeSFTP:
+    """The parts of a pysftp.Connection that upload() uses, with the remote
+    files kept in memory. Writes fail with an IOError once fail_after bytes
+    have been written, like a dropped connection, and opening a file in the
+    broken directory fails."""
+
+    def __init__(
+        self,
+        files: dict[str, bytes] | None = None,
+        fail_after: int | None = None,
+        broken: str | None = None,
+    ):
+        self.files: dict[str, bytes] = dict(files or {})
+        self.fail_after = fail_after
+        # remote directory that can't be written to
+        self.broken = broken
+
+    def stat(self, path: str):
+        if path not in self.files:
+            raise IOError(f"No such file: {path}")
+        return os.stat_result((0,) * 6 + (len(self.files[path]),) + (0,) * 3)
+
+    def open(self, path: str, mode: str) -> "FakeRemoteFile":
+        if self.broken and path.startswith(f"{self.broken}/"):
+            raise IOError(f"Permission denied: {path}")
+        if mode == "w":
+            self.files[path] = b""
+        return FakeRemoteFile(self, path)
+
+    def close(self) -> None:
+        pass
+
+
+class FakeRemoteFile:
+    def __init__(self, sftp: FakeSFTP, path: str):
+        self.sftp = sftp
+        self.path = path
+        self.position: int = 0
+
+    def __enter__(self) -> "FakeRemoteFile":
+        return self
+
+    def __exit__(self, *args) -> None:
+        pass
+
+    def set_pipelined(self, pipelined: bool) -> None:
+        pass
+
+    def seek(self, position: int) -> None:
+        self.position = position
+
+    def write(self, data: bytes) -> None:
+        if self.sftp.fail_after is not None:
+            data = data[: max(self.sftp.fail_after, 0)]
+            self.sftp.fail_after -= len(data)
+        old: bytes = self.sftp.files[self.path]
+        self.sftp.files[self.path] = old[: self.position] + data
+        self.position += len(data)
+        if self.sftp.fail_after == 0:
+            raise IOError("Connection lost")
+
+
+class FakeSessions:
+    """Sessions handing out the same FakeSFTP, or the next of several"""
+
+    def __init__(self, *connections: FakeSFTP):
+        self.connections: list[FakeSFTP] = list(connections)
+
+    def get(self) -> FakeSFTP:
+        return self.connections[0]
+
+    def reset(self) -> None:
+        if len(self.connections) > 1:
+            self.connections.pop(0)
+
+    def close(self) -> None:
+        pass
+
+
+class SummonUpdateTests:
+    @staticmethod
+    def make_export(path: Path, records: list[tuple[str, str]]) -> bytes:
+        """Write (biblionumber, title) records, no 999 if biblionumber is
+        empty, and return the file's bytes"""
+        data: bytes = b"".join(
+            make_raw(
+                [
+                    ("001", f"cca{bn}".encode()),
+                    ("245", b"10" + SD + b"a" + title.encode()),
+                ]
+                + ([("999", b"  " + SD + b"c" + bn.encode())] if bn else [])
+            )
+            for bn, title in records
+        )
+        with open_marc(path, "wb") as out:
+            out.write(data)
+        return data
+
+    def test_upload(self) -> None:
+        from unittest import mock
+
+        with tempfile.TemporaryDirectory() as tmp, mock.patch(f"{__name__}.CHUNK", 64):
+            path = Path(tmp) / "records.mrc.gz"
+            data: bytes = self.make_export(
+                path, [(str(n), f"Title {n}") for n in range(5)]
+            )
+            # a new upload, decompressed on the way
+            sftp = FakeSFTP()
+            reader, resumed = upload(sftp, str(path), "updates/new.mrc")
+            self.assertEqual(sftp.files["updates/new.mrc"], data)
+            self.assertEqual(resumed, 0)
+            self.assertEqual((reader.size, reader.records), (len(data), 5))
+            self.assertEqual(reader.sha256.hexdigest(), sha256(data).hexdigest())
+            # resuming part way through a record, the totals still cover the
+            # whole file
+            sftp = FakeSFTP({"updates/part.mrc": data[:150]})
+            reader, resumed = upload(sftp, str(path), "updates/part.mrc")
+            self.assertEqual(sftp.files["updates/part.mrc"], data)
+            self.assertEqual(resumed, 150)
+            self.assertEqual((reader.size, reader.records), (len(data), 5))
+            self.assertEqual(reader.sha256.hexdigest(), sha256(data).hexdigest())
+            # a short remote file is an error
+            sftp = FakeSFTP(fail_after=100)
+            self.assertRaises(IOError, upload, sftp, str(path), "updates/short.mrc")
+            self.assertEqual(sftp.files["updates/short.mrc"], data[:100])
+
+    def test_put_one(self) -> None:
+        from unittest import mock
+
+        with (
+            tempfile.TemporaryDirectory() as tmp,
+            mock.patch(f"{__name__}.STATE_FILE", Path(tmp) / "state.json"),
+            mock.patch(f"{__name__}.time.sleep"),
+            mock.patch(f"{__name__}.CHUNK", 64),
+        ):
+            path = Path(tmp) / "records.mrc"
+            data: bytes = self.make_export(
+                path, [(str(n), f"Title {n}") for n in range(5)]
+            )
+            key: str = state_key(str(path))
+            # the connection drops and no retries are left: the remote name
+            # is kept so a re-run resumes it
+            sftp = FakeSFTP(fail_after=200)
+            with self.assertLogs(logger, "INFO") as logs:
+                self.assertFalse(
+                    put_one(FakeSessions(sftp), str(path), "full/a.mrc", 0)
+                )
+            self.assertIn("Giving up on", logs.output[-1])
+            self.assertEqual(load_state(), {key: "full/a.mrc"})
+            self.assertEqual(sftp.files["full/a.mrc"], data[:200])
+            # put_all picks the remote name up again and resumes the upload
+            sftp.fail_after = None
+            with (
+                mock.patch(f"{__name__}.Sessions", lambda debug: FakeSessions(sftp)),
+                self.assertLogs(logger, "INFO") as logs,
+            ):
+                self.assertTrue(put_all([str(path)], ["full/b.mrc"], None, 2, 0))
+            self.assertEqual(sftp.files["full/a.mrc"], data)
+            self.assertNotIn("full/b.mrc", sftp.files)
+            self.assertIn("(resumed at byte 200)", "\n".join(logs.output))
+            self.assertIn(f"SHA-256 {sha256(data).hexdigest()}", logs.output[-1])
+            self.assertEqual(load_state(), {})
+            # a retry on a new connection resumes where the first one stopped
+            sftp = FakeSFTP(fail_after=100)
+            again = FakeSFTP()
+            sessions = FakeSessions(sftp, again)
+            with self.assertLogs(logger, "INFO") as logs:
+                self.assertTrue(put_one(sessions, str(path), "full/c.mrc", 1))
+            self.assertTrue(any("attempt 1 of 2" in line for line in logs.output))
+            self.assertTrue(
+                any(
+                    "Number of records" in line and ": 5" in line
+                    for line in logs.output
+                )
+            )
+            self.assertEqual(load_state(), {})
+
+    def test_delta(self) -> None:
+        from unittest import mock
+
+        with tempfile.TemporaryDirectory() as tmp, mock.patch(f"{__name__}.BATCH", 2):
+            export = Path(tmp) / "export.mrc"
+            updates = Path(tmp) / "updates.mrc"
+            deletes = Path(tmp) / "deletes.mrc"
+            first = [(str(n), f"Title {n}") for n in range(1, 6)]
+            self.make_export(export, first)
+            with Snapshot(Path(tmp) / "snapshot.db") as snapshot:
+                self.assertEqual(
+                    snapshot.delta(str(export), updates, deletes), (5, 0, 0)
+                )
+                # nothing is kept until commit()
+                self.assertEqual(len(snapshot), 0)
+                snapshot.commit()
+                self.assertEqual(len(snapshot), 5)
+                # 1 changed, 2 deleted, 1 added, 1 without a 999 & 2 unchanged
+                self.make_export(
+                    export,
+                    [
+                        ("1", "Title 1"),
+                        ("2", "Title 2, revised"),
+                        ("4", "Title 4"),
+                        ("6", "Title 6"),
+                        ("", "No biblionumber"),
+                    ],
+                )
+                self.assertEqual(
+                    snapshot.delta(str(export), updates, deletes), (3, 2, 2)
+                )
+                with open(updates, "rb") as fh:
+                    changed = [control_number(raw) for _, raw in iter_raw(fh)]
+                self.assertEqual(changed, [["cca2"], ["cca6"], ["cca"]])
+                with open(deletes, "rb") as fh:
+                    stubs = [Record(data=raw) for _, raw in iter_raw(fh)]
+                self.assertEqual(
+                    sorted((r.leader[5], r["001"].data, r["999"]["c"]) for r in stubs),
+                    [("d", "cca3", "3"), ("d", "cca5", "5")],
+                )
+                # comparing again without committing gives the same answer
+                self.assertEqual(snapshot.delta(str(export), None, None), (3, 2, 2))
+                snapshot.commit()
+                self.assertEqual(len(snapshot), 4)
+                # rows are staged in batches, unchanged records' too
+                sizes: list[int] = []
+                stage_rows = Snapshot._stage
+                with mock.patch.object(
+                    Snapshot,
+                    "_stage",
+                    lambda self, rows: sizes.append(len(rows))
+                    or stage_rows(self, rows),
+                ):
+                    self.assertEqual(snapshot.delta(str(export), None, None), (1, 0, 4))
+                self.assertEqual(sum(sizes), 4)
+                self.assertLessEqual(max(sizes), 2)
+
+    def test_put_delta(self) -> None:
+        from unittest import mock
+
+        with (
+            tempfile.TemporaryDirectory() as tmp,
+            mock.patch(f"{__name__}.SNAPSHOT_FILE", Path(tmp) / "snapshot.db"),
+        ):
+            export = Path(tmp) / "export.mrc"
+            self.make_export(export, [(str(n), f"Title {n}") for n in range(1, 4)])
+            # --seed records the export without uploading anything
+            with mock.patch(f"{__name__}.put_all") as put, self.assertLogs(logger):
+                self.assertTrue(put_delta(str(export), True, None, 2, 0))
+            put.assert_not_called()
+            with Snapshot(Path(tmp) / "snapshot.db") as snapshot:
+                self.assertEqual(len(snapshot), 3)
+
+            self.make_export(export, [("1", "Title 1, revised"), ("2", "Title 2")])
+            paths: dict[str, Path] = delta_paths(str(export))
+            # the updates upload but the deletes don't: the snapshot isn't
+            # committed and the generated files are kept to resume from
+            sftp = FakeSFTP(broken="deletes")
+            with (
+                mock.patch(f"{__name__}.STATE_FILE", Path(tmp) / "state.json"),
+                mock.patch(f"{__name__}.Sessions", lambda debug: FakeSessions(sftp)),
+                mock.patch(f"{__name__}.time.sleep"),
+            ):
+                with self.assertLogs(logger):
+                    self.assertFalse(put_delta(str(export), False, None, 2, 0))
+                self.assertEqual([p.split("/")[0] for p in sftp.files], ["updates"])
+                self.assertTrue(all(p.exists() for p in paths.values()))
+                updates = paths["updates"].read_bytes()
+                deletes: bytes = paths["deletes"].read_bytes()
+                with Snapshot(Path(tmp) / "snapshot.db") as snapshot:
+                    self.assertEqual(len(snapshot), 3)
+                    self.assertEqual(snapshot.delta(str(export), None, None), (1, 1, 1))
+                # the next run reuses the files and commits once both are up
+                sftp.broken = None
+                with self.assertLogs(logger) as logs:
+                    self.assertTrue(put_delta(str(export), False, None, 2, 0))
+            self.assertIn("reusing files from the last run", logs.output[0])
+            self.assertEqual(
+                sorted(sftp.files.values(), key=len),
+                sorted([updates, deletes], key=len),
+            )
+            self.assertFalse(any(p.exists() for p in paths.values()))
+            with Snapshot(Path(tmp) / "snapshot.db") as snapshot:
+                self.assertEqual(snapshot.delta(str(export), None, None), (0, 0, 2))
+
+    def test_usage(self) -> None:
+        with tempfile.TemporaryDirectory() as tmp:
+            export = Path(tmp) / "export.mrc"
+            self.make_export(export, [("1", "Title 1")])
+            runner = CliRunner()
+            for args, error in (
+                (
+                    [str(export), "--seed", "-t", "full"],
+                    "--seed only works with --delta",
+                ),
+                ([str(export), "--delta", "-t", "full"], "no --type"),
+                ([str(export)], "Missing option"),
+                ([tmp, str(export), "--delta"], "not 2 files"),
+                ([str(Path(tmp) / "empty"), "--delta"], "No MARC files found"),
+            ):
+                (Path(tmp) / "empty").mkdir(exist_ok=True)
+                result = runner.invoke(put_file, args)
+                self.assertEqual(result.exit_code, 2, args)
+                self.assertIn(error, result.output)
 
 
 @click.command()
-@click.argument("file_path")
+@click.argument("file_paths", nargs=-1, required=True, metavar="FILE_OR_DIR...")
 @click.help_option("--help", "-h")
 @click.option(
     "-t",
     "--type",
     "filetype",
-    help="type of update",
-    required=True,
+    help="type of update  [required unless --delta]",
     type=click.Choice(["updates", "deletes", "full"]),
 )
+@click.option(
+    "--delta",
+    is_flag=True,
+    help="FILE is a full export, upload only records added, changed or deleted since the last --delta",
+)
+@click.option(
+    "--seed",
+    is_flag=True,
+    help="with --delta, record the export as uploaded without uploading anything (e.g. after a full reload)",
+)
 @click.option(
     "-d", "--debug", is_flag=True, help="enable SFTP debug logging", flag_value=1
 )
+@click.option(
+    "-j",
+    "--jobs",
+    default=2,
+    show_default=True,
+    help="number of SFTP sessions uploading at once",
+    type=click.IntRange(min=1),
+)
+@click.option(
+    "-r",
+    "--retries",
+    default=3,
+    show_default=True,
+    help="times to retry (resume) a failed upload",
+    type=click.IntRange(min=0),
+)
+@profile_option
+@test_option(SummonUpdateTests)
 def put_file(
-    file_path: str,
-    filetype: Literal["updates", "deletes", "full"],
+    file_paths: tuple[str, ...],
+    filetype: Literal["updates", "deletes", "full"] | None,
+    delta: bool = False,
+    seed: bool = False,
     debug: Literal[1, None] = None,
+    jobs: int = 2,
+    retries: int = 3,
 ) -> None:
     """
-    Puts a file to the Summon SFTP server.
+    Puts files (or directories of files) to the Summon SFTP server.
     """
-    # we need to know the number of records for Summon admin
-    with open(file_path, "rb") as fh:
-        reader = MARCReader(fh)
-        # count=1 for non-MARC files if we don't include the isinstance check
-        count: int = sum(1 for record in reader if isinstance(record, Record))
-        if count and count != 0:
-            logger.info(f"Number of records in {file_path}: {count}")
-        else:
+    if delta and filetype:
+        raise click.UsageError("--delta takes a single full export and no --type")
+    if seed and not delta:
+        raise click.UsageError("--seed only works with --delta")
+    if not delta and not filetype:
+        raise click.UsageError("Missing option '-t' / '--type'")
+
+    files: list[str] = expand(file_paths)
+    if not files:
+        raise click.UsageError(f"No MARC files found in {', '.join(file_paths)}")
+    if delta and len(files) > 1:
+        raise click.UsageError(
+            f"--delta takes a single full export, not {len(files)} files"
+        )
+    for file_path in files:
+        kind: str = file_format(file_path)
+        if kind != "marc":
+            if delta:
+                # the delta's files are written as binary MARC
+                continue
+            logger.error(
+                f"{file_path} is {'MARCXML' if kind == 'xml' else 'MARC-in-JSON'} but Summon takes binary MARC. Upload it with --delta or convert it with break.py."
+            )
+            exit()
+        if not looks_like_marc(file_path):
             logger.error(
                 f"No records found in {file_path}. Are you sure it's a MARC file?"
             )
             exit()
 
-    remote_path: str = f"{filetype}/{rename(filetype)}"
-    with pysftp.Connection(
-        cnopts=cnopts,
-        host=config["SUMMON_SFTP_HOST"],
-        log=debug,  # type: ignore
-        port=int(config.get("SUMMON_SFTP_PORT", 22)),
-        private_key=config["SUMMON_SFTP_KEY"],
-        username=config["SUMMON_SFTP_USER"],
-    ) as sftp:
-        sftp.put(file_path, remote_path)
-        logger.info(f"File {file_path} put to {remote_path}")
+    if delta:
+        if not put_delta(files[0], seed, debug, jobs, retries):
+            exit(1)
+        return
+
+    remote_paths: list[str] = [
+        f"{filetype}/{rename(filetype, n + 1 if len(files) > 1 else None)}"  # type: ignore
+        for n in range(len(files))
+    ]
+    if not put_all(files, remote_paths, debug, jobs, retries):
+        exit(1)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,66 @@
+"""
+Runs the unittest cases embedded in the scripts, e.g. `python
+split_lang_codes.py test`. A script's tests are a plain class of test_
+methods (a mixin) that only becomes a unittest.TestCase here, so importing a
+script to run one of its commands doesn't import unittest, which koha_qa.py
+test checks.
+
+Scripts that are a click group add `test_command(Tests)` to it, scripts that
+are a single command take `@test_option(Tests)`, an eager `--test` flag that
+runs the tests instead of the command like `--help` prints help.
+"""
+
+import sys
+from typing import Callable, Literal
+
+import click
+
+
+def run_tests(*mixins: type, verbose: bool = False) -> Literal[0, 1]:
+    """Run the test methods of each mixin as a unittest.TestCase. Returns 0
+    for success, 1 for failures."""
+    import unittest
+
+    loader = unittest.TestLoader()
+    suite = unittest.TestSuite(
+        loader.loadTestsFromTestCase(
+            type(
+                mixin.__name__,
+                (mixin, unittest.TestCase),
+                {"__module__": mixin.__module__},
+            )
+        )
+        for mixin in mixins
+    )
+    runner = unittest.TextTestRunner(verbosity=2 if verbose else 0)
+    result: unittest.TestResult = runner.run(suite)
+    return 0 if result.wasSuccessful() else 1
+
+
+def test_command(*mixins: type, help: str = "Run the test suite.") -> click.Command:
+    """A `test` command for a click group that runs the mixins' tests"""
+
+    @click.command("test", help=help)
+    @click.option("--verbose", "-v", is_flag=True, help="more verbose test output")
+    def test(verbose: bool) -> None:
+        sys.exit(run_tests(*mixins, verbose=verbose))
+
+    return test
+
+
+def test_option(*mixins: type) -> Callable:
+    """Decorator adding an eager --test flag to a click command that runs the
+    mixins' tests and exits"""
+
+    def callback(ctx: click.Context, _, value: bool) -> None:
+        if value and not ctx.resilient_parsing:
+            sys.exit(run_tests(*mixins))
+
+    return click.option(
+        "--test",
+        is_flag=True,
+        is_eager=True,
+        expose_value=False,
+        callback=callback,
+        help="run the test suite and exit",
+    )